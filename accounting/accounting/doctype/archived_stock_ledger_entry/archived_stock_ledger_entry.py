@@ -0,0 +1,33 @@
+# Copyright (c) 2023, Akhil and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+
+
+class ArchivedStockLedgerEntry(Document):
+	# begin: auto-generated types
+	# This code is auto-generated. Do not modify anything in this block.
+
+	from typing import TYPE_CHECKING
+
+	if TYPE_CHECKING:
+		from frappe.types import DF
+
+		entry_time: DF.Datetime
+		item: DF.Link
+		qty_after_transaction: DF.Float
+		quantity: DF.Float
+		rate: DF.Float
+		source: DF.DynamicLink
+		stock_value: DF.Float
+		stock_value_difference: DF.Float
+		type: DF.Link
+		valuation_rate: DF.Float
+		warehouse: DF.Link
+	# end: auto-generated types
+	pass
+
+
+def on_doctype_update():
+	frappe.db.add_index("Archived Stock Ledger Entry", ["item", "warehouse", "entry_time"])
@@ -0,0 +1,9 @@
+# Copyright (c) 2023, Akhil and Contributors
+# See license.txt
+
+# import frappe
+from frappe.tests.utils import FrappeTestCase
+
+
+class TestArchivedStockLedgerEntry(FrappeTestCase):
+	pass
@@ -0,0 +1,523 @@
+# Copyright (c) 2023, Akhil and contributors
+# For license information, please see license.txt
+import itertools
+import json
+from datetime import datetime
+from functools import partial
+from typing import TYPE_CHECKING, Iterable
+
+import frappe
+from frappe.model.document import Document
+from frappe.query_builder import DocType, Tuple, functions
+from frappe.utils import cint, flt, get_datetime
+
+if TYPE_CHECKING:
+	from accounting.accounting.doctype.stock_entry.stock_entry import LedgerEntry
+
+BALANCE_CACHE_KEY = "stock_balance_cache"
+BALANCE_CACHE_VERSION_KEY = "stock_balance_cache_version"
+BALANCE_CACHE_HITS_KEY = "stock_balance_cache_hits"
+BALANCE_CACHE_MISSES_KEY = "stock_balance_cache_misses"
+BALANCE_CACHE_EXPIRY = 24 * 60 * 60
+LEDGER_SEQUENCE_KEY = "stock_ledger_sequence"
+LEDGER_CHANGES_KEY = "stock_ledger_changes"
+
+# KEYS[1] is the cache, ARGV the expiry followed by a field, modified stamp and value per balance
+SET_IF_NEWER_SCRIPT = """
+for i = 2, #ARGV, 3 do
+	local current = redis.call("HGET", KEYS[1], ARGV[i])
+	if not current or cjson.decode(current)["modified"] <= ARGV[i + 1] then
+		redis.call("HSET", KEYS[1], ARGV[i], ARGV[i + 2])
+	end
+end
+redis.call("EXPIRE", KEYS[1], ARGV[1])
+"""
+
+
+class NegativeStockError(frappe.ValidationError):
+	pass
+
+
+class Bin(Document):
+	# begin: auto-generated types
+	# This code is auto-generated. Do not modify anything in this block.
+
+	from typing import TYPE_CHECKING
+
+	if TYPE_CHECKING:
+		from frappe.types import DF
+
+		actual_qty: DF.Float
+		item: DF.Link
+		stock_value: DF.Float
+		valuation_rate: DF.Float
+		warehouse: DF.Link
+	# end: auto-generated types
+	pass
+
+
+def on_doctype_update():
+	frappe.db.add_unique("Bin", ["item", "warehouse"], constraint_name="unique_item_warehouse")
+
+
+def get_bin_balances(pairs: Iterable[tuple[str, str]]) -> dict[tuple[str, str], frappe._dict]:
+	"""
+	Function to fetch the current balance of many (item, warehouse) pairs at once
+
+	:param pairs: (item, warehouse) pairs to fetch
+	:return: Mapping of (item, warehouse) to its actual_qty, valuation_rate and the modified time
+		of the bin, pairs that were never stocked are missing
+	"""
+	pairs = list(pairs)
+	if not pairs:
+		return {}
+
+	bin = DocType("Bin")
+	return {
+		(row.item, row.warehouse): row
+		for row in frappe.qb.from_(bin)
+		.select(bin.item, bin.warehouse, bin.actual_qty, bin.valuation_rate, bin.modified)
+		.where(Tuple(bin.item, bin.warehouse).isin(pairs))
+		.run(as_dict=True)
+	}
+
+
+def get_balance_cache_version() -> int:
+	return cint(frappe.cache.get(frappe.cache.make_key(BALANCE_CACHE_VERSION_KEY)))
+
+
+def get_balance_cache_key() -> str:
+	# Bumping the version orphans every cached balance at once, they expire on their own
+	return frappe.cache.make_key(f"{BALANCE_CACHE_KEY}::v{get_balance_cache_version()}")
+
+
+def write_cached_balances(values: dict[str, dict]):
+	# Every value carries the modified time of the bin it was read from. A field is only ever
+	# replaced by a value read at the same time or later, so that a balance read from an older
+	# snapshot cannot overwrite the newer one, nor the marker left when the bin changed.
+	if values:
+		frappe.cache.register_script(SET_IF_NEWER_SCRIPT)(
+			keys=[get_balance_cache_key()],
+			args=[
+				BALANCE_CACHE_EXPIRY,
+				*itertools.chain.from_iterable(
+					(field, value["modified"], json.dumps(value)) for field, value in values.items()
+				),
+			],
+		)
+
+
+def get_modified_stamp(modified: datetime | str) -> str:
+	# Fixed width, so that stamps compare in the order of the times
+	return get_datetime(modified).isoformat(sep=" ", timespec="microseconds")
+
+
+def set_cached_balances(rows: Iterable[frappe._dict]):
+	"""
+	Function to write bin balances read from the database to the cache
+
+	:param rows: Bin rows with item, warehouse, actual_qty, valuation_rate and modified
+	"""
+	write_cached_balances(
+		{
+			f"{row.item}::{row.warehouse}": {
+				"actual_qty": row.actual_qty,
+				"valuation_rate": row.valuation_rate,
+				"modified": get_modified_stamp(row.modified),
+			}
+			for row in rows
+		}
+	)
+
+
+def invalidate_cached_balances(rows: Iterable[frappe._dict]):
+	"""
+	Function to drop the cached balances of bins that changed, once the change is committed
+
+	The balances are left for the next read to fill in. A marker with the modified time of the
+	change takes their place, which keeps balances read before the change out of the cache.
+
+	:param rows: Bin rows with item, warehouse and modified
+	"""
+	write_cached_balances(
+		{
+			f"{row.item}::{row.warehouse}": {"modified": get_modified_stamp(row.modified)}
+			for row in rows
+		}
+	)
+
+
+def get_cached_bin_balances(
+	pairs: Iterable[tuple[str, str]]
+) -> dict[tuple[str, str], frappe._dict]:
+	"""
+	Function to fetch the current balance of many (item, warehouse) pairs, from the cache first
+
+	Balances missing from the cache are read from the bins and cached. Balances of bins that change
+	are dropped from the cache, and the cache is never used for the locked check made while posting.
+
+	:param pairs: (item, warehouse) pairs to fetch
+	:return: Mapping of (item, warehouse) to its actual_qty and valuation_rate, pairs that were
+		never stocked are missing
+	"""
+	pairs = list(set(pairs))
+	if not pairs:
+		return {}
+
+	balances: dict[tuple[str, str], frappe._dict] = {}
+	misses: list[tuple[str, str]] = []
+	cached = frappe.cache.hmget(
+		get_balance_cache_key(), [f"{item}::{warehouse}" for item, warehouse in pairs]
+	)
+	for (item, warehouse), value in zip(pairs, cached):
+		value = json.loads(value) if value is not None else {}
+		if "actual_qty" in value:
+			balances[(item, warehouse)] = frappe._dict(value, item=item, warehouse=warehouse)
+		else:
+			misses.append((item, warehouse))
+
+	if misses:
+		fetched = get_bin_balances(misses)
+		set_cached_balances(fetched.values())
+		balances.update(fetched)
+
+	pipeline = frappe.cache.pipeline()
+	pipeline.incrby(frappe.cache.make_key(BALANCE_CACHE_HITS_KEY), len(pairs) - len(misses))
+	pipeline.incrby(frappe.cache.make_key(BALANCE_CACHE_MISSES_KEY), len(misses))
+	pipeline.execute()
+	return balances
+
+
+def record_ledger_changes(pairs: Iterable[tuple[str, str]]):
+	"""
+	Function to record that the ledger of the given pairs changed, once the change is committed
+
+	Every change gets the next number of a sequence, and each pair keeps the number of its latest
+	change. Caches built from the ledger remember the number they were built at, and only have to
+	look again at the pairs that changed since.
+
+	:param pairs: (item, warehouse) pairs whose ledger changed
+	"""
+	if pairs := [f"{item}::{warehouse}" for item, warehouse in pairs]:
+		sequence = frappe.cache.incr(frappe.cache.make_key(LEDGER_SEQUENCE_KEY))
+		frappe.cache.zadd(
+			frappe.cache.make_key(LEDGER_CHANGES_KEY), {pair: sequence for pair in pairs}
+		)
+
+
+def get_ledger_sequence() -> int:
+	return cint(frappe.cache.get(frappe.cache.make_key(LEDGER_SEQUENCE_KEY)))
+
+
+def get_changed_pairs(since: int) -> list[tuple[str, str]]:
+	"""
+	Function to fetch the pairs whose ledger changed after a number of the sequence
+
+	:param since: Number of the sequence
+	:return: (item, warehouse) pairs that changed after it
+	"""
+	return [
+		tuple(pair.decode().split("::", 1))
+		for pair in frappe.cache.zrangebyscore(
+			frappe.cache.make_key(LEDGER_CHANGES_KEY), f"({since}", "+inf"
+		)
+	]
+
+
+def invalidate_balance_cache():
+	frappe.cache.incr(frappe.cache.make_key(BALANCE_CACHE_VERSION_KEY))
+
+
+@frappe.whitelist()
+def get_balance_cache_stats() -> dict:
+	"""
+	Endpoint to fetch the hit and miss counters of the balance cache, to help size it
+
+	:return: Hits, misses, hit ratio and current version of the cache
+	"""
+	frappe.only_for("System Manager")
+	hits, misses, version = (
+		cint(value)
+		for value in frappe.cache.mget(
+			[
+				frappe.cache.make_key(BALANCE_CACHE_HITS_KEY),
+				frappe.cache.make_key(BALANCE_CACHE_MISSES_KEY),
+				frappe.cache.make_key(BALANCE_CACHE_VERSION_KEY),
+			]
+		)
+	)
+	return {
+		"hits": hits,
+		"misses": misses,
+		"hit_ratio": hits / (hits + misses) if hits + misses else 0,
+		"version": version,
+		"cached_balances": frappe.cache.hlen(get_balance_cache_key()),
+	}
+
+
+def get_valuation_rate(actual_qty: float, stock_value: float) -> float:
+	return stock_value / actual_qty if actual_qty else 0
+
+
+def get_stock_value_difference(
+	actual_qty: float, stock_value: float, quantity: float, rate: float
+) -> float:
+	"""
+	Function to value a stock movement using the moving average method
+
+	Incoming stock is valued at its own rate, outgoing stock at the current valuation rate.
+
+	:param actual_qty: Quantity in stock before the movement
+	:param stock_value: Value of the stock before the movement
+	:param quantity: Quantity moved, negative for outgoing stock
+	:param rate: Rate of the movement
+	:return: Change in the stock value caused by the movement
+	"""
+	if quantity > 0 or not actual_qty:
+		return quantity * rate
+	return quantity * stock_value / actual_qty
+
+
+def lock_bins(pairs: list[tuple[str, str]]) -> dict[tuple[str, str], frappe._dict]:
+	# A single statement scanning the unique (item, warehouse) index in order, so that every
+	# transaction takes the row locks in the same order and entries with several lines cannot
+	# deadlock each other
+	bin = DocType("Bin")
+	return {
+		(row.item, row.warehouse): row
+		for row in frappe.qb.from_(bin)
+		.select(bin.name, bin.item, bin.warehouse, bin.actual_qty, bin.stock_value)
+		.where(Tuple(bin.item, bin.warehouse).isin(pairs))
+		.orderby(bin.item)
+		.orderby(bin.warehouse)
+		.for_update()
+		.run(as_dict=True)
+	}
+
+
+def get_bins_for_update(pairs: Iterable[tuple[str, str]]) -> dict[tuple[str, str], frappe._dict]:
+	"""
+	Function to fetch and lock the bins for the given (item, warehouse) pairs
+
+	The locks are held until the transaction ends, which serializes postings per (item, warehouse)
+	while postings for other pairs go ahead in parallel. Bins that do not exist yet are created empty.
+
+	:param pairs: (item, warehouse) pairs to fetch
+	:return: Mapping of (item, warehouse) to the bin row
+	"""
+	pairs = sorted(set(pairs))
+	if not pairs:
+		return {}
+
+	if missing := set(pairs) - set(get_bin_balances(pairs)):
+		# Another transaction may create the same bins concurrently, the duplicates are skipped.
+		# Every bin is then locked at once, so that the locks are still taken in the global order.
+		now = frappe.utils.now_datetime()
+		user = frappe.session.user
+		frappe.db.bulk_insert(
+			"Bin",
+			["name", "creation", "modified", "owner", "modified_by", "item", "warehouse"],
+			[
+				(frappe.generate_hash(length=10), now, now, user, user, item, warehouse)
+				for item, warehouse in sorted(missing)
+			],
+			ignore_duplicates=True,
+		)
+
+	return lock_bins(pairs)
+
+
+def apply_entries(entries: list["LedgerEntry"], balances: dict[tuple[str, str], frappe._dict]):
+	"""
+	Function to apply ledger entries one after the other to running balances
+
+	The running balance after every entry is filled in on the entry itself, so that it can be stored
+	on the ledger row.
+
+	:param entries: Ledger entries, in the order they are posted. The incoming row of a transfer
+		comes right after its outgoing row.
+	:param balances: Mapping of (item, warehouse) to its actual_qty and stock_value, updated in place
+	:raises NegativeStockError: If an outgoing entry takes more than the stock available
+	"""
+	previous = None
+	for entry in entries:
+		row = balances[(entry.item, entry.warehouse)]
+		if entry.is_transfer_in:
+			# Transferred stock arrives with exactly the value it left with, valued here under the
+			# locks rather than at the rate seen when the entry was saved
+			entry.stock_value_difference = -previous.stock_value_difference
+			entry.rate = get_valuation_rate(entry.quantity, entry.stock_value_difference)
+		# A reversal takes back exactly the value its original row added
+		elif not entry.is_reversal:
+			entry.stock_value_difference = get_stock_value_difference(
+				flt(row.actual_qty), flt(row.stock_value), entry.quantity, entry.rate
+			)
+		row.actual_qty = flt(row.actual_qty) + entry.quantity
+		row.stock_value = flt(row.stock_value) + entry.stock_value_difference
+
+		if entry.quantity < 0 and flt(row.actual_qty, 9) < 0:
+			frappe.throw(
+				f"Not enough stock of {entry.item} in {entry.warehouse} - "
+				f"short by {-row.actual_qty}",
+				NegativeStockError,
+			)
+		entry.qty_after_transaction = row.actual_qty
+		entry.stock_value = row.stock_value
+		entry.valuation_rate = get_valuation_rate(row.actual_qty, row.stock_value)
+		previous = entry
+
+
+def get_later_pairs(
+	pairs: Iterable[tuple[str, str]], after: datetime
+) -> dict[tuple[str, str], float]:
+	"""
+	Function to find the pairs with ledger rows after a point in time
+
+	:param pairs: (item, warehouse) pairs to look for
+	:param after: Point in time
+	:return: Mapping of (item, warehouse) to the lowest running quantity after that point
+	"""
+	stock_ledger_entry = DocType("Stock Ledger Entry")
+	return {
+		(item, warehouse): flt(lowest)
+		for item, warehouse, lowest in frappe.qb.from_(stock_ledger_entry)
+		.select(
+			stock_ledger_entry.item,
+			stock_ledger_entry.warehouse,
+			functions.Min(stock_ledger_entry.qty_after_transaction),
+		)
+		.where(Tuple(stock_ledger_entry.item, stock_ledger_entry.warehouse).isin(list(pairs)))
+		.where(stock_ledger_entry.entry_time > after)
+		.groupby(stock_ledger_entry.item, stock_ledger_entry.warehouse)
+		.run()
+	}
+
+
+def update_bins(
+	entries: Iterable["LedgerEntry"], posting_time: datetime | None = None
+) -> list[tuple[str, str]]:
+	"""
+	Function to apply ledger entries to the bins of their (item, warehouse) pairs
+
+	Backdated entries continue from the balance as of their posting time rather than the current
+	one. The rows posted after them are left as they are, and are reposted later on.
+
+	:param entries: Ledger entries, in the order they are posted
+	:param posting_time: Posting time of backdated entries
+	:return: (item, warehouse) pairs with ledger rows after the backdated entries
+	:raises NegativeStockError: If an outgoing entry takes more than the stock in its bin
+	"""
+	from accounting.accounting.doctype.stock_ledger_entry.stock_ledger_entry import (
+		get_stock_balances,
+	)
+
+	entries = list(entries)
+	bins = get_bins_for_update((entry.item, entry.warehouse) for entry in entries)
+	if posting_time is None:
+		# The availability check on save runs without locks, this is the authoritative one
+		apply_entries(entries, bins)
+		later_pairs = {}
+	else:
+		# Read only after the bins are locked, so that nothing else is posted to these pairs meanwhile
+		apply_entries(entries, get_stock_balances(bins, posting_time))
+
+		changes: dict[tuple[str, str], list[float]] = {}
+		for entry in entries:
+			change = changes.setdefault((entry.item, entry.warehouse), [0.0, 0.0])
+			change[0] += entry.quantity
+			change[1] += entry.stock_value_difference
+
+		# Outgoing stock must also be there at every point after the posting time
+		later_pairs = get_later_pairs(bins, posting_time)
+		for (item, warehouse), (quantity, stock_value) in changes.items():
+			row = bins[(item, warehouse)]
+			row.actual_qty = flt(row.actual_qty) + quantity
+			row.stock_value = flt(row.stock_value) + stock_value
+			lowest = row.actual_qty
+			if (item, warehouse) in later_pairs:
+				lowest = min(lowest, later_pairs[(item, warehouse)] + quantity)
+			if quantity < 0 and flt(lowest, 9) < 0:
+				frappe.throw(
+					f"Not enough stock of {item} in {warehouse} after {posting_time} - "
+					f"short by {-lowest}",
+					NegativeStockError,
+				)
+
+	# Written with a single statement per chunk rather than one per bin
+	now = frappe.utils.now_datetime()
+	for row in bins.values():
+		row.valuation_rate = get_valuation_rate(row.actual_qty, row.stock_value)
+		row.modified = now
+	frappe.db.bulk_update(
+		"Bin",
+		{
+			row.name: {
+				"actual_qty": row.actual_qty,
+				"stock_value": row.stock_value,
+				"valuation_rate": row.valuation_rate,
+				"modified": row.modified,
+			}
+			for row in bins.values()
+		},
+		chunk_size=1000,
+		update_modified=False,
+	)
+
+	# Dropped from the cache once the new balances are visible to everyone else, the commits of
+	# different transactions may run their callbacks in any order
+	frappe.db.after_commit.add(partial(invalidate_cached_balances, list(bins.values())))
+	frappe.db.after_commit.add(partial(record_ledger_changes, list(bins)))
+	return list(later_pairs)
+
+
+def rebuild_bins():
+	"""
+	Function to recreate every bin from scratch out of the stock ledger
+	"""
+	frappe.db.delete("Bin")
+
+	stock_ledger_entry = DocType("Stock Ledger Entry")
+	balances = (
+		frappe.qb.from_(stock_ledger_entry)
+		.select(
+			stock_ledger_entry.item,
+			stock_ledger_entry.warehouse,
+			functions.Sum(stock_ledger_entry.quantity),
+			functions.Sum(stock_ledger_entry.stock_value_difference),
+		)
+		.groupby(stock_ledger_entry.item, stock_ledger_entry.warehouse)
+		.run()
+	)
+
+	now = frappe.utils.now_datetime()
+	frappe.db.bulk_insert(
+		"Bin",
+		[
+			"name",
+			"creation",
+			"modified",
+			"owner",
+			"modified_by",
+			"item",
+			"warehouse",
+			"actual_qty",
+			"stock_value",
+			"valuation_rate",
+		],
+		[
+			(
+				frappe.generate_hash(length=10),
+				now,
+				now,
+				frappe.session.user,
+				frappe.session.user,
+				item,
+				warehouse,
+				actual_qty,
+				stock_value,
+				get_valuation_rate(actual_qty, stock_value),
+			)
+			for item, warehouse, actual_qty, stock_value in balances
+		],
+	)
+	frappe.db.after_commit.add(invalidate_balance_cache)
@@ -0,0 +1,124 @@
+# Copyright (c) 2023, Akhil and Contributors
+# See license.txt
+
+from functools import partial
+
+import frappe
+from accounting.accounting.doctype.item.test_item import create_random_item
+from accounting.accounting.doctype.stock_entry.test_stock_entry import create_entry
+from accounting.accounting.doctype.warehouse.test_warehouse import create_random_warehouse
+from frappe.tests.utils import FrappeTestCase
+
+from .bin import (
+	get_balance_cache_stats,
+	get_bin_balances,
+	get_cached_bin_balances,
+	invalidate_balance_cache,
+	rebuild_bins,
+	set_cached_balances,
+)
+
+
+class TestBin(FrappeTestCase):
+	def setUp(self):
+		frappe.set_user("Administrator")
+		self.item = create_random_item()
+		self.warehouse = create_random_warehouse()
+
+	def get_bin(self):
+		return frappe.db.get_value(
+			"Bin",
+			{"item": self.item.name, "warehouse": self.warehouse.name},
+			["actual_qty", "stock_value", "valuation_rate"],
+			as_dict=True,
+		)
+
+	def get_actual_qty(self) -> float:
+		pair = (self.item.name, self.warehouse.name)
+		return get_bin_balances([pair])[pair].actual_qty
+
+	def test_bin_follows_submit_and_cancel(self):
+		receipt = create_entry(
+			"Receipt",
+			[{"item": self.item.name, "quantity": 10, "rate": 100}],
+			target_warehouse=self.warehouse.name,
+		)
+		self.assertEqual(self.get_actual_qty(), 10)
+		self.assertEqual(self.get_bin().stock_value, 1000)
+
+		consume = create_entry(
+			"Consume",
+			[{"item": self.item.name, "quantity": 4, "rate": 100}],
+			source_warehouse=self.warehouse.name,
+		)
+		self.assertEqual(self.get_actual_qty(), 6)
+		self.assertEqual(self.get_bin().valuation_rate, 100)
+
+		consume.cancel()
+		self.assertEqual(self.get_actual_qty(), 10)
+
+		receipt.cancel()
+		self.assertEqual(self.get_actual_qty(), 0)
+
+	def test_rebuild_bins(self):
+		create_entry(
+			"Receipt",
+			[{"item": self.item.name, "quantity": 10, "rate": 100}],
+			target_warehouse=self.warehouse.name,
+		)
+		create_entry(
+			"Receipt",
+			[{"item": self.item.name, "quantity": 10, "rate": 200}],
+			target_warehouse=self.warehouse.name,
+		)
+		expected = self.get_bin()
+
+		frappe.db.set_value("Bin", {"item": self.item.name}, "actual_qty", 0)
+		rebuild_bins()
+		self.assertEqual(self.get_bin(), expected)
+		self.assertEqual(expected.valuation_rate, 150)
+
+	def test_balance_cache(self):
+		create_entry(
+			"Receipt",
+			[{"item": self.item.name, "quantity": 10, "rate": 100}],
+			target_warehouse=self.warehouse.name,
+		)
+		pair = (self.item.name, self.warehouse.name)
+		invalidate_balance_cache()
+
+		before = get_balance_cache_stats()
+		self.assertEqual(get_cached_bin_balances([pair])[pair].actual_qty, 10)
+		self.assertEqual(get_cached_bin_balances([pair])[pair].valuation_rate, 100)
+		after = get_balance_cache_stats()
+		self.assertEqual(after["misses"] - before["misses"], 1)
+		self.assertEqual(after["hits"] - before["hits"], 1)
+
+		# A new version starts out empty
+		invalidate_balance_cache()
+		get_cached_bin_balances([pair])
+		self.assertEqual(get_balance_cache_stats()["misses"] - after["misses"], 1)
+
+	def test_balance_cache_skips_stale_reads(self):
+		receive = partial(
+			create_entry,
+			"Receipt",
+			[{"item": self.item.name, "quantity": 10, "rate": 100}],
+			target_warehouse=self.warehouse.name,
+		)
+		receive()
+		pair = (self.item.name, self.warehouse.name)
+		invalidate_balance_cache()
+
+		# Read by a transaction whose snapshot predates the next entry, and cached only once that
+		# entry is committed
+		stale = get_bin_balances([pair])
+		receive()
+		frappe.db.after_commit.run()
+		set_cached_balances(stale.values())
+
+		self.assertEqual(get_cached_bin_balances([pair])[pair].actual_qty, 20)
+		# Filled in again by the read that missed
+		before = get_balance_cache_stats()
+		self.assertEqual(get_cached_bin_balances([pair])[pair].actual_qty, 20)
+		self.assertEqual(get_balance_cache_stats()["hits"] - before["hits"], 1)
@@ -0,0 +1,8 @@
+// Copyright (c) 2023, Akhil and contributors
+// For license information, please see license.txt
+
+// frappe.ui.form.on("Stock Closing Balance", {
+// 	refresh(frm) {
+
+// 	},
+// });
@@ -0,0 +1,32 @@
+# Copyright (c) 2023, Akhil and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+
+
+class StockClosingBalance(Document):
+	# begin: auto-generated types
+	# This code is auto-generated. Do not modify anything in this block.
+
+	from typing import TYPE_CHECKING
+
+	if TYPE_CHECKING:
+		from frappe.types import DF
+
+		closing_time: DF.Datetime
+		item: DF.Link
+		period_closing: DF.Link
+		quantity: DF.Float
+		stock_value: DF.Float
+		warehouse: DF.Link
+	# end: auto-generated types
+	pass
+
+
+def on_doctype_update():
+	frappe.db.add_unique(
+		"Stock Closing Balance",
+		["period_closing", "item", "warehouse"],
+		constraint_name="unique_period_closing_item_warehouse",
+	)
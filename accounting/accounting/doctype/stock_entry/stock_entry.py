@@ -1,13 +1,59 @@
 # Copyright (c) 2023, Akhil and contributors
 # For license information, please see license.txt
 import itertools
-from typing import Callable
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Callable, Iterable
 
 from pydantic import BaseModel
 
 import frappe
-from frappe import cint
+from accounting.accounting.doctype.bin.bin import (
+	get_bin_balances,
+	get_cached_bin_balances,
+	update_bins,
+)
+from accounting.accounting.doctype.stock_ledger_archive.stock_ledger_archive import (
+	get_archive_cutoff,
+)
+from accounting.accounting.doctype.stock_period_closing.stock_period_closing import (
+	get_latest_closing,
+)
+from accounting.accounting.doctype.stock_ledger_entry.stock_ledger_entry import (
+	get_stock_balances,
+)
+from accounting.accounting.doctype.stock_repost_entry.stock_repost_entry import queue_repost
+from accounting.instrumentation import instrument
 from frappe.model.document import Document
+from frappe.utils import cint, flt, get_datetime
+
+
+LEDGER_FIELDS = [
+	"name",
+	"creation",
+	"modified",
+	"owner",
+	"modified_by",
+	"item",
+	"warehouse",
+	"entry_time",
+	"quantity",
+	"rate",
+	"qty_after_transaction",
+	"valuation_rate",
+	"stock_value",
+	"stock_value_difference",
+	"type",
+	"source",
+	"is_reversal",
+	"is_transfer_in",
+]
+
+# Default of Stock Settings.background_submit_threshold
+BACKGROUND_SUBMIT_THRESHOLD = 500
+
+# Fields of a Stock Entry Item accepted by the bulk submission endpoint
+LINE_FIELDS = ["item", "quantity", "rate", "source_warehouse", "target_warehouse"]
 
 
 class LedgerEntry(BaseModel):
@@ -15,6 +61,12 @@ class LedgerEntry(BaseModel):
 	warehouse: str
 	quantity: float
 	rate: float
+	qty_after_transaction: float = 0
+	valuation_rate: float = 0
+	stock_value: float = 0
+	stock_value_difference: float = 0
+	is_reversal: bool = False
+	is_transfer_in: bool = False
 
 
 class StockEntry(Document):
@@ -30,9 +82,36 @@ class StockEntry(Document):
 		amended_from: DF.Link | None
 		entry_type: DF.Literal['Receipt', 'Consume', 'Transfer']
 		items: DF.Table[StockEntryItem]
+		posting_time: DF.Datetime | None
 		source_warehouse: DF.Link
+		status: DF.Literal['Draft', 'Queued', 'Processing', 'Failed', 'Submitted', 'Cancelled']
 		target_warehouse: DF.Link
 	# end: auto-generated types
+	def _validate_links(self):
+		if not self.flags.ignore_links and self._action != "cancel":
+			self.prefetch_links()
+		super()._validate_links()
+
+	def prefetch_links(self):
+		# The link checks look every link field of every line up on its own. The Items and
+		# Warehouses the entry references are looked up with a single query per doctype instead,
+		# and seeded into the value cache those checks read from.
+		names: dict[str, set[str]] = {"Item": set(), "Warehouse": set()}
+		for doc in (self, *self.items):
+			for fieldname in ("source_warehouse", "target_warehouse"):
+				if name := doc.get(fieldname):
+					names["Warehouse"].add(name)
+		names["Item"].update(item.item for item in self.items if item.item)
+
+		# Lookups already made for a whole batch of entries are reused
+		existing_names = self.flags.existing_names or {}
+		for doctype, references in names.items():
+			existing = existing_names.get(doctype)
+			if existing is None:
+				existing = get_existing_names(doctype, references)
+			for name in references:
+				frappe.db.value_cache[(doctype, name, "name")] = ((name,),) if name in existing else ()
+
 	def validate_item_metadata(self, item: "StockEntryItem"):
 		if item.quantity <= 0:
 			frappe.throw("Quantity needs to be a positive number")
@@ -58,22 +137,6 @@ class StockEntry(Document):
 		if item.target_warehouse or self.target_warehouse:
 			frappe.throw("Target Warehouse is not allowed for consume")
 
-		# Fetch the stock for the given item in the given warehouse
-		stock = frappe.db.get_value(
-			"Stock Ledger Entry",
-			{
-				"item": item.item,
-				"warehouse": item.source_warehouse,
-			},
-			"sum(quantity)",
-		)
-
-		# Ensure that the warehouse has enough stock
-		if item.quantity > cint(stock):
-			frappe.throw(
-				f"Not enough stock in the warehouse - available: {stock or 0}, requested: {item.quantity}"
-			)
-
 	def validate_transfer(self, item: "StockEntryItem"):
 		if not self.target_warehouse and not item.target_warehouse:
 			frappe.throw("Target Warehouse is mandatory for transfer")
@@ -88,51 +151,142 @@ class StockEntry(Document):
 		if item.source_warehouse == item.target_warehouse:
 			frappe.throw("Source and Target Warehouse cannot be the same")
 
-		# Fetch the stock for the given item in the given warehouse
-		stock = frappe.db.get_value(
-			"Stock Ledger Entry",
-			{
-				"item": item.item,
-				"warehouse": item.source_warehouse,
-			},
-			"sum(quantity)",
-		)
+	def validate_stock_availability(self, balances: dict[tuple[str, str], frappe._dict]):
+		# Requested quantities are summed per (item, source warehouse) first, so that several lines
+		# drawing from the same stock cannot oversell it together
+		requested: dict[tuple[str, str], float] = defaultdict(float)
+		for item in self.items:
+			requested[(item.item, item.source_warehouse)] += item.quantity
+
+		# Ensure that the warehouses have enough stock
+		for (item, warehouse), quantity in requested.items():
+			stock = balances[(item, warehouse)].actual_qty if (item, warehouse) in balances else 0
+			if quantity > stock:
+				frappe.throw(
+					f"Not enough stock of {item} in {warehouse} - "
+					f"available: {stock}, requested: {quantity}"
+				)
 
-		# Ensure that the warehouse has enough stock
-		if item.quantity > cint(stock):
+	def validate_posting_time(self):
+		if not self.posting_time:
+			return
+
+		now = frappe.utils.now_datetime()
+		posting_time = get_datetime(self.posting_time)
+		if posting_time > now:
+			frappe.throw("Posting Time cannot be in the future")
+
+		# Closed periods are snapshotted, stock posted into them would not be counted
+		if (closing := get_latest_closing(now)) and posting_time < get_datetime(closing.closing_time):
 			frappe.throw(
-				f"Not enough stock in the warehouse - available: {stock or 0}, requested: {item.quantity}"
+				f"Stock is closed until {closing.closing_time} by Stock Period Closing {closing.name}"
 			)
 
-		# Get the average rate for the given item in the given warehouse
-		if average_rate := frappe.db.get_value(
-			"Stock Ledger Entry",
-			{
-				"item": item.item,
-				"warehouse": item.source_warehouse,
-			},
-			"avg(rate)",
-		):
-			item.rate = average_rate
+		# Rows before the cutoff are archived, the carry-forward rows after them could not be reposted
+		if (cutoff := get_archive_cutoff(include_queued=True)) and posting_time < cutoff:
+			frappe.throw(f"The Stock Ledger is archived until {cutoff}")
+
+	def set_transfer_rates(self, balances: dict[tuple[str, str], frappe._dict]):
+		# Transferred stock moves at the current valuation rate of the source warehouse. This is
+		# only an estimate, the ledger values it again against the locked bins when posting.
+		for item in self.items:
+			if balance := balances.get((item.item, item.source_warehouse)):
+				item.rate = balance.valuation_rate
+
+	@instrument
+	def insert_ledger(self, items: list[LedgerEntry], entry_time: datetime | None = None):
+		# The ledger rows are written with multi-row inserts instead of a document lifecycle per row.
+		# The links were already validated on the stock entry, so checking the permission once is
+		# all the validation that is left.
+		frappe.has_permission("Stock Ledger Entry", "create", throw=True)
+
+		user = frappe.session.user
+		values = [
+			(
+				frappe.generate_hash(length=10),
+				# Offset the creation of every row so that rows sharing an entry time keep the order
+				# they were posted in
+				self.current_time + timedelta(microseconds=idx),
+				self.current_time,
+				user,
+				user,
+				row.item,
+				row.warehouse,
+				entry_time or self.current_time,
+				row.quantity,
+				row.rate,
+				row.qty_after_transaction,
+				row.valuation_rate,
+				row.stock_value,
+				row.stock_value_difference,
+				"Stock Entry",
+				self.name,
+				row.is_reversal,
+				row.is_transfer_in,
+			)
+			for idx, row in enumerate(items)
+		]
 
-	def insert_ledger(self, items: list[LedgerEntry]):
-		for row in items:
-			frappe.new_doc(
+		chunk_size = 10_000
+		if self.flags.in_background_submit:
+			chunk_size = cint(frappe.db.get_single_value("Stock Settings", "ledger_chunk_size")) or 1000
+
+		for chunk_start in range(0, len(values), chunk_size):
+			frappe.db.bulk_insert(
 				"Stock Ledger Entry",
-				item=row.item,
-				warehouse=row.warehouse,
-				entry_time=self.current_time,
-				quantity=row.quantity,
-				rate=row.rate,
-				type="Stock Entry",
-				source=self.name,
-			).insert()
+				LEDGER_FIELDS,
+				values[chunk_start : chunk_start + chunk_size],
+				chunk_size=chunk_size,
+			)
+			if self.flags.in_background_submit:
+				frappe.publish_progress(
+					min(chunk_start + chunk_size, len(values)) * 100 / len(values),
+					title="Posting Stock Ledger",
+					doctype=self.doctype,
+					docname=self.name,
+				)
 
 	def handle_invalid_entry_type(self, _):
 		frappe.throw(f"Invalid Entry Type: {self.entry_type}")
 
+	@frappe.whitelist()
+	def submit(self):
+		threshold = frappe.db.get_single_value("Stock Settings", "background_submit_threshold")
+		# Unset until Stock Settings are saved, while 0 turns background submission off
+		threshold = BACKGROUND_SUBMIT_THRESHOLD if threshold is None else cint(threshold)
+		if threshold and len(self.items) > threshold:
+			self.queue_submit()
+			return self
+		return self._submit()
+
+	def queue_submit(self):
+		# Locking keeps the document from being submitted twice while it waits for a worker
+		self.lock()
+		self.db_set("status", "Queued")
+		frappe.enqueue(
+			process_queued_submission,
+			queue="long",
+			timeout=3600,
+			job_id=f"stock_entry_submit::{self.name}",
+			deduplicate=True,
+			enqueue_after_commit=True,
+			name=self.name,
+		)
+		frappe.msgprint(
+			f"Stock Entry {self.name} has {len(self.items)} lines and will be submitted in the "
+			"background. The form will update once it is done.",
+			alert=True,
+		)
+
+	@instrument
 	def before_save(self):
+		if self.status in ("Queued", "Processing") and not self.flags.in_background_submit:
+			frappe.throw(f"Stock Entry {self.name} is being submitted in the background")
+		if self.docstatus == 0:
+			self.status = "Draft"
+
 		self.current_time = frappe.utils.now_datetime()
+		self.validate_posting_time()
 		validation_func: Callable[["StockEntryItem"], None] = self.handle_invalid_entry_type
 		match self.entry_type:
 			case "Receipt":
@@ -146,8 +300,37 @@ class StockEntry(Document):
 			self.validate_item_metadata(item)
 			validation_func(item)
 
-	def on_submit(self):
+		if self.entry_type in ("Consume", "Transfer"):
+			# Fetch the stock for all the source pairs at once, unless a bulk submission already did.
+			# Backdated entries draw from the stock as of their posting time.
+			pairs = [(item.item, item.source_warehouse) for item in self.items]
+			if self.flags.bin_balances:
+				balances = self.flags.bin_balances
+			elif self.posting_time:
+				balances = get_stock_balances(pairs, get_datetime(self.posting_time))
+			else:
+				balances = get_cached_bin_balances(pairs)
+			self.validate_stock_availability(balances)
+			if self.entry_type == "Transfer":
+				self.set_transfer_rates(balances)
+
+	@instrument
+	def before_submit(self):
+		self.status = "Submitted"
 		self.current_time = frappe.utils.now_datetime()
+		self.validate_posting_time()
+		self.posting_time = self.posting_time or self.current_time
+
+	def before_cancel(self):
+		# The rows to reverse are read back from the ledger, they must not be archived yet
+		if (cutoff := get_archive_cutoff(include_queued=True)) and get_datetime(
+			self.posting_time or self.creation
+		) < cutoff:
+			frappe.throw(f"Stock Entries posted before {cutoff} are archived and cannot be cancelled")
+		self.status = "Cancelled"
+
+	@instrument
+	def on_submit(self):
 		items: list[LedgerEntry] = []
 		match self.entry_type:
 			case "Receipt":
@@ -188,63 +371,248 @@ class StockEntry(Document):
 								item=item.item,
 								warehouse=item.target_warehouse,
 								quantity=item.quantity,
-								rate=item.rate
+								rate=item.rate,
+								is_transfer_in=True,
 							)
 						)
 						for item in self.items
 					)
 				)
 
-		self.insert_ledger(items)
+		# Bins are updated first, as they compute the running balance stored on every ledger row.
+		# Backdated entries leave the running balances of the rows after them stale, those are
+		# recomputed in the background.
+		posting_time = get_datetime(self.posting_time)
+		backdated = posting_time < self.current_time
+		later_pairs = update_bins(items, posting_time if backdated else None)
+		self.insert_ledger(items, posting_time)
+		if later_pairs:
+			queue_repost(later_pairs, posting_time, self)
 
+	@instrument
 	def on_cancel(self):
 		self.current_time = frappe.utils.now_datetime()
-		items: list[LedgerEntry] = []
 
-		match self.entry_type:
-			case "Receipt":
-				items.extend(
-					[
-						LedgerEntry(
-							item=item.item,
-							warehouse=item.target_warehouse,
-							quantity=-item.quantity,
-							rate=item.rate
-						)
-						for item in self.items
-					]
-				)
-			case "Consume":
-				items.extend(
-					[
-						LedgerEntry(
-							item=item.item,
-							warehouse=item.source_warehouse,
-							quantity=item.quantity,
-							rate=item.rate
-						)
-						for item in self.items
-					]
-				)
-			case "Transfer":
-				items.extend(
-					itertools.chain.from_iterable(
-						(
-							LedgerEntry(
-								item=item.item,
-								warehouse=item.source_warehouse,
-								quantity=item.quantity,
-								rate=item.rate
-							),
-							LedgerEntry(
-								item=item.item,
-								warehouse=item.target_warehouse,
-								quantity=-item.quantity,
-								rate=item.rate
-							)
-						)
-						for item in self.items
-					)
-				)
+		# Reverse the rows that were actually posted rather than recomputing them from the lines,
+		# so that the reversal matches the original warehouses, rates and values exactly. The rows
+		# are read in one query, the running balances still have to be computed against the bins
+		# before they can be written back.
+		stock_ledger_entry = frappe.qb.DocType("Stock Ledger Entry")
+		items = [
+			LedgerEntry(
+				item=row.item,
+				warehouse=row.warehouse,
+				quantity=-row.quantity,
+				rate=row.rate,
+				stock_value_difference=-flt(row.stock_value_difference),
+				is_reversal=True,
+			)
+			for row in frappe.qb.from_(stock_ledger_entry)
+			.select(
+				stock_ledger_entry.item,
+				stock_ledger_entry.warehouse,
+				stock_ledger_entry.quantity,
+				stock_ledger_entry.rate,
+				stock_ledger_entry.stock_value_difference,
+			)
+			.where(stock_ledger_entry.type == self.doctype)
+			.where(stock_ledger_entry.source == self.name)
+			.orderby(stock_ledger_entry.creation)
+			.run(as_dict=True)
+		]
 
+		update_bins(items)
 		self.insert_ledger(items)
+
+
+def process_queued_submission(name: str):
+	"""
+	Background job submitting a Stock Entry queued by StockEntry.queue_submit
+
+	:param name: Name of the Stock Entry
+	"""
+	doc: StockEntry = frappe.get_doc("Stock Entry", name)
+	# Committed right away, so that the form shows the entry is being worked on
+	doc.db_set("status", "Processing", commit=True)
+	doc.flags.in_background_submit = True
+	try:
+		doc._submit()
+		frappe.db.commit()
+	except Exception:
+		frappe.db.rollback()
+		doc.db_set("status", "Failed", commit=True)
+		doc.log_error(f"Background submission of Stock Entry {name} failed")
+		raise
+	finally:
+		doc.unlock()
+		doc.notify_update()
+
+
+def get_existing_names(doctype: str, names: Iterable[str]) -> set[str]:
+	"""
+	Function to check which of the given names exist, in a single query
+
+	:param doctype: DocType to look the names up in
+	:param names: Names to look up
+	:return: The names that exist
+	"""
+	if names := {name for name in names if name}:
+		return set(frappe.get_all(doctype, filters={"name": ["in", list(names)]}, pluck="name"))
+	return set()
+
+
+def get_lines(entry: dict) -> list[tuple[str, float, str | None, str | None]]:
+	"""
+	Function to resolve the lines of a stock entry the same way the validate_* methods do
+
+	:param entry: Stock entry as a dict
+	:return: Item, quantity, source warehouse and target warehouse of every line
+	"""
+	return [
+		(
+			line.get("item"),
+			flt(line.get("quantity")),
+			entry.get("source_warehouse") or line.get("source_warehouse"),
+			entry.get("target_warehouse") or line.get("target_warehouse"),
+		)
+		for line in entry.get("items") or []
+	]
+
+
+def get_line_error(
+	entry_type: str | None, lines: list[tuple[str, float, str | None, str | None]]
+) -> str | None:
+	"""
+	Function to check the quantities and warehouses of the lines of a stock entry up front, so that
+	the stock available can be tracked through a batch of entries
+
+	:param entry_type: Receipt, Consume or Transfer
+	:param lines: Lines of the entry, as returned by get_lines
+	:return: What is wrong with the lines, None if nothing is
+	"""
+	if entry_type not in ("Receipt", "Consume", "Transfer"):
+		return f"Invalid Entry Type: {entry_type}"
+
+	for idx, (_, quantity, source_warehouse, target_warehouse) in enumerate(lines, start=1):
+		if quantity <= 0:
+			return f"Row #{idx}: Quantity needs to be a positive number"
+		if entry_type in ("Consume", "Transfer") and not source_warehouse:
+			return f"Row #{idx}: Source Warehouse is mandatory for {entry_type.lower()}"
+		if entry_type in ("Receipt", "Transfer") and not target_warehouse:
+			return f"Row #{idx}: Target Warehouse is mandatory for {entry_type.lower()}"
+	return None
+
+
+@frappe.whitelist(methods=["POST"])
+def make_stock_entries(entries: str | list[dict], chunk_size: int = 100) -> list[dict]:
+	"""
+	Endpoint to insert and submit a batch of stock entries
+
+	The entries are validated together: the items and warehouses they reference are looked up
+	once, and the availability of stock is checked in a single pass that follows the entries in
+	order. They are then submitted in chunks, one transaction per chunk. An entry that fails is
+	rolled back on its own and reported, the rest of the batch goes ahead.
+
+	:param entries: Stock entries, as dicts with the fields of a Stock Entry
+	:param chunk_size: Number of entries submitted per transaction
+	:return: Result of every entry, in the order they were given
+	"""
+	frappe.has_permission("Stock Entry", "submit", throw=True)
+	entries: list[dict] = frappe.parse_json(entries)
+	chunk_size = cint(chunk_size) or 100
+	results: list[dict] = [{"index": idx} for idx in range(len(entries))]
+
+	# Shared lookups for all the entries
+	lines = [get_lines(entry) for entry in entries]
+	items = get_existing_names("Item", (line[0] for entry in lines for line in entry))
+	warehouses = get_existing_names(
+		"Warehouse", (warehouse for entry in lines for line in entry for warehouse in line[2:])
+	)
+	balances = get_bin_balances(
+		{
+			(item, warehouse)
+			for entry in lines
+			for item, _, *line_warehouses in entry
+			for warehouse in line_warehouses
+			if warehouse
+		}
+	)
+
+	# Availability pass, following the entries in order so that stock received by an entry can be
+	# consumed by the ones after it
+	for result, entry, entry_lines in zip(results, entries, lines):
+		if missing := {line[0] for line in entry_lines} - items:
+			result["error"] = f"Items not found: {', '.join(sorted(map(str, missing)))}"
+			continue
+		if missing := {w for line in entry_lines for w in line[2:] if w} - warehouses:
+			result["error"] = f"Warehouses not found: {', '.join(sorted(missing))}"
+			continue
+		if error := get_line_error(entry.get("entry_type"), entry_lines):
+			result["error"] = error
+			continue
+
+		requested: dict[tuple[str, str], float] = defaultdict(float)
+		if entry.get("entry_type") in ("Consume", "Transfer"):
+			for item, quantity, source_warehouse, _ in entry_lines:
+				requested[(item, source_warehouse)] += quantity
+
+		available = {
+			pair: frappe._dict(balances.get(pair) or {"actual_qty": 0, "valuation_rate": 0})
+			for pair in requested
+		}
+		if short := [
+			pair for pair, quantity in requested.items() if quantity > available[pair].actual_qty
+		]:
+			result["error"] = "Not enough stock of " + ", ".join(
+				f"{item} in {warehouse}" for item, warehouse in short
+			)
+			continue
+
+		result["bin_balances"] = available
+		for item, quantity, source_warehouse, target_warehouse in entry_lines:
+			if entry.get("entry_type") in ("Consume", "Transfer"):
+				balances.setdefault(
+					(item, source_warehouse), frappe._dict(actual_qty=0, valuation_rate=0)
+				).actual_qty -= quantity
+			if entry.get("entry_type") in ("Receipt", "Transfer") and target_warehouse:
+				balances.setdefault(
+					(item, target_warehouse), frappe._dict(actual_qty=0, valuation_rate=0)
+				).actual_qty += quantity
+
+	for chunk_start in range(0, len(entries), chunk_size):
+		for result, entry in zip(
+			results[chunk_start : chunk_start + chunk_size],
+			entries[chunk_start : chunk_start + chunk_size],
+		):
+			bin_balances = result.pop("bin_balances", None)
+			if "error" in result:
+				result["status"] = "Failed"
+				continue
+
+			frappe.db.savepoint("bulk_stock_entry")
+			try:
+				doc = frappe.new_doc(
+					"Stock Entry",
+					entry_type=entry.get("entry_type"),
+					source_warehouse=entry.get("source_warehouse"),
+					target_warehouse=entry.get("target_warehouse"),
+					items=[
+						{field: line.get(field) for field in LINE_FIELDS}
+						for line in entry.get("items") or []
+					],
+				)
+				# The links and the stock were looked up for the whole batch above
+				doc.flags.existing_names = {"Item": items, "Warehouse": warehouses}
+				doc.flags.bin_balances = bin_balances
+				doc.insert().submit()
+			except frappe.ValidationError as e:
+				frappe.db.rollback(save_point="bulk_stock_entry")
+				frappe.clear_messages()
+				result.update(status="Failed", error=str(e))
+			else:
+				# Large entries are queued for a background worker instead
+				result.update(status=doc.status, name=doc.name)
+
+		frappe.db.commit()
+
+	return results
@@ -1,9 +1,18 @@
 # Copyright (c) 2023, Akhil and Contributors
 # See license.txt
 
+import os
+import unittest
 from typing import Literal
 
 import frappe
+from accounting.accounting.doctype.stock_entry.stock_entry import (
+    make_stock_entries,
+    process_queued_submission,
+)
+from accounting.benchmarks import concurrency
+from accounting.benchmarks.utils import QUERY_BUDGET_SIZES, get_query_counts
+from accounting.instrumentation import track_queries
 from accounting.utils import generate_random_string, get_random_integer
 from frappe.tests.utils import FrappeTestCase
 
@@ -129,6 +138,243 @@ class TestStockEntry(FrappeTestCase):
         )
         self.assertEqual(created_stock_entry_type, "Consume")
 
+    def test_duplicate_lines_cannot_oversell(self):
+        frappe.set_user("Administrator")
+        item = frappe.new_doc("Item", item_name=generate_random_string()).insert()
+        create_entry(
+            "Receipt",
+            [{"item": item.name, "quantity": 10, "rate": 100}],
+            None,
+            self.incoming_warehouse_name,
+        )
+
+        # Each line fits in the available stock on its own, but together they do not
+        with self.assertRaises(frappe.exceptions.ValidationError):
+            create_entry(
+                "Consume",
+                [
+                    {"item": item.name, "quantity": 6, "rate": 100},
+                    {"item": item.name, "quantity": 6, "rate": 100},
+                ],
+                self.incoming_warehouse_name,
+                None,
+            )
+
+    def test_bulk_submission(self):
+        frappe.set_user("Administrator")
+        item = frappe.new_doc("Item", item_name=generate_random_string()).insert()
+        line = {"item": item.name, "quantity": 5, "rate": 100}
+
+        warehouse = self.main_warehouse_name
+        results = make_stock_entries(
+            [
+                {"entry_type": "Receipt", "target_warehouse": warehouse, "items": [line]},
+                # Consumes the stock received by the entry before it
+                {"entry_type": "Consume", "source_warehouse": warehouse, "items": [line]},
+                # Nothing left to consume
+                {"entry_type": "Consume", "source_warehouse": warehouse, "items": [line]},
+                {"entry_type": "Receipt", "target_warehouse": "Missing", "items": [line]},
+                # Never stocked in this warehouse
+                {
+                    "entry_type": "Consume",
+                    "source_warehouse": self.outgoing_warehouse_name,
+                    "items": [{**line, "quantity": 0}],
+                },
+                {"entry_type": "Consume", "items": [line]},
+                {"entry_type": "Receipt", "target_warehouse": warehouse, "items": [line]},
+            ],
+            chunk_size=2,
+        )
+
+        self.assertEqual(
+            [result["status"] for result in results],
+            ["Submitted", "Submitted", "Failed", "Failed", "Failed", "Failed", "Submitted"],
+        )
+        self.assertIn("Not enough stock", results[2]["error"])
+        self.assertIn("Missing", results[3]["error"])
+        self.assertIn("Quantity needs to be a positive number", results[4]["error"])
+        self.assertIn("Source Warehouse is mandatory", results[5]["error"])
+        self.assertEqual(frappe.db.get_value("Stock Entry", results[6]["name"], "docstatus"), 1)
+
+    def test_background_submission(self):
+        frappe.set_user("Administrator")
+        threshold = frappe.db.get_single_value("Stock Settings", "background_submit_threshold")
+        frappe.db.set_single_value("Stock Settings", "background_submit_threshold", 1)
+        self.addCleanup(
+            frappe.db.set_single_value,
+            "Stock Settings",
+            "background_submit_threshold",
+            threshold,
+        )
+
+        items = [
+            {"item": item["name"], "quantity": 1, "rate": 100}
+            for item in frappe.get_all("Item", fields=["name"], limit=2)
+        ]
+        doc = create_entry("Receipt", items, None, self.main_warehouse_name)
+        doc.reload()
+        self.assertEqual(doc.docstatus, 0)
+        self.assertEqual(doc.status, "Queued")
+
+        # Queued entries cannot be edited until the worker is done with them
+        with self.assertRaises(frappe.exceptions.ValidationError):
+            doc.save()
+
+        process_queued_submission(doc.name)
+        doc.reload()
+        self.assertEqual(doc.docstatus, 1)
+        self.assertEqual(doc.status, "Submitted")
+        self.assertEqual(
+            frappe.db.count("Stock Ledger Entry", {"source": doc.name}), len(items)
+        )
+
+    def test_cancel_reverses_posted_rows(self):
+        frappe.set_user("Administrator")
+        item = frappe.new_doc("Item", item_name=generate_random_string()).insert()
+        create_entry(
+            "Receipt",
+            [{"item": item.name, "quantity": 10, "rate": 100}],
+            None,
+            self.incoming_warehouse_name,
+        )
+        create_entry(
+            "Receipt",
+            [{"item": item.name, "quantity": 10, "rate": 200}],
+            None,
+            self.incoming_warehouse_name,
+        )
+        doc = create_entry(
+            "Transfer",
+            [{"item": item.name, "quantity": 5, "rate": 0}],
+            self.incoming_warehouse_name,
+            self.outgoing_warehouse_name,
+        )
+
+        # Changing the lines after posting does not change what gets reversed
+        frappe.db.set_value("Stock Entry Item", doc.items[0].name, "rate", 999)
+        doc.reload()
+        doc.cancel()
+
+        rows = frappe.get_all(
+            "Stock Ledger Entry",
+            filters={"source": doc.name},
+            fields=["warehouse", "quantity", "rate", "stock_value_difference"],
+        )
+        self.assertEqual(len(rows), 4)
+        for warehouse in (self.incoming_warehouse_name, self.outgoing_warehouse_name):
+            self.assertEqual(sum(r.quantity for r in rows if r.warehouse == warehouse), 0)
+            self.assertEqual(
+                sum(r.stock_value_difference for r in rows if r.warehouse == warehouse), 0
+            )
+        self.assertTrue(all(r.rate == 150 for r in rows))
+        self.assertEqual(
+            frappe.db.get_value(
+                "Bin",
+                {"item": item.name, "warehouse": self.incoming_warehouse_name},
+                ["actual_qty", "stock_value"],
+            ),
+            (20, 3000),
+        )
+
+    def test_transfer_keeps_value(self):
+        frappe.set_user("Administrator")
+        item = frappe.new_doc("Item", item_name=generate_random_string()).insert()
+        for quantity, rate in ((3, 100), (4, 101.5)):
+            create_entry(
+                "Receipt",
+                [{"item": item.name, "quantity": quantity, "rate": rate}],
+                None,
+                self.incoming_warehouse_name,
+            )
+        doc = create_entry(
+            "Transfer",
+            [{"item": item.name, "quantity": 5, "rate": 0}],
+            self.incoming_warehouse_name,
+            self.outgoing_warehouse_name,
+        )
+
+        # The valuation rate of 100.857... is not a whole number, none of it may get lost
+        rows = {
+            row.warehouse: row
+            for row in frappe.get_all(
+                "Stock Ledger Entry",
+                filters={"source": doc.name},
+                fields=["warehouse", "rate", "stock_value_difference"],
+            )
+        }
+        outgoing = rows[self.incoming_warehouse_name]
+        incoming = rows[self.outgoing_warehouse_name]
+        self.assertAlmostEqual(outgoing.stock_value_difference, -5 * 706 / 7)
+        self.assertAlmostEqual(incoming.stock_value_difference, -outgoing.stock_value_difference)
+        self.assertAlmostEqual(incoming.rate, 706 / 7)
+        self.assertAlmostEqual(
+            sum(frappe.get_all("Bin", filters={"item": item.name}, pluck="stock_value")), 706
+        )
+
+    def test_links_are_looked_up_once(self):
+        frappe.set_user("Administrator")
+        items = [
+            {"item": item["name"], "quantity": 1, "rate": 100}
+            for item in frappe.get_all("Item", fields=["name"], limit=20)
+        ]
+        doc = frappe.new_doc(
+            "Stock Entry",
+            entry_type="Receipt",
+            target_warehouse=self.main_warehouse_name,
+            items=items,
+        )
+        with track_queries(record=True) as stats:
+            doc.insert()
+        self.assertEqual(len([query for query in stats.queries if "`tabItem`" in query]), 1)
+        self.assertEqual(len([query for query in stats.queries if "`tabWarehouse`" in query]), 1)
+
+        doc = frappe.new_doc(
+            "Stock Entry",
+            entry_type="Receipt",
+            target_warehouse=self.main_warehouse_name,
+            items=[*items, {"item": "Missing Item", "quantity": 1, "rate": 100}],
+        )
+        with self.assertRaises(frappe.LinkValidationError) as error:
+            doc.insert()
+        self.assertIn(f"Row #{len(items) + 1}: Item: Missing Item", str(error.exception))
+
+    def test_query_count_is_constant(self):
+        frappe.set_user("Administrator")
+        items = [
+            frappe.new_doc("Item", item_name=generate_random_string()).insert()
+            for _ in range(max(QUERY_BUDGET_SIZES))
+        ]
+
+        def new_entry(size: int):
+            # A new warehouse every time, so that every run creates the same number of bins
+            warehouse = frappe.new_doc(
+                "Warehouse",
+                warehouse_name=generate_random_string(),
+                address=generate_random_string(),
+            ).insert()
+            return frappe.new_doc(
+                "Stock Entry",
+                entry_type="Receipt",
+                target_warehouse=warehouse.name,
+                items=[{"item": item.name, "quantity": 1, "rate": 100} for item in items[:size]],
+            ).insert()
+
+        # Frappe writes the lines of the entry itself a row at a time, everything else has to be
+        # done in a constant number of statements
+        submit_counts = get_query_counts(
+            lambda size: new_entry(size).submit, exclude=["Stock Entry Item"]
+        )
+        self.assertEqual(
+            len(set(submit_counts.values())), 1, f"Queries per number of lines: {submit_counts}"
+        )
+
+        cancel_counts = get_query_counts(
+            lambda size: new_entry(size).submit().cancel, exclude=["Stock Entry Item"]
+        )
+        self.assertEqual(
+            len(set(cancel_counts.values())), 1, f"Queries per number of lines: {cancel_counts}"
+        )
+
     def test_create_guest(self):
         frappe.set_user("Guest")
         with self.assertRaises(frappe.exceptions.PermissionError):
@@ -137,3 +383,19 @@ class TestStockEntry(FrappeTestCase):
     def test_read_guest(self):
         frappe.set_user("Guest")
         self.assertFalse(frappe.has_permission("Stock Entry"))
+
+
+# The workers commit, so the benchmark leaves its warehouse, items and entries behind
+@unittest.skipUnless(
+    os.environ.get("ACCOUNTING_CONCURRENCY_TESTS"), "Set ACCOUNTING_CONCURRENCY_TESTS to run"
+)
+class TestStockEntryConcurrency(FrappeTestCase):
+    def test_concurrent_consumption(self):
+        frappe.set_user("Administrator")
+        # 4 processes trying to consume 5 units each out of 12 in stock
+        results = concurrency.run(processes=4, entries=5, items=2, stock=12)
+
+        self.assertEqual(results["submitted"], 12)
+        for balance in results["balances"].values():
+            self.assertEqual(balance, 0)
+        self.assertGreater(results["entries_per_second"], 0)
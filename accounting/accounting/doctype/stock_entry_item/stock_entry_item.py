@@ -19,7 +19,7 @@ class StockEntryItem(Document):
         parentfield: DF.Data
         parenttype: DF.Data
         quantity: DF.Float
-        rate: DF.Int
+        rate: DF.Float
         source_warehouse: DF.Link | None
         target_warehouse: DF.Link | None
     # end: auto-generated types
@@ -0,0 +1,12 @@
+// Copyright (c) 2023, Akhil and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on("Stock Ledger Archive", {
+	refresh(frm) {
+		if (frm.doc.status === "Failed") {
+			frm.add_custom_button("Retry", () => {
+				frm.call("retry").then(() => frm.reload_doc());
+			});
+		}
+	},
+});
@@ -0,0 +1,291 @@
+# Copyright (c) 2023, Akhil and contributors
+# For license information, please see license.txt
+from datetime import datetime
+
+import frappe
+from accounting.accounting.doctype.bin.bin import get_bins_for_update, get_valuation_rate
+from frappe.model.document import Document
+from frappe.query_builder import Case, DocType, Tuple, functions
+from frappe.utils import cint, flt, get_datetime
+
+# Columns moved to the archive along with every ledger row
+ARCHIVE_FIELDS = (
+	"name",
+	"creation",
+	"modified",
+	"owner",
+	"modified_by",
+	"item",
+	"warehouse",
+	"entry_time",
+	"quantity",
+	"rate",
+	"qty_after_transaction",
+	"valuation_rate",
+	"stock_value",
+	"stock_value_difference",
+	"type",
+	"source",
+)
+
+# Columns of the ledger when read together with the archive
+LEDGER_COLUMNS = (
+	"name",
+	"creation",
+	"item",
+	"warehouse",
+	"entry_time",
+	"quantity",
+	"rate",
+	"qty_after_transaction",
+	"valuation_rate",
+	"stock_value",
+	"stock_value_difference",
+	"type",
+	"source",
+)
+
+
+class StockLedgerArchive(Document):
+	# begin: auto-generated types
+	# This code is auto-generated. Do not modify anything in this block.
+
+	from typing import TYPE_CHECKING
+
+	if TYPE_CHECKING:
+		from frappe.types import DF
+
+		archived_entries: DF.Int
+		cutoff: DF.Datetime
+		error: DF.LongText | None
+		status: DF.Literal['Queued', 'In Progress', 'Completed', 'Failed']
+	# end: auto-generated types
+	def validate(self):
+		cutoff = get_datetime(self.cutoff)
+		if cutoff > frappe.utils.now_datetime():
+			frappe.throw("Cutoff cannot be in the future")
+
+		if self.is_new():
+			# A failed archive is retried, or superseded by a new one with the same cutoff
+			latest = get_archive_cutoff(include_queued=True, include_failed=False)
+			if latest and cutoff <= latest:
+				frappe.throw(f"The Stock Ledger is already archived until {latest}")
+
+			# Reposting rewrites the running balances of the rows after its from time, which must
+			# still be in the ledger by then
+			if frappe.db.exists(
+				"Stock Repost Entry",
+				{"status": ["!=", "Completed"], "from_time": ["<", cutoff]},
+			):
+				frappe.throw("Stock Repost Entries before the cutoff have to be completed first")
+
+	def after_insert(self):
+		self.enqueue_archive()
+
+	def enqueue_archive(self):
+		frappe.enqueue(
+			process_archive,
+			queue="long",
+			timeout=3600,
+			job_id=f"stock_ledger_archive::{self.name}",
+			deduplicate=True,
+			enqueue_after_commit=True,
+			name=self.name,
+		)
+
+	def archive_chunk(self, pairs: list[tuple[str, str]]) -> int:
+		"""
+		Function to move the ledger rows of some (item, warehouse) pairs posted before the cutoff to
+		the archive, leaving one carry-forward row per pair in their place
+
+		The carry-forward row is dated at the last archived row of its pair and holds the sum of
+		the rows it replaces, so sums over the ledger and balances after the cutoff stay exact.
+		Carry-forward rows of earlier archives are folded into the new one. The bins are locked
+		while the rows are moved, so that nothing is posted or reposted to the pairs meanwhile.
+
+		:param pairs: (item, warehouse) pairs to archive
+		:return: Number of ledger rows archived
+		"""
+		cutoff = get_datetime(self.cutoff)
+		get_bins_for_update(pairs)
+
+		stock_ledger_entry = DocType("Stock Ledger Entry")
+		before_cutoff = Tuple(stock_ledger_entry.item, stock_ledger_entry.warehouse).isin(pairs) & (
+			stock_ledger_entry.entry_time < cutoff
+		)
+		archived_rows = functions.Count(Case().when(stock_ledger_entry.is_carry_forward == 0, 1))
+		balances = (
+			frappe.qb.from_(stock_ledger_entry)
+			.select(
+				stock_ledger_entry.item,
+				stock_ledger_entry.warehouse,
+				functions.Max(stock_ledger_entry.entry_time),
+				functions.Sum(stock_ledger_entry.quantity),
+				functions.Sum(stock_ledger_entry.stock_value_difference),
+				archived_rows,
+			)
+			.where(before_cutoff)
+			.groupby(stock_ledger_entry.item, stock_ledger_entry.warehouse)
+			# Pairs left with nothing but the carry-forward row of an earlier archive stay as they are
+			.having(archived_rows > 0)
+			.run()
+		)
+		if not balances:
+			return 0
+
+		archived = Tuple(stock_ledger_entry.item, stock_ledger_entry.warehouse).isin(
+			[(item, warehouse) for item, warehouse, *_ in balances]
+		) & (stock_ledger_entry.entry_time < cutoff)
+		archive = DocType("Archived Stock Ledger Entry")
+		(
+			frappe.qb.into(archive)
+			.columns(*ARCHIVE_FIELDS)
+			.from_(stock_ledger_entry)
+			.select(*(stock_ledger_entry.field(fieldname) for fieldname in ARCHIVE_FIELDS))
+			.where(archived & (stock_ledger_entry.is_carry_forward == 0))
+			.run()
+		)
+		frappe.qb.from_(stock_ledger_entry).delete().where(archived).run()
+
+		# The running balance of a pair starts from zero, so it is the sum of every row up to then
+		now = frappe.utils.now_datetime()
+		user = frappe.session.user
+		frappe.db.bulk_insert(
+			"Stock Ledger Entry",
+			[*ARCHIVE_FIELDS, "is_carry_forward"],
+			[
+				(
+					frappe.generate_hash(length=10),
+					now,
+					now,
+					user,
+					user,
+					item,
+					warehouse,
+					entry_time,
+					flt(quantity),
+					0,
+					flt(quantity),
+					get_valuation_rate(flt(quantity), flt(stock_value)),
+					flt(stock_value),
+					flt(stock_value),
+					self.doctype,
+					self.name,
+					1,
+				)
+				for item, warehouse, entry_time, quantity, stock_value, _ in balances
+			],
+		)
+		return sum(count for *_, count in balances)
+
+	@frappe.whitelist()
+	def retry(self):
+		"""
+		Endpoint to queue a failed archive again, the pairs it already archived are skipped
+		"""
+		self.check_permission("write")
+		if self.status != "Failed":
+			frappe.throw("Only failed archives can be retried")
+
+		self.db_set({"status": "Queued", "error": None})
+		self.enqueue_archive()
+
+	def archive(self):
+		chunk_size = cint(frappe.db.get_single_value("Stock Settings", "archive_chunk_size")) or 1000
+		self.db_set("status", "In Progress", commit=True)
+		try:
+			pairs = frappe.get_all(
+				"Bin", fields=["item", "warehouse"], order_by="item asc, warehouse asc", as_list=True
+			)
+			# Every chunk is committed on its own, archiving again picks up the pairs that are left
+			for chunk_start in range(0, len(pairs), chunk_size):
+				archived = self.archive_chunk(
+					[tuple(pair) for pair in pairs[chunk_start : chunk_start + chunk_size]]
+				)
+				self.db_set("archived_entries", cint(self.archived_entries) + archived, commit=True)
+			self.db_set("status", "Completed", commit=True)
+		except Exception:
+			frappe.db.rollback()
+			self.db_set({"status": "Failed", "error": frappe.get_traceback()}, commit=True)
+			self.log_error(f"Archiving the Stock Ledger until {self.cutoff} failed")
+
+
+def process_archive(name: str):
+	"""
+	Background job archiving the ledger for a Stock Ledger Archive
+
+	:param name: Name of the Stock Ledger Archive
+	"""
+	frappe.get_doc("Stock Ledger Archive", name).archive()
+
+
+def get_archive_cutoff(
+	include_queued: bool = False, include_failed: bool = True
+) -> datetime | None:
+	"""
+	Function to fetch the point in time the ledger is archived until
+
+	Archives that are in progress or failed count as well, part of their rows may be moved already.
+
+	:param include_queued: Whether to count archives that have not started yet as well
+	:param include_failed: Whether to count failed archives, which are left to be retried
+	:return: Latest cutoff, None if nothing is archived
+	"""
+	excluded = [
+		status
+		for status, included in (("Queued", include_queued), ("Failed", include_failed))
+		if not included
+	]
+	filters = {"status": ["not in", excluded]} if excluded else {}
+	cutoffs = frappe.get_all(
+		"Stock Ledger Archive",
+		filters=filters,
+		order_by="cutoff desc",
+		pluck="cutoff",
+		limit=1,
+	)
+	return get_datetime(cutoffs[0]) if cutoffs else None
+
+
+def get_ledger_table(from_date: datetime | None, cutoff: datetime | None):
+	"""
+	Function to pick what to read the ledger from, for a window starting at from_date
+
+	Windows starting at or after the cutoff read the live table alone, where the carry-forward rows
+	hold the balance of the archived rows before the window. Windows reaching back into archived
+	periods read the archived rows along with the live ones, without the carry-forward rows.
+
+	:param from_date: Start of the window, None when it reaches back to the first row
+	:param cutoff: Point in time the ledger is archived until, as returned by get_archive_cutoff
+	:return: Stock Ledger Entry table, or a derived table with the LEDGER_COLUMNS of both tables
+	"""
+	stock_ledger_entry = DocType("Stock Ledger Entry")
+	if not cutoff or (from_date and from_date >= cutoff):
+		return stock_ledger_entry
+
+	archive = DocType("Archived Stock Ledger Entry")
+	return (
+		frappe.qb.from_(stock_ledger_entry)
+		.select(*(stock_ledger_entry.field(fieldname) for fieldname in LEDGER_COLUMNS))
+		.where(stock_ledger_entry.is_carry_forward == 0)
+		.union_all(
+			frappe.qb.from_(archive).select(
+				*(archive.field(fieldname) for fieldname in LEDGER_COLUMNS)
+			)
+		)
+	).as_("full_ledger")
+
+
+def archive_ledger():
+	"""
+	Function to archive the ledger rows older than configured in Stock Settings, run by the scheduler
+	"""
+	days = cint(frappe.db.get_single_value("Stock Settings", "archive_after_days"))
+	if not days:
+		return
+
+	cutoff = get_datetime(frappe.utils.add_days(frappe.utils.nowdate(), -days))
+	latest = get_archive_cutoff(include_queued=True, include_failed=False)
+	if latest and cutoff <= latest:
+		return
+	frappe.new_doc("Stock Ledger Archive", cutoff=cutoff).insert()
@@ -0,0 +1,121 @@
+# Copyright (c) 2023, Akhil and Contributors
+# See license.txt
+
+from datetime import timedelta
+
+import frappe
+from accounting.accounting.doctype.item.test_item import create_random_item
+from accounting.accounting.doctype.stock_ledger_entry.stock_ledger_entry import (
+	get_stock_balance,
+)
+from accounting.accounting.doctype.warehouse.test_warehouse import create_random_warehouse
+from accounting.accounting.report.stock_balance import stock_balance
+from accounting.accounting.report.stock_ledger import stock_ledger
+from frappe.tests.utils import FrappeTestCase
+
+
+class TestStockLedgerArchive(FrappeTestCase):
+	def setUp(self):
+		frappe.set_user("Administrator")
+		self.item = create_random_item()
+		self.warehouse = create_random_warehouse()
+		self.now = frappe.utils.now_datetime()
+
+	def post(self, entry_type: str, quantity: int, days_ago: int):
+		warehouse = "target_warehouse" if entry_type == "Receipt" else "source_warehouse"
+		return (
+			frappe.new_doc(
+				"Stock Entry",
+				entry_type=entry_type,
+				posting_time=self.now - timedelta(days=days_ago),
+				items=[{"item": self.item.name, "quantity": quantity, "rate": 100}],
+				**{warehouse: self.warehouse.name},
+			)
+			.insert()
+			.submit()
+		)
+
+	def archive(self, days_ago: int):
+		# Archived in this transaction rather than by the background job, which commits
+		archive = frappe.new_doc(
+			"Stock Ledger Archive", cutoff=self.now - timedelta(days=days_ago)
+		).insert()
+		archive.db_set("status", "In Progress")
+		return archive.archive_chunk([(self.item.name, self.warehouse.name)])
+
+	def get_balances(self, days_ago: int) -> list[dict]:
+		return stock_balance.execute(
+			{
+				"item": self.item.name,
+				"from_date": self.now - timedelta(days=days_ago),
+				"to_date": self.now + timedelta(days=1),
+			}
+		)[1]
+
+	def test_archive_keeps_balances(self):
+		self.post("Receipt", 10, days_ago=10)
+		self.post("Consume", 4, days_ago=9)
+		self.post("Receipt", 5, days_ago=2)
+
+		balances = {days_ago: self.get_balances(days_ago) for days_ago in (20, 9, 5)}
+		ledger = stock_ledger.execute({"item": self.item.name})[1]
+
+		self.assertEqual(self.archive(7), 2)
+		rows = frappe.get_all(
+			"Stock Ledger Entry",
+			filters={"item": self.item.name},
+			fields=["quantity", "qty_after_transaction", "is_carry_forward"],
+			order_by="entry_time asc",
+		)
+		self.assertEqual(
+			[(row.quantity, row.qty_after_transaction, row.is_carry_forward) for row in rows],
+			[(6, 6, 1), (5, 11, 0)],
+		)
+		self.assertEqual(frappe.db.count("Archived Stock Ledger Entry", {"item": self.item.name}), 2)
+
+		# Windows before the cutoff read the archive, later ones the carry-forward rows
+		for days_ago, expected in balances.items():
+			self.assertEqual(self.get_balances(days_ago), expected)
+		self.assertEqual(stock_ledger.execute({"item": self.item.name})[1], ledger)
+		self.assertEqual(
+			get_stock_balance(self.item.name, self.warehouse.name, self.now - timedelta(days=9.5))[
+				"actual_qty"
+			],
+			10,
+		)
+
+		with self.assertRaises(frappe.ValidationError):
+			self.post("Receipt", 1, days_ago=8)
+
+	def test_retry_failed_archive(self):
+		other_warehouse = create_random_warehouse()
+		self.post("Receipt", 10, days_ago=10)
+		frappe.new_doc(
+			"Stock Entry",
+			entry_type="Receipt",
+			posting_time=self.now - timedelta(days=10),
+			items=[{"item": self.item.name, "quantity": 3, "rate": 100}],
+			target_warehouse=other_warehouse.name,
+		).insert().submit()
+		pairs = [(self.item.name, self.warehouse.name), (self.item.name, other_warehouse.name)]
+
+		# Failed after the first pair was archived
+		archive = frappe.new_doc("Stock Ledger Archive", cutoff=self.now - timedelta(days=7)).insert()
+		archive.db_set("status", "In Progress")
+		self.assertEqual(archive.archive_chunk(pairs[:1]), 1)
+		archive.db_set("status", "Failed")
+
+		# Its rows stay out of reach, while the cutoff can be archived again
+		with self.assertRaises(frappe.ValidationError):
+			self.post("Receipt", 1, days_ago=8)
+		frappe.new_doc("Stock Ledger Archive", cutoff=archive.cutoff).insert().delete()
+
+		archive.retry()
+		self.assertEqual(archive.status, "Queued")
+		archive.db_set("status", "In Progress")
+		self.assertEqual(archive.archive_chunk(pairs), 1)
+		self.assertEqual(frappe.db.count("Archived Stock Ledger Entry", {"item": self.item.name}), 2)
+		self.assertEqual(
+			frappe.db.count("Stock Ledger Entry", {"item": self.item.name, "is_carry_forward": 1}),
+			2,
+		)
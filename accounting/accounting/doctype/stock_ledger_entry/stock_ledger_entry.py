@@ -1,8 +1,18 @@
 # Copyright (c) 2023, Akhil and contributors
 # For license information, please see license.txt
 
-# import frappe
+from datetime import datetime
+from functools import reduce
+from typing import Iterable
+
+import frappe
+from accounting.accounting.doctype.bin.bin import get_cached_bin_balances
+from accounting.accounting.doctype.stock_ledger_archive.stock_ledger_archive import (
+	get_archive_cutoff,
+)
 from frappe.model.document import Document
+from frappe.query_builder import DocType, Order
+from frappe.utils import flt, get_datetime
 
 
 class StockLedgerEntry(Document):
@@ -15,11 +25,132 @@ class StockLedgerEntry(Document):
 		from frappe.types import DF
 
 		entry_time: DF.Datetime
+		is_carry_forward: DF.Check
+		is_reversal: DF.Check
+		is_transfer_in: DF.Check
 		item: DF.Link
+		qty_after_transaction: DF.Float
 		quantity: DF.Float
-		rate: DF.Int
+		rate: DF.Float
 		source: DF.DynamicLink
+		stock_value: DF.Float
+		stock_value_difference: DF.Float
 		type: DF.Link
+		valuation_rate: DF.Float
 		warehouse: DF.Link
 	# end: auto-generated types
 	pass
+
+
+def on_doctype_update():
+	frappe.db.add_index("Stock Ledger Entry", ["item", "warehouse", "entry_time"])
+
+
+def get_latest_entry_query(
+	item: str, warehouse: str, at: datetime, doctype: str = "Stock Ledger Entry"
+):
+	# The last row at or before the given time holds the running balance as of then. With the
+	# (item, warehouse, entry_time) index this is a single seek, however long the ledger is.
+	stock_ledger_entry = DocType(doctype)
+	return (
+		frappe.qb.from_(stock_ledger_entry)
+		.select(
+			stock_ledger_entry.item,
+			stock_ledger_entry.warehouse,
+			stock_ledger_entry.entry_time,
+			stock_ledger_entry.creation,
+			stock_ledger_entry.qty_after_transaction,
+			stock_ledger_entry.valuation_rate,
+			stock_ledger_entry.stock_value,
+		)
+		.where(stock_ledger_entry.item == item)
+		.where(stock_ledger_entry.warehouse == warehouse)
+		.where(stock_ledger_entry.entry_time <= at)
+		.orderby(stock_ledger_entry.entry_time, order=Order.desc)
+		.orderby(stock_ledger_entry.creation, order=Order.desc)
+		.limit(1)
+	)
+
+
+def get_stock_balances(
+	pairs: Iterable[tuple[str, str]], at: datetime | None = None
+) -> dict[tuple[str, str], frappe._dict]:
+	"""
+	Function to fetch the balance of many (item, warehouse) pairs at a point in time, in one query
+
+	:param pairs: (item, warehouse) pairs to fetch
+	:param at: Point in time, the current balance when not set
+	:return: Mapping of (item, warehouse) to its actual_qty, valuation_rate and stock_value
+	"""
+	pairs = list(dict.fromkeys((item, warehouse) for item, warehouse in pairs))
+	balances = {
+		(item, warehouse): frappe._dict(
+			item=item, warehouse=warehouse, actual_qty=0, valuation_rate=0, stock_value=0
+		)
+		for item, warehouse in pairs
+	}
+	if not pairs:
+		return balances
+
+	if at is None:
+		# The bins already hold the current balance
+		for pair, row in get_cached_bin_balances(pairs).items():
+			balances[pair].update(
+				actual_qty=flt(row.actual_qty),
+				valuation_rate=flt(row.valuation_rate),
+				stock_value=flt(row.actual_qty) * flt(row.valuation_rate),
+			)
+		return balances
+
+	# One seek per pair, sent together as a single UNION ALL. Before the archive cutoff the rows
+	# may have been moved to the archive, which is sought as well and the latest row of the two wins.
+	seeks = [get_latest_entry_query(*pair, at) for pair in pairs]
+	if (cutoff := get_archive_cutoff()) and at < cutoff:
+		seeks.extend(
+			get_latest_entry_query(*pair, at, "Archived Stock Ledger Entry") for pair in pairs
+		)
+	query = reduce(lambda union, seek: union.union_all(seek), seeks[1:], seeks[0])
+
+	latest: dict[tuple[str, str], tuple] = {}
+	for row in query.run(as_dict=True):
+		pair = (row.item, row.warehouse)
+		if pair in latest and latest[pair] >= (row.entry_time, row.creation):
+			continue
+		latest[pair] = (row.entry_time, row.creation)
+		balances[pair].update(
+			actual_qty=flt(row.qty_after_transaction),
+			valuation_rate=flt(row.valuation_rate),
+			stock_value=flt(row.stock_value),
+		)
+	return balances
+
+
+@frappe.whitelist()
+def get_stock_balance(item: str, warehouse: str, at: str | datetime | None = None) -> dict:
+	"""
+	Endpoint to fetch the balance of an item in a warehouse at a point in time
+
+	:param item: Item
+	:param warehouse: Warehouse
+	:param at: Point in time, the current balance when not set
+	:return: actual_qty, valuation_rate and stock_value
+	"""
+	frappe.has_permission("Stock Ledger Entry", "read", throw=True)
+	return get_stock_balances([(item, warehouse)], get_datetime(at) if at else None)[
+		(item, warehouse)
+	]
+
+
+@frappe.whitelist()
+def get_stock_balance_batch(pairs: str | list, at: str | datetime | None = None) -> list[dict]:
+	"""
+	Endpoint to fetch the balance of many (item, warehouse) pairs at a point in time
+
+	:param pairs: [item, warehouse] pairs, as a list or a JSON string
+	:param at: Point in time, the current balance when not set
+	:return: item, warehouse, actual_qty, valuation_rate and stock_value of every pair, in order
+	"""
+	frappe.has_permission("Stock Ledger Entry", "read", throw=True)
+	pairs = [(item, warehouse) for item, warehouse in frappe.parse_json(pairs)]
+	balances = get_stock_balances(pairs, get_datetime(at) if at else None)
+	return [balances[pair] for pair in pairs]
@@ -3,6 +3,7 @@
 
 import frappe
 from frappe.tests.utils import FrappeTestCase
+from .stock_ledger_entry import get_stock_balance, get_stock_balance_batch
 from ..item.test_item import create_random_item
 from ..stock_entry.test_stock_entry import create_entry as create_stock_entry
 from ..warehouse.test_warehouse import create_random_warehouse
@@ -95,3 +96,124 @@ class TestStockLedgerEntry(FrappeTestCase):
         self.assertEqual(doc[0].quantity, quantity)
         self.assertEqual(doc[1].quantity, -quantity)
         self.assertEqual(sum([d.quantity for d in doc]), 0)
+
+    def test_hot_queries_use_indexes(self):
+        frappe.set_user("Administrator")
+        item = create_random_item()
+        warehouse = create_random_warehouse()
+        create_stock_entry(
+            entry_type="Receipt",
+            items=[{"item": item.name, "quantity": 10, "rate": 100}],
+            source_warehouse=None,
+            target_warehouse=warehouse.name,
+        )
+        now = frappe.utils.now_datetime()
+
+        # Balance of a single (item, warehouse) pair up to a point in time
+        plan = frappe.db.sql(
+            """EXPLAIN SELECT sum(quantity) FROM `tabStock Ledger Entry`
+            WHERE item = %s AND warehouse = %s AND entry_time <= %s""",
+            (item.name, warehouse.name, now),
+            as_dict=True,
+        )
+        self.assertEqual(plan[0].key, "item_warehouse_entry_time_index")
+
+        # Ledger rows within a window
+        plan = frappe.db.sql(
+            """EXPLAIN SELECT name FROM `tabStock Ledger Entry`
+            WHERE entry_time BETWEEN %s AND %s""",
+            (now, now),
+            as_dict=True,
+        )
+        self.assertIn("entry_time", plan[0].possible_keys.split(","))
+
+    def test_running_valuation(self):
+        frappe.set_user("Administrator")
+        item = create_random_item()
+        warehouse_1 = create_random_warehouse()
+        warehouse_2 = create_random_warehouse()
+        for rate in (100, 200):
+            create_stock_entry(
+                entry_type="Receipt",
+                items=[{"item": item.name, "quantity": 10, "rate": rate}],
+                source_warehouse=None,
+                target_warehouse=warehouse_1.name,
+            )
+        create_stock_entry(
+            entry_type="Consume",
+            items=[{"item": item.name, "quantity": 5, "rate": 1}],
+            source_warehouse=warehouse_1.name,
+            target_warehouse=None,
+        )
+
+        rows = frappe.db.get_all(
+            "Stock Ledger Entry",
+            {"item": item.name, "warehouse": warehouse_1.name},
+            ["qty_after_transaction", "valuation_rate", "stock_value", "stock_value_difference"],
+            order_by="creation asc",
+        )
+        self.assertEqual([row.qty_after_transaction for row in rows], [10, 20, 15])
+        self.assertEqual([row.valuation_rate for row in rows], [100, 150, 150])
+        self.assertEqual([row.stock_value for row in rows], [1000, 3000, 2250])
+        # Outgoing stock is valued at the moving average, not at the rate on the entry
+        self.assertEqual(rows[-1].stock_value_difference, -750)
+
+        # Transfers move stock at the valuation rate of the source warehouse
+        create_stock_entry(
+            entry_type="Transfer",
+            items=[{"item": item.name, "quantity": 5, "rate": 1}],
+            source_warehouse=warehouse_1.name,
+            target_warehouse=warehouse_2.name,
+        )
+        row = frappe.db.get_value(
+            "Stock Ledger Entry",
+            {"item": item.name, "warehouse": warehouse_2.name},
+            ["rate", "valuation_rate", "stock_value"],
+            as_dict=True,
+        )
+        self.assertEqual(row.rate, 150)
+        self.assertEqual(row.valuation_rate, 150)
+        self.assertEqual(row.stock_value, 750)
+
+    def test_stock_balance_at(self):
+        frappe.set_user("Administrator")
+        item = create_random_item()
+        warehouse_1 = create_random_warehouse()
+        warehouse_2 = create_random_warehouse()
+        create_stock_entry(
+            entry_type="Receipt",
+            items=[{"item": item.name, "quantity": 10, "rate": 100}],
+            source_warehouse=None,
+            target_warehouse=warehouse_1.name,
+        )
+        before_transfer = frappe.utils.now_datetime()
+        frappe.db.set_value(
+            "Stock Ledger Entry",
+            {"item": item.name},
+            "entry_time",
+            frappe.utils.add_to_date(before_transfer, seconds=-1),
+        )
+        create_stock_entry(
+            entry_type="Transfer",
+            items=[{"item": item.name, "quantity": 4, "rate": 1}],
+            source_warehouse=warehouse_1.name,
+            target_warehouse=warehouse_2.name,
+        )
+
+        balance = get_stock_balance(item.name, warehouse_1.name, before_transfer)
+        self.assertEqual(balance.actual_qty, 10)
+        self.assertEqual(balance.stock_value, 1000)
+        self.assertEqual(get_stock_balance(item.name, warehouse_1.name).actual_qty, 6)
+
+        balances = get_stock_balance_batch(
+            [[item.name, warehouse_1.name], [item.name, warehouse_2.name]],
+            frappe.utils.now_datetime(),
+        )
+        self.assertEqual([b.actual_qty for b in balances], [6, 4])
+        self.assertEqual(balances[1].valuation_rate, 100)
+
+        # Nothing was in the second warehouse before the transfer
+        balances = get_stock_balance_batch(
+            [[item.name, warehouse_2.name]], before_transfer
+        )
+        self.assertEqual(balances[0].actual_qty, 0)
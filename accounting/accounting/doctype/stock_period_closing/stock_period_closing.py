@@ -0,0 +1,142 @@
+# Copyright (c) 2023, Akhil and contributors
+# For license information, please see license.txt
+from datetime import datetime
+
+import frappe
+from accounting.accounting.doctype.stock_ledger_archive.stock_ledger_archive import (
+	get_archive_cutoff,
+)
+from frappe.model.document import Document
+from frappe.query_builder import DocType, functions
+from frappe.utils import flt, get_datetime
+
+
+class StockPeriodClosing(Document):
+	# begin: auto-generated types
+	# This code is auto-generated. Do not modify anything in this block.
+
+	from typing import TYPE_CHECKING
+
+	if TYPE_CHECKING:
+		from frappe.types import DF
+
+		amended_from: DF.Link | None
+		closing_time: DF.Datetime
+	# end: auto-generated types
+	def validate(self):
+		if get_datetime(self.closing_time) > frappe.utils.now_datetime():
+			frappe.throw("Closing Time cannot be in the future")
+
+		# The rows before the cutoff are replaced by carry-forward rows dated at the last of them
+		if (cutoff := get_archive_cutoff(include_queued=True)) and get_datetime(
+			self.closing_time
+		) < cutoff:
+			frappe.throw(f"Closing Time cannot be before the archive cutoff {cutoff}")
+
+	def on_submit(self):
+		# The balances are carried forward from the previous closing, so only the ledger rows posted
+		# since then are read
+		balances: dict[tuple[str, str], list[float]] = {}
+		stock_ledger_entry = DocType("Stock Ledger Entry")
+		query = (
+			frappe.qb.from_(stock_ledger_entry)
+			.select(
+				stock_ledger_entry.item,
+				stock_ledger_entry.warehouse,
+				functions.Sum(stock_ledger_entry.quantity),
+				functions.Sum(stock_ledger_entry.stock_value_difference),
+			)
+			.where(stock_ledger_entry.entry_time < self.closing_time)
+			.groupby(stock_ledger_entry.item, stock_ledger_entry.warehouse)
+		)
+
+		# Carry-forward rows hold the balance since the very first row, so a snapshot taken before
+		# the archive cutoff cannot be added to them
+		previous = get_latest_closing(self.closing_time, exclude=self.name)
+		cutoff = get_archive_cutoff()
+		if previous and cutoff and get_datetime(previous.closing_time) < cutoff:
+			previous = None
+
+		if previous:
+			query = query.where(stock_ledger_entry.entry_time >= previous.closing_time)
+			for item, warehouse, quantity, stock_value in frappe.get_all(
+				"Stock Closing Balance",
+				filters={"period_closing": previous.name},
+				fields=["item", "warehouse", "quantity", "stock_value"],
+				as_list=True,
+			):
+				balances[(item, warehouse)] = [quantity, stock_value]
+
+		for item, warehouse, quantity, stock_value in query.run():
+			balance = balances.setdefault((item, warehouse), [0.0, 0.0])
+			balance[0] += flt(quantity)
+			balance[1] += flt(stock_value)
+
+		now = frappe.utils.now_datetime()
+		user = frappe.session.user
+		frappe.db.bulk_insert(
+			"Stock Closing Balance",
+			[
+				"name",
+				"creation",
+				"modified",
+				"owner",
+				"modified_by",
+				"period_closing",
+				"closing_time",
+				"item",
+				"warehouse",
+				"quantity",
+				"stock_value",
+			],
+			[
+				(
+					frappe.generate_hash(length=10),
+					now,
+					now,
+					user,
+					user,
+					self.name,
+					self.closing_time,
+					item,
+					warehouse,
+					quantity,
+					stock_value,
+				)
+				for (item, warehouse), (quantity, stock_value) in balances.items()
+			],
+		)
+
+	def on_cancel(self):
+		frappe.db.delete("Stock Closing Balance", {"period_closing": self.name})
+
+
+def get_latest_closing(before: datetime, exclude: str | None = None) -> frappe._dict | None:
+	"""
+	Function to fetch the latest submitted period closing at or before a point in time
+
+	:param before: Point in time the closing must not be after
+	:param exclude: Name of a period closing to ignore
+	:return: Name and closing time of the period closing, None if there is none
+	"""
+	filters = {"docstatus": 1, "closing_time": ["<=", before]}
+	if exclude:
+		filters["name"] = ["!=", exclude]
+
+	closings = frappe.get_all(
+		"Stock Period Closing",
+		filters=filters,
+		fields=["name", "closing_time"],
+		order_by="closing_time desc",
+		limit=1,
+	)
+	return closings[0] if closings else None
+
+
+def close_previous_month():
+	"""
+	Function to snapshot the balances at the start of the current month, run by the scheduler
+	"""
+	closing_time = get_datetime(frappe.utils.get_first_day(frappe.utils.nowdate()))
+	if not frappe.db.exists("Stock Period Closing", {"docstatus": 1, "closing_time": closing_time}):
+		frappe.new_doc("Stock Period Closing", closing_time=closing_time).insert().submit()
@@ -0,0 +1,84 @@
+# Copyright (c) 2023, Akhil and Contributors
+# See license.txt
+
+from datetime import timedelta
+
+import frappe
+from accounting.accounting.doctype.item.test_item import create_random_item
+from accounting.accounting.doctype.stock_entry.test_stock_entry import create_entry
+from accounting.accounting.doctype.warehouse.test_warehouse import create_random_warehouse
+from accounting.accounting.report.stock_balance.stock_balance import execute
+from frappe.tests.utils import FrappeTestCase
+
+
+def create_period_closing(closing_time=None):
+	return (
+		frappe.new_doc(
+			"Stock Period Closing", closing_time=closing_time or frappe.utils.now_datetime()
+		)
+		.insert()
+		.submit()
+	)
+
+
+class TestStockPeriodClosing(FrappeTestCase):
+	def setUp(self):
+		frappe.set_user("Administrator")
+		self.item = create_random_item()
+		self.warehouse = create_random_warehouse()
+
+	def receive(self, quantity: int):
+		create_entry(
+			"Receipt",
+			[{"item": self.item.name, "quantity": quantity, "rate": 100}],
+			target_warehouse=self.warehouse.name,
+		)
+
+	def get_closing_balance(self, closing):
+		return frappe.db.get_value(
+			"Stock Closing Balance",
+			{"period_closing": closing.name, "item": self.item.name},
+			["quantity", "stock_value"],
+			as_dict=True,
+		)
+
+	def test_closing_carries_forward(self):
+		self.receive(10)
+		first = create_period_closing()
+		self.assertEqual(self.get_closing_balance(first).quantity, 10)
+
+		self.receive(5)
+		second = create_period_closing()
+		self.assertEqual(self.get_closing_balance(second).quantity, 15)
+		self.assertEqual(self.get_closing_balance(second).stock_value, 1500)
+
+		second.cancel()
+		self.assertIsNone(self.get_closing_balance(second))
+
+	def test_future_closing(self):
+		with self.assertRaises(frappe.exceptions.ValidationError):
+			create_period_closing(frappe.utils.now_datetime() + timedelta(days=1))
+
+	def test_report_opening_uses_snapshot(self):
+		self.receive(10)
+		closing = create_period_closing()
+
+		# Tamper with the snapshot to prove that the report reads it instead of the older ledger rows
+		frappe.db.set_value(
+			"Stock Closing Balance",
+			{"period_closing": closing.name, "item": self.item.name},
+			"quantity",
+			100,
+		)
+		self.receive(5)
+
+		_, data = execute(
+			{
+				"item": self.item.name,
+				"from_date": closing.closing_time,
+				"to_date": frappe.utils.now_datetime() + timedelta(days=1),
+			}
+		)
+		self.assertEqual(data[0]["opening_stock"], 100)
+		self.assertEqual(data[0]["incoming_stock"], 5)
+		self.assertEqual(data[0]["closing_stock"], 105)
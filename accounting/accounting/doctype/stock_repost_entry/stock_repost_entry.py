@@ -0,0 +1,311 @@
+# Copyright (c) 2023, Akhil and contributors
+# For license information, please see license.txt
+from datetime import datetime, timedelta
+from functools import partial
+
+import frappe
+from accounting.accounting.doctype.bin.bin import (
+	get_bins_for_update,
+	get_stock_value_difference,
+	get_valuation_rate,
+	invalidate_cached_balances,
+	record_ledger_changes,
+)
+from accounting.accounting.doctype.stock_ledger_entry.stock_ledger_entry import (
+	get_stock_balances,
+)
+from frappe.model.document import Document
+from frappe.query_builder import DocType, Tuple
+from frappe.utils import cint, flt, get_datetime
+
+
+class StockRepostEntry(Document):
+	# begin: auto-generated types
+	# This code is auto-generated. Do not modify anything in this block.
+
+	from typing import TYPE_CHECKING
+
+	if TYPE_CHECKING:
+		from frappe.types import DF
+
+		error: DF.LongText | None
+		from_time: DF.Datetime
+		item: DF.Link
+		last_entry: DF.Link | None
+		status: DF.Literal['Queued', 'In Progress', 'Completed', 'Failed']
+		voucher_no: DF.DynamicLink | None
+		voucher_type: DF.Link | None
+		warehouse: DF.Link
+	# end: auto-generated types
+	def repost_chunk(self, chunk_size: int) -> bool:
+		"""
+		Function to recompute the running balance of the next chunk of ledger rows
+
+		The bin is locked while the chunk is reposted, so that nothing is posted to the pair in the
+		meantime. It is set to the final balance along with the last chunk.
+
+		:param chunk_size: Number of ledger rows to repost
+		:return: Whether every ledger row has been reposted
+		"""
+		pair = (self.item, self.warehouse)
+		bin = get_bins_for_update([pair])[pair]
+
+		stock_ledger_entry = DocType("Stock Ledger Entry")
+		query = (
+			frappe.qb.from_(stock_ledger_entry)
+			.select(
+				stock_ledger_entry.name,
+				stock_ledger_entry.creation,
+				stock_ledger_entry.quantity,
+				stock_ledger_entry.rate,
+				stock_ledger_entry.stock_value_difference,
+				stock_ledger_entry.is_reversal,
+				stock_ledger_entry.type,
+				stock_ledger_entry.source,
+			)
+			.where(stock_ledger_entry.item == self.item)
+			.where(stock_ledger_entry.warehouse == self.warehouse)
+			.orderby(stock_ledger_entry.entry_time)
+			.orderby(stock_ledger_entry.creation)
+			.orderby(stock_ledger_entry.name)
+			.limit(chunk_size)
+		)
+
+		if self.last_entry:
+			# Resume right after the last row reposted, from the balance stored on it
+			last = frappe.db.get_value(
+				"Stock Ledger Entry",
+				self.last_entry,
+				["entry_time", "creation", "name", "qty_after_transaction", "stock_value"],
+				as_dict=True,
+			)
+			query = query.where(
+				(stock_ledger_entry.entry_time > last.entry_time)
+				| (
+					(stock_ledger_entry.entry_time == last.entry_time)
+					& (
+						(stock_ledger_entry.creation > last.creation)
+						| (
+							(stock_ledger_entry.creation == last.creation)
+							& (stock_ledger_entry.name > last.name)
+						)
+					)
+				)
+			)
+			actual_qty, stock_value = flt(last.qty_after_transaction), flt(last.stock_value)
+		else:
+			query = query.where(stock_ledger_entry.entry_time > self.from_time)
+			balance = get_stock_balances([pair], get_datetime(self.from_time))[pair]
+			actual_qty, stock_value = balance.actual_qty, balance.stock_value
+
+		rows = query.run(as_dict=True)
+		updates = {}
+		revalued = []
+		for row in rows:
+			# Only outgoing stock is valued at the running valuation rate. Incoming rows keep the
+			# value they were received at, incoming transfers the value their stock left with, and
+			# reversals the value they take back.
+			stock_value_difference = flt(row.stock_value_difference)
+			if row.quantity < 0 and not row.is_reversal:
+				stock_value_difference = get_stock_value_difference(
+					actual_qty, stock_value, row.quantity, row.rate
+				)
+				if flt(stock_value_difference, 9) != flt(row.stock_value_difference, 9):
+					revalued.append(row.update(stock_value_difference=stock_value_difference))
+			actual_qty += row.quantity
+			stock_value += stock_value_difference
+			updates[row.name] = {
+				"qty_after_transaction": actual_qty,
+				"valuation_rate": get_valuation_rate(actual_qty, stock_value),
+				"stock_value": stock_value,
+				"stock_value_difference": stock_value_difference,
+			}
+		frappe.db.bulk_update("Stock Ledger Entry", updates, update_modified=False)
+		frappe.db.after_commit.add(partial(record_ledger_changes, [pair]))
+		self.update_incoming_transfers(revalued)
+
+		if len(rows) == chunk_size:
+			self.db_set("last_entry", rows[-1].name)
+			return False
+
+		bin.update(
+			actual_qty=actual_qty,
+			stock_value=stock_value,
+			valuation_rate=get_valuation_rate(actual_qty, stock_value),
+			modified=frappe.utils.now_datetime(),
+		)
+		frappe.db.set_value(
+			"Bin",
+			bin.name,
+			{
+				"actual_qty": bin.actual_qty,
+				"stock_value": bin.stock_value,
+				"valuation_rate": bin.valuation_rate,
+				"modified": bin.modified,
+			},
+			update_modified=False,
+		)
+		frappe.db.after_commit.add(partial(invalidate_cached_balances, [bin]))
+		return True
+
+	def update_incoming_transfers(self, revalued: list[frappe._dict]):
+		"""
+		Function to carry the new value of outgoing transfer rows over to their incoming rows
+
+		The incoming row of a transfer is posted right after its outgoing row, a microsecond later.
+		The pairs of the incoming rows are queued for reposting from then on, so that their running
+		balances and bins follow.
+
+		:param revalued: Outgoing rows whose stock value difference changed, with the new one
+		"""
+		if not revalued:
+			return
+
+		stock_ledger_entry = DocType("Stock Ledger Entry")
+		incoming = {
+			(row.type, row.source, row.creation): row
+			for row in frappe.qb.from_(stock_ledger_entry)
+			.select(
+				stock_ledger_entry.name,
+				stock_ledger_entry.creation,
+				stock_ledger_entry.warehouse,
+				stock_ledger_entry.entry_time,
+				stock_ledger_entry.quantity,
+				stock_ledger_entry.type,
+				stock_ledger_entry.source,
+			)
+			.where(stock_ledger_entry.item == self.item)
+			.where(stock_ledger_entry.is_transfer_in == 1)
+			.where(
+				Tuple(stock_ledger_entry.type, stock_ledger_entry.source).isin(
+					list({(row.type, row.source) for row in revalued})
+				)
+			)
+			.run(as_dict=True)
+		}
+
+		updates = {}
+		from_times: dict[str, datetime] = {}
+		for row in revalued:
+			leg = incoming.get((row.type, row.source, row.creation + timedelta(microseconds=1)))
+			if not leg:
+				continue
+			updates[leg.name] = {
+				"stock_value_difference": -row.stock_value_difference,
+				"rate": get_valuation_rate(leg.quantity, -row.stock_value_difference),
+			}
+			# Just before the row, so that the repost does not start from its stale balance
+			from_time = get_datetime(leg.entry_time) - timedelta(microseconds=1)
+			from_times[leg.warehouse] = min(from_times.get(leg.warehouse, from_time), from_time)
+
+		frappe.db.bulk_update("Stock Ledger Entry", updates, update_modified=False)
+		for warehouse, from_time in from_times.items():
+			queue_repost([(self.item, warehouse)], from_time, self)
+
+	def repost(self):
+		chunk_size = cint(frappe.db.get_single_value("Stock Settings", "repost_chunk_size")) or 10_000
+		self.db_set("status", "In Progress", commit=True)
+		try:
+			# Every chunk is committed on its own, an interrupted repost resumes where it stopped
+			while not self.repost_chunk(chunk_size):
+				frappe.db.commit()
+			self.db_set("status", "Completed", commit=True)
+		except Exception:
+			frappe.db.rollback()
+			self.db_set({"status": "Failed", "error": frappe.get_traceback()}, commit=True)
+			self.log_error(f"Repost of {self.item} in {self.warehouse} failed")
+
+
+def queue_repost(pairs: list[tuple[str, str]], from_time: datetime, voucher: Document):
+	"""
+	Function to queue the ledger rows of the given pairs posted after a point in time for reposting
+
+	A pair that is already queued is reposted once, from the earlier of the two points in time.
+
+	:param pairs: (item, warehouse) pairs to repost
+	:param from_time: Point in time after which the rows are reposted
+	:param voucher: Document whose posting made the repost necessary
+	"""
+	queued = {
+		(row.item, row.warehouse): row
+		for row in frappe.get_all(
+			"Stock Repost Entry",
+			filters={
+				"status": "Queued",
+				"item": ["in", list({item for item, _ in pairs})],
+				"warehouse": ["in", list({warehouse for _, warehouse in pairs})],
+			},
+			fields=["name", "item", "warehouse", "from_time"],
+		)
+	}
+
+	now = frappe.utils.now_datetime()
+	user = frappe.session.user
+	values = []
+	for item, warehouse in pairs:
+		if row := queued.get((item, warehouse)):
+			if get_datetime(row.from_time) > from_time:
+				frappe.db.set_value("Stock Repost Entry", row.name, "from_time", from_time)
+			continue
+
+		values.append(
+			(
+				frappe.generate_hash(length=10),
+				now,
+				now,
+				user,
+				user,
+				item,
+				warehouse,
+				from_time,
+				"Queued",
+				voucher.doctype,
+				voucher.name,
+			)
+		)
+
+	frappe.db.bulk_insert(
+		"Stock Repost Entry",
+		[
+			"name",
+			"creation",
+			"modified",
+			"owner",
+			"modified_by",
+			"item",
+			"warehouse",
+			"from_time",
+			"status",
+			"voucher_type",
+			"voucher_no",
+		],
+		values,
+	)
+	enqueue_repost(enqueue_after_commit=True)
+
+
+def enqueue_repost(enqueue_after_commit: bool = False):
+	# A single job works through the queue, so that two workers never repost the same pair
+	frappe.enqueue(
+		process_repost_queue,
+		queue="long",
+		timeout=3600,
+		job_id="stock_repost_queue",
+		deduplicate=True,
+		enqueue_after_commit=enqueue_after_commit,
+	)
+
+
+def process_repost_queue():
+	"""
+	Background job reposting the queued entries, oldest first
+	"""
+	# Entries left In Progress were interrupted, they pick up after the last row they reposted
+	while names := frappe.get_all(
+		"Stock Repost Entry",
+		filters={"status": ["in", ["Queued", "In Progress"]]},
+		order_by="creation asc",
+		pluck="name",
+		limit=1,
+	):
+		frappe.get_doc("Stock Repost Entry", names[0]).repost()
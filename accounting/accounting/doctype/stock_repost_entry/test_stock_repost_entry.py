@@ -0,0 +1,148 @@
+# Copyright (c) 2023, Akhil and Contributors
+# See license.txt
+
+from datetime import timedelta
+
+import frappe
+from accounting.accounting.doctype.bin.bin import NegativeStockError
+from accounting.accounting.doctype.item.test_item import create_random_item
+from accounting.accounting.doctype.stock_period_closing.test_stock_period_closing import (
+	create_period_closing,
+)
+from accounting.accounting.doctype.warehouse.test_warehouse import create_random_warehouse
+from frappe.tests.utils import FrappeTestCase
+
+from .stock_repost_entry import process_repost_queue
+
+
+class TestStockRepostEntry(FrappeTestCase):
+	def setUp(self):
+		frappe.set_user("Administrator")
+		self.item = create_random_item()
+		self.warehouse = create_random_warehouse()
+		self.now = frappe.utils.now_datetime()
+
+	def post(self, entry_type: str, quantity: int, rate: float = 100, hours_ago: int = 0):
+		warehouse = "target_warehouse" if entry_type == "Receipt" else "source_warehouse"
+		return (
+			frappe.new_doc(
+				"Stock Entry",
+				entry_type=entry_type,
+				posting_time=self.now - timedelta(hours=hours_ago),
+				items=[{"item": self.item.name, "quantity": quantity, "rate": rate}],
+				**{warehouse: self.warehouse.name},
+			)
+			.insert()
+			.submit()
+		)
+
+	def get_bin(self):
+		return frappe.db.get_value(
+			"Bin",
+			{"item": self.item.name, "warehouse": self.warehouse.name},
+			["actual_qty", "stock_value"],
+		)
+
+	def test_backdated_entry_is_reposted(self):
+		chunk_size = frappe.db.get_single_value("Stock Settings", "repost_chunk_size")
+		frappe.db.set_single_value("Stock Settings", "repost_chunk_size", 1)
+		self.addCleanup(
+			frappe.db.set_single_value, "Stock Settings", "repost_chunk_size", chunk_size
+		)
+
+		self.post("Receipt", 10, rate=100, hours_ago=3)
+		self.post("Consume", 5)
+		self.post("Consume", 1)
+
+		# Received before the consumptions, which now have to be valued at the new average
+		entry = self.post("Receipt", 10, rate=200, hours_ago=2)
+		repost = frappe.get_last_doc("Stock Repost Entry", {"voucher_no": entry.name})
+		self.assertEqual(repost.status, "Queued")
+		self.assertEqual(self.get_bin()[0], 14)
+
+		process_repost_queue()
+		repost.reload()
+		self.assertEqual(repost.status, "Completed")
+
+		rows = frappe.get_all(
+			"Stock Ledger Entry",
+			filters={"item": self.item.name},
+			fields=["qty_after_transaction", "stock_value", "stock_value_difference"],
+			order_by="entry_time asc, creation asc",
+		)
+		self.assertEqual([row.qty_after_transaction for row in rows], [10, 20, 15, 14])
+		self.assertEqual([row.stock_value_difference for row in rows], [1000, 2000, -750, -150])
+		self.assertEqual(self.get_bin(), (14, 2100))
+
+	def test_repost_keeps_reversals_and_incoming_transfers(self):
+		self.post("Receipt", 10, rate=100.5, hours_ago=3)
+		self.post("Receipt", 5, rate=103, hours_ago=1).cancel()
+		target_warehouse = create_random_warehouse()
+		transfer = (
+			frappe.new_doc(
+				"Stock Entry",
+				entry_type="Transfer",
+				source_warehouse=self.warehouse.name,
+				target_warehouse=target_warehouse.name,
+				items=[{"item": self.item.name, "quantity": 3, "rate": 0}],
+			)
+			.insert()
+			.submit()
+		)
+
+		entry = self.post("Receipt", 10, rate=200.25, hours_ago=2)
+		process_repost_queue()
+		self.assertEqual(
+			frappe.db.get_value("Stock Repost Entry", {"voucher_no": entry.name}, "status"),
+			"Completed",
+		)
+
+		# The reversal takes back the 515 its receipt added rather than 5 at the new average, and
+		# only the outgoing transfer is valued at the new average of 150.375
+		rows = frappe.get_all(
+			"Stock Ledger Entry",
+			filters={"item": self.item.name, "warehouse": self.warehouse.name},
+			fields=["stock_value_difference"],
+			order_by="entry_time asc, creation asc",
+			pluck="stock_value_difference",
+		)
+		self.assertEqual(rows, [1005, 2002.5, 515, -515, -451.125])
+		self.assertEqual(self.get_bin(), (17, 2556.375))
+
+		# The incoming leg takes over the re-valued amount, and the target warehouse is reposted
+		legs = frappe.get_all(
+			"Stock Ledger Entry",
+			filters={"source": transfer.name},
+			fields=["warehouse", "stock_value_difference"],
+		)
+		self.assertEqual(sum(leg.stock_value_difference for leg in legs), 0)
+		self.assertEqual(
+			frappe.db.get_value(
+				"Bin",
+				{"item": self.item.name, "warehouse": target_warehouse.name},
+				["actual_qty", "stock_value"],
+			),
+			(3, 451.125),
+		)
+
+	def test_backdated_entry_without_later_rows(self):
+		self.post("Receipt", 10, hours_ago=3)
+		self.post("Consume", 4, hours_ago=2)
+
+		self.assertEqual(self.get_bin(), (6, 600))
+		self.assertFalse(frappe.db.exists("Stock Repost Entry", {"item": self.item.name}))
+
+	def test_backdated_entry_cannot_take_later_stock(self):
+		self.post("Receipt", 10, hours_ago=3)
+		self.post("Consume", 10)
+
+		# There was enough stock two hours ago, but all of it was consumed afterwards
+		with self.assertRaises(NegativeStockError):
+			self.post("Consume", 5, hours_ago=2)
+
+	def test_posting_into_closed_period(self):
+		closing = create_period_closing(self.now - timedelta(hours=1))
+		self.addCleanup(closing.cancel)
+
+		with self.assertRaises(frappe.ValidationError):
+			self.post("Receipt", 10, hours_ago=2)
@@ -0,0 +1,23 @@
+# Copyright (c) 2023, Akhil and contributors
+# For license information, please see license.txt
+
+# import frappe
+from frappe.model.document import Document
+
+
+class StockSettings(Document):
+	# begin: auto-generated types
+	# This code is auto-generated. Do not modify anything in this block.
+
+	from typing import TYPE_CHECKING
+
+	if TYPE_CHECKING:
+		from frappe.types import DF
+
+		archive_after_days: DF.Int
+		archive_chunk_size: DF.Int
+		background_submit_threshold: DF.Int
+		ledger_chunk_size: DF.Int
+		repost_chunk_size: DF.Int
+	# end: auto-generated types
+	pass
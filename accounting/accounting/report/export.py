@@ -0,0 +1,184 @@
+# Copyright (c) 2023, Akhil and contributors
+# For license information, please see license.txt
+import csv
+import hashlib
+import itertools
+import os
+from typing import Iterator
+
+from openpyxl import Workbook
+
+import frappe
+
+# Reports that can be exported in the background, and the modules that build them. Each module has
+# a Filters model, get_columns() and iter_rows(filters) streaming the rows of the report.
+REPORTS = {
+	"Stock Balance": "accounting.accounting.report.stock_balance.stock_balance",
+	"Stock Ledger": "accounting.accounting.report.stock_ledger.stock_ledger",
+}
+
+FILE_FORMATS = {"CSV": "csv", "Excel": "xlsx"}
+
+# Rows written to the file at once
+CHUNK_SIZE = 10_000
+
+
+def iter_chunks(rows: Iterator[dict], columns: list[dict]) -> Iterator[list[list]]:
+	fieldnames = [column["fieldname"] for column in columns]
+	while chunk := [
+		[row.get(fieldname) for fieldname in fieldnames]
+		for row in itertools.islice(rows, CHUNK_SIZE)
+	]:
+		yield chunk
+
+
+def write_csv(path: str, columns: list[dict], rows: Iterator[dict]):
+	with open(path, "w", newline="") as f:
+		writer = csv.writer(f)
+		writer.writerow([column["label"] for column in columns])
+		for chunk in iter_chunks(rows, columns):
+			writer.writerows(chunk)
+
+
+def write_xlsx(path: str, columns: list[dict], rows: Iterator[dict]):
+	# A write-only workbook streams the rows to disk as they are appended
+	workbook = Workbook(write_only=True)
+	sheet = workbook.create_sheet()
+	sheet.append([column["label"] for column in columns])
+	for chunk in iter_chunks(rows, columns):
+		for row in chunk:
+			sheet.append(row)
+	workbook.save(path)
+
+
+def get_content_hash(path: str) -> str:
+	content_hash = hashlib.md5()
+	with open(path, "rb") as f:
+		while block := f.read(1 << 20):
+			content_hash.update(block)
+	return content_hash.hexdigest()
+
+
+def build_export(report_name: str, filters: dict, file_format: str, user: str) -> str:
+	"""
+	Function to write a report to a private file attached to the Report, one chunk at a time
+
+	:param report_name: Name of the report, one of REPORTS
+	:param filters: Report filters
+	:param file_format: One of FILE_FORMATS
+	:param user: User the export is for
+	:return: URL of the file
+	"""
+	module = frappe.get_module(REPORTS[report_name])
+	columns = [column for column in module.get_columns() if not column.get("hidden")]
+	rows = module.iter_rows(module.Filters.model_validate(filters))
+
+	file_name = "{}-{}.{}".format(
+		frappe.scrub(report_name), frappe.generate_hash(length=10), FILE_FORMATS[file_format]
+	)
+	path = frappe.get_site_path("private", "files", file_name)
+	if file_format == "Excel":
+		write_xlsx(path, columns, rows)
+	else:
+		write_csv(path, columns, rows)
+
+	# Inserting a File document reads the whole file back to hash it, so the row is written
+	# directly with the hash computed block by block instead
+	now = frappe.utils.now_datetime()
+	file_url = f"/private/files/{file_name}"
+	frappe.db.bulk_insert(
+		"File",
+		[
+			"name",
+			"creation",
+			"modified",
+			"owner",
+			"modified_by",
+			"file_name",
+			"file_url",
+			"file_type",
+			"file_size",
+			"content_hash",
+			"is_private",
+			"folder",
+			"attached_to_doctype",
+			"attached_to_name",
+		],
+		[
+			(
+				frappe.generate_hash(length=10),
+				now,
+				now,
+				user,
+				user,
+				file_name,
+				file_url,
+				FILE_FORMATS[file_format].upper(),
+				os.path.getsize(path),
+				get_content_hash(path),
+				1,
+				"Home/Attachments",
+				"Report",
+				report_name,
+			)
+		],
+	)
+	return file_url
+
+
+def process_export(report_name: str, filters: dict, file_format: str, user: str):
+	"""
+	Background job exporting a report queued by export_report, the user is notified once it is done
+	"""
+	try:
+		file_url = build_export(report_name, filters, file_format, user)
+		frappe.db.commit()
+	except Exception:
+		frappe.db.rollback()
+		frappe.log_error(f"Export of {report_name} failed")
+		frappe.publish_realtime(
+			"msgprint", f"Export of {report_name} failed, please check the Error Log", user=user
+		)
+		raise
+
+	frappe.publish_realtime(
+		"msgprint", f'Export of {report_name} is ready: <a href="{file_url}">Download</a>', user=user
+	)
+
+
+@frappe.whitelist(methods=["POST"])
+def export_report(report_name: str, filters: str | dict, file_format: str = "CSV"):
+	"""
+	Endpoint to export a whole report to a file in the background
+
+	The rows are streamed from the database to the file in chunks, so reports of any size can be
+	exported without holding them in memory.
+
+	:param report_name: Name of the report
+	:param filters: Report filters
+	:param file_format: CSV or Excel
+	"""
+	if report_name not in REPORTS:
+		frappe.throw(f"{report_name} cannot be exported in the background")
+	if file_format not in FILE_FORMATS:
+		frappe.throw(f"Invalid file format: {file_format}")
+	if not frappe.get_doc("Report", report_name).is_permitted():
+		frappe.throw(f"Not permitted to export {report_name}", frappe.PermissionError)
+
+	# Validate the filters right away rather than failing in the background
+	filters = frappe.parse_json(filters)
+	frappe.get_module(REPORTS[report_name]).Filters.model_validate(filters)
+
+	frappe.enqueue(
+		process_export,
+		queue="long",
+		timeout=3600,
+		report_name=report_name,
+		filters=filters,
+		file_format=file_format,
+		user=frappe.session.user,
+	)
+	frappe.msgprint(
+		f"{report_name} is being exported in the background, you will be notified once it is ready",
+		alert=True,
+	)
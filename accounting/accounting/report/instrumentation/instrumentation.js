@@ -0,0 +1,6 @@
+// Copyright (c) 2023, Akhil and contributors
+// For license information, please see license.txt
+
+frappe.query_reports["Instrumentation"] = {
+	"filters": []
+};
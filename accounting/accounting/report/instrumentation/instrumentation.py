@@ -0,0 +1,51 @@
+# Copyright (c) 2023, Akhil and contributors
+# For license information, please see license.txt
+
+import frappe
+from accounting.instrumentation import PERCENTILES, get_stats
+
+
+def get_columns() -> list[dict]:
+	columns = [
+		{
+			"fieldname": "name",
+			"label": "Function",
+			"fieldtype": "Data",
+			"width": 300,
+		},
+		{
+			"fieldname": "calls",
+			"label": "Calls",
+			"fieldtype": "Int",
+			"width": 80,
+		},
+	]
+	for percentile in PERCENTILES:
+		columns.extend(
+			[
+				{
+					"fieldname": f"p{percentile}_time",
+					"label": f"P{percentile} Time (ms)",
+					"fieldtype": "Float",
+					"width": 130,
+				},
+				{
+					"fieldname": f"p{percentile}_queries",
+					"label": f"P{percentile} Queries",
+					"fieldtype": "Int",
+					"width": 110,
+				},
+				{
+					"fieldname": f"p{percentile}_query_time",
+					"label": f"P{percentile} Query Time (ms)",
+					"fieldtype": "Float",
+					"width": 160,
+				},
+			]
+		)
+	return columns
+
+
+def execute(incoming_filters: dict | None = None) -> tuple[list[dict], list[dict]]:
+	frappe.only_for("System Manager")
+	return get_columns(), get_stats()
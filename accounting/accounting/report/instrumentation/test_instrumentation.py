@@ -0,0 +1,63 @@
+# Copyright (c) 2023, Akhil and Contributors
+# See license.txt
+
+import frappe
+from accounting.accounting.doctype.item.test_item import create_random_item
+from accounting.accounting.doctype.stock_entry.test_stock_entry import create_entry
+from accounting.accounting.doctype.warehouse.test_warehouse import create_random_warehouse
+from accounting.instrumentation import (
+	NAMES_KEY,
+	SAMPLE_SIZE,
+	get_percentile,
+	get_samples_key,
+	get_stats,
+	write_samples,
+)
+from frappe.tests.utils import FrappeTestCase
+
+from .instrumentation import execute
+
+
+class TestInstrumentation(FrappeTestCase):
+	def setUp(self):
+		frappe.set_user("Administrator")
+
+	def test_report(self):
+		create_entry(
+			"Receipt",
+			[{"item": create_random_item().name, "quantity": 10, "rate": 100}],
+			target_warehouse=create_random_warehouse().name,
+		)
+
+		_, data = execute()
+		rows = {row["name"]: row for row in data}
+		for name in (
+			"stock_entry.StockEntry.before_save",
+			"stock_entry.StockEntry.on_submit",
+			"stock_entry.StockEntry.insert_ledger",
+		):
+			self.assertGreaterEqual(rows[name]["calls"], 1)
+			self.assertLessEqual(rows[name]["calls"], SAMPLE_SIZE)
+		self.assertGreater(rows["stock_entry.StockEntry.insert_ledger"]["p50_queries"], 0)
+		self.assertEqual(
+			frappe.cache.llen(get_samples_key("stock_entry.StockEntry.on_submit")),
+			rows["stock_entry.StockEntry.on_submit"]["calls"],
+		)
+
+	def test_stats_include_written_samples(self):
+		name = f"test_instrumentation.{frappe.generate_hash(length=10)}"
+		self.addCleanup(frappe.cache.srem, NAMES_KEY, name)
+		self.addCleanup(frappe.cache.delete_value, get_samples_key(name))
+
+		write_samples([(name, (0.002, 3, 0.001)), (name, (0.004, 5, 0.003))])
+		rows = {row["name"]: row for row in get_stats()}
+		self.assertEqual(rows[name]["calls"], 2)
+		self.assertEqual(rows[name]["p50_queries"], 3)
+		self.assertEqual(rows[name]["p99_queries"], 5)
+		self.assertAlmostEqual(rows[name]["p99_time"], 4)
+
+	def test_percentile(self):
+		values = list(range(1, 101))
+		self.assertEqual(get_percentile(values, 50), 50)
+		self.assertEqual(get_percentile(values, 99), 99)
+		self.assertEqual(get_percentile([7], 95), 7)
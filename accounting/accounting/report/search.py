@@ -0,0 +1,126 @@
+# Copyright (c) 2023, Akhil and contributors
+# For license information, please see license.txt
+import hashlib
+import json
+from functools import partial
+
+import frappe
+
+SEARCH_CACHE_KEY = "stock_link_search"
+# Short enough that new and renamed records show up soon, long enough to absorb typing
+SEARCH_CACHE_EXPIRY = 60
+MAX_PAGE_LENGTH = 100
+
+
+def escape_like(txt: str) -> str:
+	return txt.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def get_search_fields(doctype: str, filters: dict) -> tuple[list[str], list[list], list[str]]:
+	"""
+	Function to describe the search of a doctype
+
+	:param doctype: Item or Warehouse
+	:param filters: Warehouses can be limited to the subtree of a group with `parent`
+	:return: (value, description) fields selected, filters, and the fields matched against the
+		search text
+	"""
+	if doctype == "Item":
+		return ["name", "item_name"], [], ["name", "item_name"]
+
+	conditions = []
+	if parent := filters.get("parent"):
+		if not (bounds := frappe.db.get_value("Warehouse", parent, ["lft", "rgt"])):
+			frappe.throw(f"Warehouse {parent} does not exist")
+		lft, rgt = bounds
+		conditions = [["lft", ">=", lft], ["rgt", "<=", rgt]]
+	return ["name", "parent_warehouse"], conditions, ["name"]
+
+
+def get_matches(doctype: str, txt: str, start: int, page_len: int, filters: dict) -> list[tuple]:
+	"""
+	Function to fetch one page of the records matching the search text, prefix matches first
+
+	Prefix matches are range scans on the indexes of the matched fields. Substring matches need a
+	full scan, so they are only looked for once the prefix matches run out before the page is full.
+	Records are read with frappe.get_list, so that user permissions apply.
+
+	:param doctype: Item or Warehouse
+	:param txt: Search text
+	:param start: Number of matches to skip
+	:param page_len: Number of matches to return
+	:param filters: Search filters
+	:return: (value, description) of every match
+	"""
+	fields, conditions, search_fields = get_search_fields(doctype, filters)
+	get_list = partial(frappe.get_list, doctype, fields=fields, order_by="name asc", as_list=True)
+	if not txt:
+		return get_list(filters=conditions, limit_start=start, limit_page_length=page_len)
+
+	txt = escape_like(txt)
+	matches = get_list(
+		filters=conditions,
+		or_filters=[[field, "like", f"{txt}%"] for field in search_fields],
+		limit_page_length=start + page_len,
+	)
+	if len(matches) == start + page_len:
+		return matches[start:]
+
+	# Every prefix match has been fetched, the substring matches continue after them
+	page = matches[start:]
+	return [
+		*page,
+		*get_list(
+			filters=[
+				*conditions,
+				*([field, "not like", f"{txt}%"] for field in search_fields),
+			],
+			or_filters=[[field, "like", f"%{txt}%"] for field in search_fields],
+			limit_start=max(start - len(matches), 0),
+			limit_page_length=page_len - len(page),
+		),
+	]
+
+
+@frappe.whitelist()
+@frappe.validate_and_sanitize_search_inputs
+def search_link(
+	doctype: str,
+	txt: str,
+	searchfield: str,
+	start: int,
+	page_len: int,
+	filters: dict | None = None,
+) -> list[tuple]:
+	"""
+	Endpoint for the Item and Warehouse link filters of the reports, one page of matches at a time
+
+	Items match on the item code and the item name, warehouses on their name and can be limited to
+	the subtree of a group with the `parent` filter. Pages are cached per user for a short while.
+
+	:param doctype: Item or Warehouse
+	:param txt: Search text
+	:param searchfield: Unused, the fields matched depend on the doctype
+	:param start: Number of matches to skip
+	:param page_len: Number of matches to return
+	:param filters: Search filters
+	:return: (value, description) of every match
+	"""
+	if doctype not in ("Item", "Warehouse"):
+		frappe.throw(f"Cannot search {doctype}")
+	frappe.has_permission(doctype, "read", throw=True)
+
+	filters = frappe.parse_json(filters) or {}
+	page_len = min(page_len, MAX_PAGE_LENGTH)
+	digest = hashlib.sha1(
+		json.dumps(
+			[frappe.session.user, doctype, txt, start, page_len, filters], sort_keys=True
+		).encode()
+	).hexdigest()
+	key = f"{SEARCH_CACHE_KEY}::{digest}"
+	if (matches := frappe.cache.get_value(key)) is not None:
+		return matches
+
+	matches = [tuple(match) for match in get_matches(doctype, txt, start, page_len, filters)]
+	frappe.cache.set_value(key, matches, expires_in_sec=SEARCH_CACHE_EXPIRY)
+	return matches
@@ -0,0 +1,48 @@
+// Copyright (c) 2023, Akhil and contributors
+// For license information, please see license.txt
+
+frappe.query_reports["Stock Ageing"] = {
+	"filters": [
+		{
+			"fieldname": "item",
+			"label": __("Item"),
+			"fieldtype": "Link",
+			"width": "80",
+			"options": "Item",
+			"get_query": function () {
+				return {"query": "accounting.accounting.report.search.search_link"};
+			}
+		},
+		{
+			"fieldname": "warehouse",
+			"label": __("Warehouse"),
+			"fieldtype": "Link",
+			"width": "80",
+			"options": "Warehouse",
+			"get_query": function () {
+				return {"query": "accounting.accounting.report.search.search_link"};
+			}
+		},
+		{
+			"fieldname": "to_date",
+			"label": __("As On"),
+			"fieldtype": "Datetime",
+			"width": "80",
+			"default": frappe.datetime.now_datetime()
+		},
+		{
+			"fieldname": "range",
+			"label": __("Range (Days)"),
+			"fieldtype": "Int",
+			"width": "80",
+			"default": 30
+		},
+		{
+			"fieldname": "buckets",
+			"label": __("Number of Ranges"),
+			"fieldtype": "Int",
+			"width": "80",
+			"default": 4
+		}
+	]
+};
@@ -0,0 +1,217 @@
+# Copyright (c) 2023, Akhil and contributors
+# For license information, please see license.txt
+
+import itertools
+from dataclasses import dataclass
+from datetime import datetime
+
+import numpy as np
+from pydantic import BaseModel, Field
+
+import frappe
+from accounting.accounting.doctype.stock_ledger_archive.stock_ledger_archive import (
+	get_archive_cutoff,
+	get_ledger_table,
+)
+from accounting.instrumentation import instrument
+
+# Ledger rows converted to arrays at once
+BATCH_SIZE = 100_000
+
+
+class Filters(BaseModel):
+	item: str | None = None
+	warehouse: str | None = None
+	to_date: datetime | None = None
+	range: int = Field(default=30, gt=0)
+	buckets: int = Field(default=4, ge=2, le=12)
+
+
+@dataclass
+class Ledger:
+	"""
+	Ledger rows as columns, ordered by (item, warehouse, entry_time)
+	"""
+
+	# (item, warehouse) of every pair, in order
+	pairs: list[tuple[str, str]]
+	# Index into pairs of every row
+	pair_index: np.ndarray
+	entry_time: np.ndarray
+	quantity: np.ndarray
+
+
+def get_columns(filters: Filters) -> list[dict]:
+	columns = [
+		{
+			"fieldname": "item",
+			"label": "Item",
+			"fieldtype": "Link",
+			"options": "Item",
+			"width": 200,
+		},
+		{
+			"fieldname": "warehouse",
+			"label": "Warehouse",
+			"fieldtype": "Link",
+			"options": "Warehouse",
+			"width": 200,
+		},
+		{
+			"fieldname": "quantity",
+			"label": "Quantity",
+			"fieldtype": "Float",
+			"width": 120,
+		},
+		{
+			"fieldname": "average_age",
+			"label": "Average Age (Days)",
+			"fieldtype": "Float",
+			"width": 150,
+		},
+	]
+
+	for bucket in range(filters.buckets):
+		start = bucket * filters.range
+		label = (
+			f"{start + 1 if bucket else 0}-{start + filters.range}"
+			if bucket < filters.buckets - 1
+			else f"{start + 1}-Above"
+		)
+		columns.append(
+			{"fieldname": f"range_{bucket}", "label": label, "fieldtype": "Float", "width": 120}
+		)
+	return columns
+
+
+def get_ledger(filters: Filters) -> Ledger:
+	"""
+	Function to read the ledger rows up to to_date into arrays
+
+	The rows are streamed through a server side cursor and converted a batch at a time, so only
+	the numeric columns of the whole ledger are held in memory.
+
+	:param filters: Report filters
+	:return: Ledger rows as columns
+	"""
+	# Every receipt is aged on its own, so archived rows are read instead of the carry-forward rows
+	# standing in for them. Ordered by the (item, warehouse, entry_time) index, so the rows of the
+	# live table come out without a sort. Rows of a pair sharing an entry time have the same age,
+	# the order among them does not matter.
+	stock_ledger_entry = get_ledger_table(None, get_archive_cutoff())
+	query = (
+		frappe.qb.from_(stock_ledger_entry)
+		.select(
+			stock_ledger_entry.item,
+			stock_ledger_entry.warehouse,
+			stock_ledger_entry.entry_time,
+			stock_ledger_entry.quantity,
+		)
+		.where(stock_ledger_entry.entry_time <= filters.to_date)
+		.orderby(stock_ledger_entry.item)
+		.orderby(stock_ledger_entry.warehouse)
+		.orderby(stock_ledger_entry.entry_time)
+	)
+	if filters.item:
+		query = query.where(stock_ledger_entry.item == filters.item)
+	if filters.warehouse:
+		query = query.where(stock_ledger_entry.warehouse == filters.warehouse)
+
+	pairs: list[tuple[str, str]] = []
+	pair_index, entry_time, quantity = [], [], []
+	with frappe.db.unbuffered_cursor():
+		rows = query.run(as_iterator=True)
+		while batch := list(itertools.islice(rows, BATCH_SIZE)):
+			items, warehouses, times, quantities = (np.array(column) for column in zip(*batch))
+
+			# A new pair starts wherever the item or the warehouse differs from the row before it,
+			# including the first row of the batch when it differs from the last pair seen so far
+			previous_item, previous_warehouse = pairs[-1] if pairs else (None, None)
+			starts = np.empty(len(batch), dtype=bool)
+			starts[0] = (items[0], warehouses[0]) != (previous_item, previous_warehouse)
+			starts[1:] = (items[1:] != items[:-1]) | (warehouses[1:] != warehouses[:-1])
+
+			pair_index.append(len(pairs) - 1 + np.cumsum(starts))
+			pairs.extend(zip(items[starts].tolist(), warehouses[starts].tolist()))
+			entry_time.append(times.astype("datetime64[s]"))
+			quantity.append(quantities.astype(np.float64))
+
+	if not pairs:
+		return Ledger(
+			pairs=[],
+			pair_index=np.empty(0, dtype=np.int64),
+			entry_time=np.empty(0, dtype="datetime64[s]"),
+			quantity=np.empty(0, dtype=np.float64),
+		)
+	return Ledger(
+		pairs=pairs,
+		pair_index=np.concatenate(pair_index),
+		entry_time=np.concatenate(entry_time),
+		quantity=np.concatenate(quantity),
+	)
+
+
+def get_ageing(ledger: Ledger, filters: Filters) -> list[dict]:
+	"""
+	Function to bucket the stock on hand of every pair by age, consuming receipts first in first out
+
+	Every incoming row is a layer. Consuming stock first in first out, a layer is left with what
+	was received up to and including it beyond everything that went out, capped at its own quantity:
+	clip(received_until_layer - total_out, 0, layer_quantity). That holds for every layer at once,
+	so the whole ledger is aged with array operations instead of a loop over its rows.
+
+	:param ledger: Ledger rows as columns
+	:param filters: Report filters
+	:return: Quantity per age bucket, total quantity and average age of every pair with stock
+	"""
+	pair_count = len(ledger.pairs)
+	if not pair_count:
+		return []
+
+	incoming = np.where(ledger.quantity > 0, ledger.quantity, 0)
+	outgoing = np.bincount(
+		ledger.pair_index,
+		weights=np.where(ledger.quantity < 0, -ledger.quantity, 0),
+		minlength=pair_count,
+	)
+
+	# Running total of incoming stock within each pair: the running total over all the rows, less
+	# what was received by the pairs before it
+	received = np.cumsum(incoming)
+	first_rows = np.flatnonzero(np.r_[True, ledger.pair_index[1:] != ledger.pair_index[:-1]])
+	received -= (received[first_rows] - incoming[first_rows])[ledger.pair_index]
+
+	remaining = np.clip(received - outgoing[ledger.pair_index], 0, incoming)
+
+	to_date = np.datetime64(filters.to_date, "s")
+	age = (to_date - ledger.entry_time) / np.timedelta64(1, "D")
+	# Ages of exactly a multiple of the range fall in the lower bucket: 30 days is still in 0-30
+	edges = np.arange(1, filters.buckets) * filters.range
+	bucket = np.digitize(age, edges, right=True)
+
+	buckets = np.bincount(
+		ledger.pair_index * filters.buckets + bucket,
+		weights=remaining,
+		minlength=pair_count * filters.buckets,
+	).reshape(pair_count, filters.buckets)
+	quantity = buckets.sum(axis=1)
+	total_age = np.bincount(ledger.pair_index, weights=remaining * age, minlength=pair_count)
+
+	return [
+		{
+			"item": item,
+			"warehouse": warehouse,
+			"quantity": float(quantity[index]),
+			"average_age": float(total_age[index] / quantity[index]),
+			**{f"range_{bucket}": float(value) for bucket, value in enumerate(buckets[index])},
+		}
+		for index, (item, warehouse) in enumerate(ledger.pairs)
+		if quantity[index] > 0
+	]
+
+
+@instrument
+def execute(incoming_filters: dict) -> tuple[list[dict], list[dict]]:
+	filters = Filters.model_validate(incoming_filters)
+	filters.to_date = filters.to_date or frappe.utils.now_datetime()
+	return get_columns(filters), get_ageing(get_ledger(filters), filters)
@@ -0,0 +1,50 @@
+# Copyright (c) 2023, Akhil and Contributors
+# See license.txt
+
+from datetime import timedelta
+
+import frappe
+from accounting.accounting.doctype.item.test_item import create_random_item
+from accounting.accounting.doctype.warehouse.test_warehouse import create_random_warehouse
+from frappe.tests.utils import FrappeTestCase
+
+from .stock_ageing import execute
+
+
+class TestStockAgeing(FrappeTestCase):
+	def setUp(self):
+		frappe.set_user("Administrator")
+		self.item = create_random_item()
+		self.warehouse = create_random_warehouse()
+		self.now = frappe.utils.now_datetime()
+
+	def post(self, entry_type: str, quantity: int, days_ago: int):
+		warehouse = "target_warehouse" if entry_type == "Receipt" else "source_warehouse"
+		frappe.new_doc(
+			"Stock Entry",
+			entry_type=entry_type,
+			posting_time=self.now - timedelta(days=days_ago),
+			items=[{"item": self.item.name, "quantity": quantity, "rate": 100}],
+			**{warehouse: self.warehouse.name},
+		).insert().submit()
+
+	def test_fifo_ageing(self):
+		self.post("Receipt", 10, days_ago=100)
+		self.post("Receipt", 10, days_ago=50)
+		# Consumes the oldest receipt and half of the next one
+		self.post("Consume", 15, days_ago=10)
+		self.post("Receipt", 4, days_ago=5)
+
+		columns, data = execute({"item": self.item.name, "to_date": self.now})
+		self.assertEqual(
+			[column["label"] for column in columns[4:]], ["0-30", "31-60", "61-90", "91-Above"]
+		)
+		self.assertEqual(len(data), 1)
+		self.assertEqual(data[0]["quantity"], 9)
+		self.assertEqual([data[0][f"range_{bucket}"] for bucket in range(4)], [4, 5, 0, 0])
+		self.assertAlmostEqual(data[0]["average_age"], 30)
+
+		# Stock that has all been consumed is not aged
+		self.post("Consume", 9, days_ago=0)
+		_, data = execute({"item": self.item.name, "to_date": self.now})
+		self.assertEqual(data, [])
@@ -10,7 +10,7 @@ frappe.query_reports["Stock Balance"] = {
             "width": "80",
             "options": "Item",
             "get_query": function () {
-                return frappe.db.get_list("Item");
+                return {"query": "accounting.accounting.report.search.search_link"};
             }
         },
         {
@@ -20,7 +20,7 @@ frappe.query_reports["Stock Balance"] = {
             "width": "80",
             "options": "Warehouse",
             "get_query": function () {
-                return frappe.db.get_list("Warehouse");
+                return {"query": "accounting.accounting.report.search.search_link"};
             }
         },
         {
@@ -36,6 +36,45 @@ frappe.query_reports["Stock Balance"] = {
             "fieldtype": "Datetime",
             "width": "80",
             "default": frappe.datetime.now_datetime()
+        },
+        {
+            "fieldname": "rollup",
+            "label": __("Roll Up Warehouse Groups"),
+            "fieldtype": "Check",
+            "default": 0
+        }
+    ],
+    "onload": function (report) {
+        // Streams the whole report to a file attachment, without going through the browser
+        report.page.add_inner_button(__("Export in Background"), function () {
+            frappe.prompt(
+                {
+                    "fieldname": "file_format",
+                    "label": __("Format"),
+                    "fieldtype": "Select",
+                    "options": ["CSV", "Excel"],
+                    "default": "CSV"
+                },
+                function (values) {
+                    frappe.call({
+                        "method": "accounting.accounting.report.export.export_report",
+                        "args": {
+                            "report_name": "Stock Balance",
+                            "filters": report.get_filter_values(),
+                            "file_format": values.file_format
+                        }
+                    });
+                },
+                __("Export in Background")
+            );
+        });
+    },
+    "formatter": function (value, row, column, data, default_formatter) {
+        value = default_formatter(value, row, column, data);
+        // Nest rolled up warehouses under their group
+        if (column.fieldname === "warehouse" && data && data.indent) {
+            value = `<span style="padding-left: ${data.indent * 15}px">${value}</span>`;
         }
-    ]
+        return value;
+    }
 };
@@ -1,12 +1,28 @@
 # Copyright (c) 2023, Akhil and contributors
 # For license information, please see license.txt
+import hashlib
 from datetime import datetime
+from functools import partial
+from typing import Iterable, Iterator
 
 from pydantic import BaseModel
 
 import frappe
-from frappe.query_builder import DocType, functions
-from frappe.utils import flt
+from accounting.accounting.doctype.bin.bin import (
+    get_balance_cache_version,
+    get_changed_pairs,
+    get_ledger_sequence,
+)
+from accounting.accounting.doctype.stock_ledger_archive.stock_ledger_archive import (
+    get_archive_cutoff,
+    get_ledger_table,
+)
+from accounting.accounting.doctype.stock_period_closing.stock_period_closing import (
+    get_latest_closing,
+)
+from accounting.instrumentation import instrument
+from frappe.query_builder import Case, DocType, Tuple, functions
+from frappe.utils import flt, get_datetime
 
 
 class Filters(BaseModel):
@@ -14,11 +30,25 @@ class Filters(BaseModel):
     warehouse: str | None = None
     from_date: datetime
     to_date: datetime
+    rollup: bool = False
 
 
-def execute(incoming_filters: dict) -> tuple[list[dict], list[dict]]:
-    filters = Filters.model_validate(incoming_filters)
-    columns = [
+BALANCE_FIELDS = (
+    "opening_stock",
+    "incoming_stock",
+    "outgoing_stock",
+    "closing_stock",
+    "closing_value",
+)
+
+REPORT_CACHE_KEY = "stock_balance_report"
+REPORT_CACHE_EXPIRY = 24 * 60 * 60
+# Past this many changed pairs, running the whole report again is cheaper than merging
+MAX_CHANGED_PAIRS = 1000
+
+
+def get_columns() -> list[dict]:
+    return [
         {
             "fieldname": "item",
             "label": "Item",
@@ -65,78 +95,295 @@ def execute(incoming_filters: dict) -> tuple[list[dict], list[dict]]:
         },
     ]
 
-    stock_ledger_entry = DocType("Stock Ledger Entry")
-    query = frappe.qb.from_(stock_ledger_entry).distinct().select("item", "warehouse").where(
-        stock_ledger_entry.entry_time.between(filters.from_date, filters.to_date)
+
+def get_entries(
+    filters: Filters, pairs: Iterable[tuple[str, str]] | None = None
+) -> list[dict]:
+    """
+    Function to fetch the balances of every (item, warehouse) pair with movement in the window
+
+    :param filters: Report filters
+    :param pairs: Only fetch the balances of these pairs
+    :return: Opening, incoming, outgoing and closing stock and closing value per pair
+    """
+    return get_query(filters, pairs).run(as_dict=True)
+
+
+def get_query(filters: Filters, pairs: Iterable[tuple[str, str]] | None = None):
+    # Archived rows are only read when the window reaches back into archived periods
+    cutoff = get_archive_cutoff()
+    stock_ledger_entry = get_ledger_table(filters.from_date, cutoff)
+    quantity = stock_ledger_entry.quantity
+    before_window = stock_ledger_entry.entry_time < filters.from_date
+    in_window = stock_ledger_entry.entry_time[filters.from_date:filters.to_date]
+
+    # Every column is a conditional aggregate over the same rows, so the whole report is a single
+    # grouped scan instead of a handful of queries per (item, warehouse) pair
+    query = (
+        frappe.qb.from_(stock_ledger_entry)
+        .select(
+            stock_ledger_entry.item,
+            stock_ledger_entry.warehouse,
+            functions.Sum(Case().when(before_window, quantity).else_(0)).as_("opening_stock"),
+            functions.Sum(Case().when(in_window & (quantity > 0), quantity).else_(0)).as_(
+                "incoming_stock"
+            ),
+            functions.Sum(Case().when(in_window & (quantity < 0), quantity).else_(0)).as_(
+                "outgoing_stock"
+            ),
+            functions.Sum(quantity).as_("closing_stock"),
+            functions.Sum(stock_ledger_entry.stock_value_difference).as_("closing_value"),
+        )
+        .where(stock_ledger_entry.entry_time <= filters.to_date)
+        .groupby(stock_ledger_entry.item, stock_ledger_entry.warehouse)
+        # Only report pairs that had some movement within the requested window
+        .having(functions.Count(Case().when(in_window, 1)) > 0)
     )
 
     if filters.item:
         query = query.where(stock_ledger_entry.item == filters.item)
 
     if filters.warehouse:
-        query = query.where(stock_ledger_entry.warehouse == filters.warehouse)
-
-    response: list[dict] = []
-
-    item_warehouse_pairs: list[dict] = query.run(as_dict=True)
-    for entry in item_warehouse_pairs:
-        # Get opening stock
-        if opening_stock := (frappe.qb.from_(stock_ledger_entry)
-            .select(functions.Sum(stock_ledger_entry.quantity, "result"))
-            .where(stock_ledger_entry.entry_time < filters.from_date)
-            .where(stock_ledger_entry.item == entry["item"])
-            .where(stock_ledger_entry.warehouse == entry["warehouse"])
-            .run(as_dict=True)):
-            opening_stock = opening_stock[0].get("result", 0)
-
-        # Get incoming stock
-        if incoming_stock := (frappe.qb.from_(stock_ledger_entry)
-            .select(functions.Sum(stock_ledger_entry.quantity, "result"))
-            .where(stock_ledger_entry.entry_time[filters.from_date:filters.to_date])
-            .where(stock_ledger_entry.item == entry["item"])
-            .where(stock_ledger_entry.warehouse == entry["warehouse"])
-            .run(as_dict=True)):
-            incoming_stock = incoming_stock[0].get("result", 0)
-
-        # Get outgoing stock
-        if outgoing_stock := (frappe.qb.from_(stock_ledger_entry)
-            .select(functions.Sum(stock_ledger_entry.quantity, "result"))
-            .where(stock_ledger_entry.entry_time[filters.from_date:filters.to_date])
-            .where(stock_ledger_entry.item == entry["item"])
-            .where(stock_ledger_entry.warehouse == entry["warehouse"])
-            .run(as_dict=True)
-        ):
-            outgoing_stock = outgoing_stock[0].get("result", 0)
-
-        # Get closing stock
-        if closing_stock := (frappe.qb.from_(stock_ledger_entry)
-            .select(functions.Sum(stock_ledger_entry.quantity, "result"))
-            .where(stock_ledger_entry.entry_time <= filters.to_date)
-            .where(stock_ledger_entry.item == entry["item"])
-            .where(stock_ledger_entry.warehouse == entry["warehouse"])
-            .run(as_dict=True)
-        ):
-            closing_stock = closing_stock[0].get("result", 0)
-
-        # Get valuation rate
-        if valuation_rate := (frappe.qb.from_(stock_ledger_entry)
-            .select(functions.Avg(stock_ledger_entry.rate, "result"))
-            .where(stock_ledger_entry.entry_time[filters.from_date:filters.to_date])
-            .where(stock_ledger_entry.item == entry["item"])
-            .where(stock_ledger_entry.warehouse == entry["warehouse"])
-            .run(as_dict=True)
-        ):
-            valuation_rate = valuation_rate[0].get("result", 0)
-
-        response.append(
-            {
-                "item": entry["item"],
-                "warehouse": entry["warehouse"],
-                "opening_stock": flt(opening_stock),
-                "incoming_stock": flt(incoming_stock),
-                "outgoing_stock": abs(flt(outgoing_stock)),
-                "closing_stock": flt(closing_stock),
-                "valuation_rate": flt(valuation_rate),
-            }
+        values = frappe.db.get_value("Warehouse", filters.warehouse, ["lft", "rgt", "is_group"])
+        if not values:
+            frappe.throw(f"Warehouse {filters.warehouse} does not exist")
+        lft, rgt, is_group = values
+        if is_group:
+            # A group covers every warehouse nested within its lft/rgt range
+            warehouse = DocType("Warehouse")
+            query = (
+                query.join(warehouse)
+                .on(warehouse.name == stock_ledger_entry.warehouse)
+                .where(warehouse.lft >= lft)
+                .where(warehouse.rgt <= rgt)
+            )
+        else:
+            query = query.where(stock_ledger_entry.warehouse == filters.warehouse)
+
+    if pairs is not None:
+        query = query.where(
+            Tuple(stock_ledger_entry.item, stock_ledger_entry.warehouse).isin(list(pairs))
         )
-    return columns, response
+
+    # Start from the latest period closing snapshot before the window, so that only the ledger rows
+    # posted since then have to be read no matter how old the ledger is. Carry-forward rows hold
+    # the balance since the very first row, they cannot be added to a snapshot taken before them.
+    closing = get_latest_closing(filters.from_date)
+    if (
+        closing
+        and cutoff
+        and filters.from_date >= cutoff
+        and get_datetime(closing.closing_time) < cutoff
+    ):
+        closing = None
+
+    if closing:
+        ledger = query.where(stock_ledger_entry.entry_time >= closing.closing_time).as_("ledger")
+        snapshot = DocType("Stock Closing Balance")
+        query = (
+            frappe.qb.from_(ledger)
+            .left_join(snapshot)
+            .on(
+                (snapshot.period_closing == closing.name)
+                & (snapshot.item == ledger.item)
+                & (snapshot.warehouse == ledger.warehouse)
+            )
+            .select(
+                ledger.item,
+                ledger.warehouse,
+                (ledger.opening_stock + functions.Coalesce(snapshot.quantity, 0)).as_(
+                    "opening_stock"
+                ),
+                ledger.incoming_stock,
+                ledger.outgoing_stock,
+                (ledger.closing_stock + functions.Coalesce(snapshot.quantity, 0)).as_(
+                    "closing_stock"
+                ),
+                (ledger.closing_value + functions.Coalesce(snapshot.stock_value, 0)).as_(
+                    "closing_value"
+                ),
+            )
+            .orderby(ledger.item)
+            .orderby(ledger.warehouse)
+        )
+    else:
+        query = query.orderby(stock_ledger_entry.item).orderby(stock_ledger_entry.warehouse)
+
+    return query
+
+
+def get_cache_key(filters: Filters) -> str:
+    # Rebuilding the bins bumps the version, which is done whenever the ledger is changed in bulk.
+    # Rolling up happens after the entries are fetched, so it does not need a cache of its own.
+    digest = hashlib.sha1(filters.model_dump_json(exclude={"rollup"}).encode()).hexdigest()
+    return f"{REPORT_CACHE_KEY}::v{get_balance_cache_version()}::{digest}"
+
+
+def get_cached_entries(filters: Filters) -> list[dict]:
+    """
+    Function to fetch the balances like get_entries, reusing the result of an earlier run
+
+    Results are cached per filters, along with the number of the latest ledger change they include.
+    A result is returned as is when the ledger has not changed since, otherwise only the pairs that
+    changed are fetched again and merged into it.
+
+    :param filters: Report filters
+    :return: Opening, incoming, outgoing and closing stock and closing value per pair
+    """
+    # The sequence is read before the ledger, so that anything committed in between is merged in
+    # by the next run rather than taken as included. A snapshot that the request already started
+    # earlier can still miss a commit, such a result is only kept until the cache expires.
+    sequence = get_ledger_sequence()
+    key = get_cache_key(filters)
+    cached = frappe.cache.get_value(key)
+    if cached and cached["sequence"] == sequence:
+        return cached["entries"]
+
+    changed = None
+    if cached and cached["sequence"] < sequence:
+        changed = set(get_changed_pairs(cached["sequence"]))
+
+    if changed is None or len(changed) > MAX_CHANGED_PAIRS:
+        entries = get_entries(filters)
+    else:
+        entries = [
+            entry
+            for entry in cached["entries"]
+            if (entry["item"], entry["warehouse"]) not in changed
+        ]
+        if changed:
+            entries.extend(get_entries(filters, changed))
+            entries.sort(key=lambda entry: (entry["item"], entry["warehouse"]))
+
+    # A change recorded while the ledger was read may or may not be part of the result
+    if get_ledger_sequence() != sequence:
+        return entries
+
+    set_cache = partial(
+        frappe.cache.set_value,
+        key,
+        {"sequence": sequence, "entries": entries},
+        expires_in_sec=REPORT_CACHE_EXPIRY,
+    )
+    # Uncommitted rows of the transaction must not outlive a rollback in the cache. Once they are
+    # committed, their changes are recorded after the sequence the result is cached with.
+    if frappe.db.transaction_writes:
+        frappe.db.after_commit.add(set_cache)
+    else:
+        set_cache()
+    return entries
+
+
+def get_warehouse_tree(root: str | None = None) -> list[frappe._dict]:
+    """
+    Function to fetch the warehouse tree in nested set order
+
+    :param root: Warehouse whose subtree is fetched, the whole tree when not set
+    :return: Warehouses ordered by lft, with the names of their ancestors and their depth
+    """
+    warehouse = DocType("Warehouse")
+    query = (
+        frappe.qb.from_(warehouse)
+        .select(warehouse.name, warehouse.parent_warehouse, warehouse.lft, warehouse.rgt)
+        .orderby(warehouse.lft)
+    )
+    if root:
+        values = frappe.db.get_value("Warehouse", root, ["lft", "rgt"])
+        if not values:
+            frappe.throw(f"Warehouse {root} does not exist")
+        lft, rgt = values
+        query = query.where(warehouse.lft >= lft).where(warehouse.rgt <= rgt)
+
+    # Walking the tree in lft order, the warehouses still open on the stack are the ancestors of
+    # the current one
+    tree: list[frappe._dict] = query.run(as_dict=True)
+    stack: list[frappe._dict] = []
+    for node in tree:
+        while stack and stack[-1].rgt < node.lft:
+            stack.pop()
+        node.ancestors = [ancestor.name for ancestor in stack]
+        node.indent = len(stack)
+        stack.append(node)
+    return tree
+
+
+def rollup(entries: list[dict], tree: list[frappe._dict]) -> list[dict]:
+    """
+    Function to add the balances of every warehouse to all of its ancestors
+
+    :param entries: Balances per (item, warehouse)
+    :param tree: Warehouse tree, as returned by get_warehouse_tree
+    :return: Balances of every item in every warehouse and group containing it, ordered as a tree
+    """
+    nodes = {node.name: node for node in tree}
+    totals: dict[tuple[str, str], dict] = {}
+    for entry in entries:
+        node = nodes.get(entry["warehouse"])
+        if not node:
+            continue
+
+        for warehouse in (*node.ancestors, node.name):
+            total = totals.setdefault(
+                (entry["item"], warehouse),
+                {
+                    "item": entry["item"],
+                    "warehouse": warehouse,
+                    "parent_warehouse": nodes[warehouse].parent_warehouse,
+                    "indent": nodes[warehouse].indent,
+                },
+            )
+            for field in BALANCE_FIELDS:
+                total[field] = flt(total.get(field)) + flt(entry[field])
+
+    return sorted(
+        totals.values(), key=lambda total: (total["item"], nodes[total["warehouse"]].lft)
+    )
+
+
+def get_row(entry: dict) -> dict:
+    return {
+        **entry,
+        "opening_stock": flt(entry["opening_stock"]),
+        "incoming_stock": flt(entry["incoming_stock"]),
+        "outgoing_stock": abs(flt(entry["outgoing_stock"])),
+        "closing_stock": flt(entry["closing_stock"]),
+        # Moving average valuation rate as of the end of the window
+        "valuation_rate": flt(entry["closing_value"]) / flt(entry["closing_stock"])
+        if flt(entry["closing_stock"])
+        else 0,
+    }
+
+
+def iter_rows(filters: Filters) -> Iterator[dict]:
+    """
+    Function to stream the report rows through a server side cursor
+
+    Rolled up balances need every row of a group before it can be output, so they are built in
+    memory instead. The report has a row per (item, warehouse) either way.
+
+    :param filters: Report filters
+    :return: Iterator over the report rows
+    """
+    if filters.rollup:
+        yield from execute(filters.model_dump())[1]
+        return
+
+    query = get_query(filters)
+    with frappe.db.unbuffered_cursor():
+        for entry in query.run(as_dict=True, as_iterator=True):
+            yield get_row(entry)
+
+
+@instrument
+def execute(incoming_filters: dict) -> tuple:
+    filters = Filters.model_validate(incoming_filters)
+    entries = get_cached_entries(filters)
+    if filters.rollup:
+        entries = rollup(entries, get_warehouse_tree(filters.warehouse))
+
+    response: list[dict] = [get_row(entry) for entry in entries]
+
+    if filters.rollup:
+        # Groups already include their children, so a total row would count them twice
+        return get_columns(), response, None, None, None, True
+    return get_columns(), response
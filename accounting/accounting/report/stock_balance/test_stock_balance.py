@@ -1,9 +1,146 @@
 # Copyright (c) 2023, Akhil and Contributors
 # See license.txt
 
+from datetime import timedelta
+
+import frappe
+from accounting.accounting.doctype.item.test_item import create_random_item
+from accounting.accounting.doctype.stock_entry.test_stock_entry import create_entry
+from accounting.accounting.doctype.warehouse.test_warehouse import create_random_warehouse
+from accounting.benchmarks.utils import QUERY_BUDGET_SIZES, get_query_counts
+from accounting.instrumentation import track_queries
 from frappe.tests.utils import FrappeTestCase
 
+from .stock_balance import execute
+
+
+def get_filters(**kwargs) -> dict:
+    now = frappe.utils.now_datetime()
+    return {
+        "from_date": now - timedelta(days=1),
+        "to_date": now + timedelta(days=1),
+        **kwargs,
+    }
+
 
 class TestStockBalance(FrappeTestCase):
+    def setUp(self):
+        frappe.set_user("Administrator")
+
     def test_report(self):
-        pass
+        item = create_random_item()
+        warehouse = create_random_warehouse()
+        create_entry(
+            "Receipt",
+            [{"item": item.name, "quantity": 10, "rate": 100}],
+            target_warehouse=warehouse.name,
+        )
+        create_entry(
+            "Consume",
+            [{"item": item.name, "quantity": 4, "rate": 100}],
+            source_warehouse=warehouse.name,
+        )
+
+        _, data = execute(get_filters(item=item.name, warehouse=warehouse.name))
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]["opening_stock"], 0)
+        self.assertEqual(data[0]["incoming_stock"], 10)
+        self.assertEqual(data[0]["outgoing_stock"], 4)
+        self.assertEqual(data[0]["closing_stock"], 6)
+
+    def test_missing_warehouse(self):
+        with self.assertRaises(frappe.ValidationError):
+            execute(get_filters(warehouse=frappe.generate_hash(length=10)))
+
+    def test_query_count_is_constant(self):
+        items = [create_random_item() for _ in range(max(QUERY_BUDGET_SIZES))]
+
+        def prepare(size: int):
+            warehouse = create_random_warehouse()
+            create_entry(
+                "Receipt",
+                [{"item": item.name, "quantity": 10, "rate": 100} for item in items[:size]],
+                target_warehouse=warehouse.name,
+            )
+
+            def run():
+                _, data = execute(get_filters(warehouse=warehouse.name))
+                self.assertEqual(len(data), size)
+
+            return run
+
+        counts = get_query_counts(prepare)
+        self.assertEqual(len(set(counts.values())), 1, f"Queries per number of pairs: {counts}")
+
+    def test_group_warehouse(self):
+        item = create_random_item()
+        group = frappe.new_doc(
+            "Warehouse",
+            warehouse_name=frappe.generate_hash(length=10),
+            address=frappe.generate_hash(length=10),
+            is_group=1,
+        ).insert()
+        children = [
+            frappe.new_doc(
+                "Warehouse",
+                warehouse_name=frappe.generate_hash(length=10),
+                address=frappe.generate_hash(length=10),
+                parent_warehouse=group.name,
+            ).insert()
+            for _ in range(2)
+        ]
+        for quantity, child in enumerate(children, start=1):
+            create_entry(
+                "Receipt",
+                [{"item": item.name, "quantity": quantity, "rate": 100}],
+                target_warehouse=child.name,
+            )
+
+        _, data = execute(get_filters(item=item.name, warehouse=group.name))[:2]
+        self.assertEqual(
+            sorted(row["warehouse"] for row in data), sorted(child.name for child in children)
+        )
+
+        _, data = execute(get_filters(item=item.name, warehouse=group.name, rollup=1))[:2]
+        self.assertEqual(len(data), 3)
+        self.assertEqual(data[0]["warehouse"], group.name)
+        self.assertEqual(data[0]["indent"], 0)
+        self.assertEqual(data[0]["closing_stock"], 3)
+        self.assertEqual({row["indent"] for row in data[1:]}, {1})
+
+    def test_cached_result(self):
+        item = create_random_item()
+        warehouse = create_random_warehouse()
+
+        def receive(quantity: int):
+            create_entry(
+                "Receipt",
+                [{"item": item.name, "quantity": quantity, "rate": 100}],
+                target_warehouse=warehouse.name,
+            )
+
+        def execute_cached(filters: dict) -> list[dict]:
+            data = execute(filters)[1]
+            # The result of a transaction with writes is only cached once they are committed
+            frappe.db.after_commit.run()
+            return data
+
+        receive(10)
+        # Run the callbacks of a commit, which record the change in the ledger sequence
+        frappe.db.after_commit.run()
+
+        filters = get_filters(item=item.name)
+        data = execute_cached(filters)
+        self.assertEqual(data[0]["closing_stock"], 10)
+
+        # Nothing was posted since, so the cached result is returned without touching the ledger
+        with track_queries(record=True) as stats:
+            data = execute_cached(filters)
+        self.assertEqual(stats.queries, [])
+        self.assertEqual(data[0]["closing_stock"], 10)
+
+        # Only the pair that changed is fetched again
+        receive(5)
+        frappe.db.after_commit.run()
+        data = execute_cached(filters)
+        self.assertEqual(data[0]["closing_stock"], 15)
@@ -10,7 +10,7 @@ frappe.query_reports["Stock Ledger"] = {
 			"width": "80",
 			"options": "Item",
 			"get_query": function () {
-				return frappe.db.get_list("Item");
+				return {"query": "accounting.accounting.report.search.search_link"};
 			}
 		},
 		{
@@ -20,7 +20,7 @@ frappe.query_reports["Stock Ledger"] = {
 			"width": "80",
 			"options": "Warehouse",
 			"get_query": function () {
-				return frappe.db.get_list("Warehouse");
+				return {"query": "accounting.accounting.report.search.search_link"};
 			}
 		},
 		{
@@ -36,6 +36,64 @@ frappe.query_reports["Stock Ledger"] = {
 			"fieldtype": "Datetime",
 			"width": "80",
 			"default": frappe.datetime.now_datetime()
+		},
+		{
+			"fieldname": "page_size",
+			"label": __("Page Size"),
+			"fieldtype": "Int",
+			"width": "80",
+			"default": 500
+		},
+		{
+			"fieldname": "after_entry_time",
+			"fieldtype": "Datetime",
+			"hidden": 1
+		},
+		{
+			"fieldname": "after_name",
+			"fieldtype": "Data",
+			"hidden": 1
 		}
-	]
+	],
+	"onload": function (report) {
+		// Continue after the last row shown, the server seeks straight to it
+		report.page.add_inner_button(__("Next Page"), function () {
+			const data = report.data || [];
+			if (data.length < report.get_filter_value("page_size")) {
+				frappe.show_alert(__("No more entries"));
+				return;
+			}
+			const last = data[data.length - 1];
+			report.set_filter_value({
+				"after_entry_time": last.entry_time,
+				"after_name": last.name
+			});
+		});
+		report.page.add_inner_button(__("First Page"), function () {
+			report.set_filter_value({"after_entry_time": null, "after_name": null});
+		});
+		// Exports every page, without going through the browser
+		report.page.add_inner_button(__("Export in Background"), function () {
+			frappe.prompt(
+				{
+					"fieldname": "file_format",
+					"label": __("Format"),
+					"fieldtype": "Select",
+					"options": ["CSV", "Excel"],
+					"default": "CSV"
+				},
+				function (values) {
+					frappe.call({
+						"method": "accounting.accounting.report.export.export_report",
+						"args": {
+							"report_name": "Stock Ledger",
+							"filters": report.get_filter_values(),
+							"file_format": values.file_format
+						}
+					});
+				},
+				__("Export in Background")
+			);
+		});
+	}
 };
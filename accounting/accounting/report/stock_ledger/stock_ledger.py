@@ -2,11 +2,16 @@
 # For license information, please see license.txt
 
 from datetime import datetime
+from typing import Iterator
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 import frappe
-from frappe.query_builder import DocType
+from accounting.accounting.doctype.stock_ledger_archive.stock_ledger_archive import (
+	get_archive_cutoff,
+	get_ledger_table,
+)
+from accounting.instrumentation import instrument
 
 
 class Filters(BaseModel):
@@ -14,11 +19,14 @@ class Filters(BaseModel):
 	warehouse: str | None = None
 	from_date: datetime | None = None
 	to_date: datetime | None = None
+	page_size: int = Field(default=500, gt=0, le=10_000)
+	# Keyset cursor: the (entry_time, name) of the last row of the previous page
+	after_entry_time: datetime | None = None
+	after_name: str | None = None
 
 
-def execute(incoming_filters: dict) -> tuple[list[dict], list[dict]]:
-	filters = Filters.model_validate(incoming_filters)
-	columns = [
+def get_columns() -> list[dict]:
+	return [
 		{
 			"fieldname": "item",
 			"label": "Item",
@@ -36,7 +44,7 @@ def execute(incoming_filters: dict) -> tuple[list[dict], list[dict]]:
 		{
 			"fieldname": "entry_time",
 			"label": "Entry Time",
-			"fieldtype": "DateTime",
+			"fieldtype": "Datetime",
 			"width": 200,
 		},
 		{
@@ -51,10 +59,47 @@ def execute(incoming_filters: dict) -> tuple[list[dict], list[dict]]:
 			"fieldtype": "Float",
 			"width": 200,
 		},
+		{
+			"fieldname": "qty_after_transaction",
+			"label": "Balance Quantity",
+			"fieldtype": "Float",
+			"width": 200,
+		},
+		{
+			"fieldname": "valuation_rate",
+			"label": "Valuation Rate",
+			"fieldtype": "Float",
+			"width": 200,
+		},
+		{
+			"fieldname": "name",
+			"label": "Stock Ledger Entry",
+			"fieldtype": "Link",
+			"options": "Stock Ledger Entry",
+			"hidden": 1,
+		},
 	]
 
-	stock_ledger_entry = DocType("Stock Ledger Entry")
-	query = frappe.qb.from_(stock_ledger_entry).select("*")
+
+def get_query(filters: Filters, stock_ledger_entry=None):
+	# Archived rows are only read when the window reaches back into archived periods
+	if stock_ledger_entry is None:
+		stock_ledger_entry = get_ledger_table(filters.from_date, get_archive_cutoff())
+	query = (
+		frappe.qb.from_(stock_ledger_entry)
+		.select(
+			stock_ledger_entry.name,
+			stock_ledger_entry.item,
+			stock_ledger_entry.warehouse,
+			stock_ledger_entry.entry_time,
+			stock_ledger_entry.quantity,
+			stock_ledger_entry.rate,
+			stock_ledger_entry.qty_after_transaction,
+			stock_ledger_entry.valuation_rate,
+		)
+		.orderby(stock_ledger_entry.entry_time)
+		.orderby(stock_ledger_entry.name)
+	)
 
 	if filters.item:
 		query = query.where(stock_ledger_entry.item == filters.item)
@@ -65,9 +110,87 @@ def execute(incoming_filters: dict) -> tuple[list[dict], list[dict]]:
 	if filters.from_date and filters.to_date:
 		query = query.where(stock_ledger_entry.entry_time[filters.from_date:filters.to_date])
 	elif filters.from_date:
-		query.where(stock_ledger_entry.entry_time >= filters.from_date)
+		query = query.where(stock_ledger_entry.entry_time >= filters.from_date)
 	elif filters.to_date:
-		query.where(stock_ledger_entry.entry_time <= filters.to_date)
+		query = query.where(stock_ledger_entry.entry_time <= filters.to_date)
+
+	return query
+
+
+def get_page(filters: Filters) -> list[dict]:
+	"""
+	Function to fetch one page of the ledger, ordered by (entry_time, name)
+
+	:param filters: Report filters, including the page size and the cursor to continue after
+	:return: Ledger rows of the page
+	"""
+	stock_ledger_entry = get_ledger_table(filters.from_date, get_archive_cutoff())
+	query = get_query(filters, stock_ledger_entry).limit(filters.page_size)
 
-	data = query.run()
-	return columns, data
+	# Seek past the previous page instead of using an offset, so every page costs the same
+	if filters.after_entry_time and filters.after_name:
+		query = query.where(
+			(stock_ledger_entry.entry_time > filters.after_entry_time)
+			| (
+				(stock_ledger_entry.entry_time == filters.after_entry_time)
+				& (stock_ledger_entry.name > filters.after_name)
+			)
+		)
+
+	return query.run(as_dict=True)
+
+
+def iter_pages(filters: Filters) -> Iterator[list[dict]]:
+	"""
+	Function to walk the whole ledger matching the filters one page at a time
+
+	:param filters: Report filters, the cursor is advanced after every page
+	:return: Iterator over the pages
+	"""
+	filters = filters.model_copy()
+	while page := get_page(filters):
+		yield page
+		if len(page) < filters.page_size:
+			break
+		filters.after_entry_time = page[-1]["entry_time"]
+		filters.after_name = page[-1]["name"]
+
+
+def iter_rows(filters: Filters) -> Iterator[dict]:
+	"""
+	Function to stream the whole ledger matching the filters, ignoring the page and the cursor
+
+	The rows are read through a server side cursor, so they are never all held in memory at once.
+	Nothing else can be queried until the iterator is exhausted.
+
+	:param filters: Report filters
+	:return: Iterator over the ledger rows
+	"""
+	query = get_query(filters)
+	with frappe.db.unbuffered_cursor():
+		yield from query.run(as_dict=True, as_iterator=True)
+
+
+@frappe.whitelist()
+def get_ledger_page(filters: str | dict) -> dict:
+	"""
+	Endpoint to stream the ledger to the client one page at a time
+
+	:param filters: Report filters, including the cursor returned with the previous page
+	:return: Rows of the page and the cursor for the next one, None on the last page
+	"""
+	frappe.has_permission("Stock Ledger Entry", "report", throw=True)
+	filters = Filters.model_validate(frappe.parse_json(filters))
+	data = get_page(filters)
+
+	next_cursor = None
+	if len(data) == filters.page_size:
+		next_cursor = {"after_entry_time": data[-1]["entry_time"], "after_name": data[-1]["name"]}
+
+	return {"data": data, "next_cursor": next_cursor}
+
+
+@instrument
+def execute(incoming_filters: dict) -> tuple[list[dict], list[dict]]:
+	filters = Filters.model_validate(incoming_filters)
+	return get_columns(), get_page(filters)
@@ -0,0 +1,66 @@
+# Copyright (c) 2023, Akhil and Contributors
+# See license.txt
+
+import csv
+from datetime import timedelta
+
+import frappe
+from accounting.accounting.doctype.item.test_item import create_random_item
+from accounting.accounting.doctype.stock_entry.test_stock_entry import create_entry
+from accounting.accounting.doctype.warehouse.test_warehouse import create_random_warehouse
+from accounting.accounting.report.export import build_export
+from frappe.tests.utils import FrappeTestCase
+
+from .stock_ledger import Filters, execute, iter_pages
+
+
+class TestStockLedger(FrappeTestCase):
+	def setUp(self):
+		frappe.set_user("Administrator")
+		self.item = create_random_item()
+		warehouse = create_random_warehouse()
+		for quantity in range(1, 6):
+			create_entry(
+				"Receipt",
+				[{"item": self.item.name, "quantity": quantity, "rate": 100}],
+				target_warehouse=warehouse.name,
+			)
+
+	def test_pages(self):
+		_, data = execute({"item": self.item.name, "page_size": 2})
+		self.assertEqual([row["quantity"] for row in data], [1, 2])
+
+		_, data = execute(
+			{
+				"item": self.item.name,
+				"page_size": 2,
+				"after_entry_time": data[-1]["entry_time"],
+				"after_name": data[-1]["name"],
+			}
+		)
+		self.assertEqual([row["quantity"] for row in data], [3, 4])
+
+		pages = list(iter_pages(Filters(item=self.item.name, page_size=2)))
+		self.assertEqual([len(page) for page in pages], [2, 2, 1])
+
+	def test_single_date_filters(self):
+		future = frappe.utils.now_datetime() + timedelta(days=1)
+		_, data = execute({"item": self.item.name, "from_date": future})
+		self.assertEqual(data, [])
+
+		_, data = execute({"item": self.item.name, "to_date": future})
+		self.assertEqual(len(data), 5)
+
+	def test_export(self):
+		file_url = build_export("Stock Ledger", {"item": self.item.name}, "CSV", "Administrator")
+		self.assertEqual(
+			frappe.db.get_value(
+				"File", {"file_url": file_url}, ["attached_to_doctype", "attached_to_name"]
+			),
+			("Report", "Stock Ledger"),
+		)
+
+		with open(frappe.get_site_path(*file_url.strip("/").split("/"))) as f:
+			rows = list(csv.reader(f))
+		self.assertEqual(rows[0][:2], ["Item", "Warehouse"])
+		self.assertEqual([float(row[3]) for row in rows[1:]], [1, 2, 3, 4, 5])
@@ -0,0 +1,46 @@
+# Copyright (c) 2023, Akhil and Contributors
+# See license.txt
+
+import frappe
+from accounting.accounting.doctype.item.test_item import create_random_item
+from accounting.accounting.doctype.warehouse.test_warehouse import create_random_warehouse
+from frappe.tests.utils import FrappeTestCase
+
+from .search import search_link
+
+
+class TestSearch(FrappeTestCase):
+	def setUp(self):
+		frappe.set_user("Administrator")
+
+	def test_search(self):
+		prefix = frappe.generate_hash(length=8)
+		items = [create_random_item(f"{prefix}{index}") for index in range(3)]
+		named = create_random_item(f"x{prefix}")
+
+		# Prefix matches on the item name come first, then substring matches
+		matches = search_link("Item", prefix, "name", 0, 10)
+		self.assertEqual(
+			[name for name, _ in matches], [*(item.name for item in items), named.name]
+		)
+		self.assertEqual(search_link("Item", prefix, "name", 2, 2), matches[2:4])
+
+		group = frappe.new_doc(
+			"Warehouse",
+			warehouse_name=f"{prefix}-group",
+			address=frappe.generate_hash(length=10),
+			is_group=1,
+		).insert()
+		child = create_random_warehouse(f"{prefix}-child")
+		child.parent_warehouse = group.name
+		child.save()
+		create_random_warehouse(f"{prefix}-other")
+
+		matches = search_link("Warehouse", prefix, "name", 0, 10, {"parent": group.name})
+		self.assertEqual([name for name, _ in matches], [child.name, group.name])
+
+	def test_search_missing_parent(self):
+		with self.assertRaises(frappe.ValidationError):
+			search_link(
+				"Warehouse", "", "name", 0, 10, {"parent": frappe.generate_hash(length=10)}
+			)
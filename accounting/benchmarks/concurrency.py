@@ -0,0 +1,115 @@
+"""
+Concurrent stock posting stress benchmark
+
+Run with: bench --site <site> execute accounting.benchmarks.concurrency.run
+Run on a throwaway site, the setup and the entries are committed. Every worker is a separate
+process with its own database connection, submitting Consume entries against the same few items so
+that they contend for the same bins.
+"""
+import multiprocessing
+import random
+import time
+
+import frappe
+from accounting.accounting.doctype.bin.bin import get_bin_balances
+from accounting.utils import generate_random_string
+
+
+def consume(site: str, sites_path: str, warehouse: str, items: list[str], entries: int) -> int:
+	"""
+	Function run in every worker process to submit Consume entries one after the other
+
+	The lines of every entry are shuffled, so that workers ask for the same bins in different
+	orders.
+
+	:param site: Site to connect to
+	:param sites_path: Path of the sites directory
+	:param warehouse: Warehouse to consume from
+	:param items: Items consumed by every entry, one unit each
+	:param entries: Number of entries to submit
+	:return: Number of entries that were submitted, the rest ran out of stock
+	"""
+	frappe.init(site=site, sites_path=sites_path)
+	frappe.connect()
+	frappe.set_user("Administrator")
+	submitted = 0
+	try:
+		for _ in range(entries):
+			lines = [{"item": item, "quantity": 1, "rate": 100} for item in items]
+			random.shuffle(lines)
+			try:
+				frappe.new_doc(
+					"Stock Entry", entry_type="Consume", source_warehouse=warehouse, items=lines
+				).insert().submit()
+				frappe.db.commit()
+				submitted += 1
+			except frappe.ValidationError:
+				frappe.db.rollback()
+	finally:
+		frappe.destroy()
+	return submitted
+
+
+def setup(items: int, stock: int) -> tuple[str, list[str]]:
+	"""
+	Function to create a warehouse and items with some stock, committed so the workers see them
+
+	:param items: Number of items
+	:param stock: Quantity of every item received into the warehouse
+	:return: Name of the warehouse and of the items
+	"""
+	warehouse = (
+		frappe.new_doc(
+			"Warehouse", warehouse_name=generate_random_string(), address=generate_random_string()
+		)
+		.insert()
+		.name
+	)
+	item_names = [
+		frappe.new_doc("Item", item_name=generate_random_string()).insert().name
+		for _ in range(items)
+	]
+	frappe.new_doc(
+		"Stock Entry",
+		entry_type="Receipt",
+		target_warehouse=warehouse,
+		items=[{"item": item, "quantity": stock, "rate": 100} for item in item_names],
+	).insert().submit()
+	frappe.db.commit()
+	return warehouse, item_names
+
+
+def run(processes: int = 8, entries: int = 20, items: int = 3, stock: int = 100) -> dict:
+	"""
+	Function to hammer the same bins from several processes at once
+
+	:param processes: Number of worker processes
+	:param entries: Number of entries submitted by every worker
+	:param items: Number of items on every entry
+	:param stock: Quantity of every item available before the workers start
+	:return: Number of submitted entries, the throughput and the final balance of every item
+	"""
+	frappe.set_user("Administrator")
+	warehouse, item_names = setup(items, stock)
+
+	start = time.perf_counter()
+	with multiprocessing.get_context("spawn").Pool(processes) as pool:
+		submitted = sum(
+			pool.starmap(
+				consume,
+				[
+					(frappe.local.site, frappe.local.sites_path, warehouse, item_names, entries)
+					for _ in range(processes)
+				],
+			)
+		)
+	seconds = time.perf_counter() - start
+
+	balances = get_bin_balances((item, warehouse) for item in item_names)
+	return {
+		"submitted": submitted,
+		"seconds": seconds,
+		"entries_per_second": processes * entries / seconds,
+		"balances": {item: balances[(item, warehouse)].actual_qty for item in item_names},
+		"stock": stock,
+	}
@@ -0,0 +1,183 @@
+"""
+Synthetic stock ledger for benchmarks
+
+Run on a throwaway site: the generated items, warehouses and ledger rows are committed so that they
+can be reused across benchmark runs, and removed with clear().
+"""
+import itertools
+import random
+from datetime import timedelta
+
+import frappe
+from accounting.accounting.doctype.bin.bin import (
+	get_stock_value_difference,
+	get_valuation_rate,
+	rebuild_bins,
+)
+from accounting.accounting.doctype.stock_entry.stock_entry import LEDGER_FIELDS
+
+PREFIX = "BENCH"
+SOURCE = f"{PREFIX}-LEDGER"
+
+
+def get_weights(count: int, skew: float) -> list[float]:
+	# Zipf-like weights, so that a few items and warehouses see most of the movement
+	return [1 / (rank**skew) for rank in range(1, count + 1)]
+
+
+def insert_items(count: int) -> list[str]:
+	now = frappe.utils.now_datetime()
+	names = [f"{PREFIX}-ITEM-{idx:07d}" for idx in range(count)]
+	frappe.db.bulk_insert(
+		"Item",
+		["name", "creation", "modified", "owner", "modified_by", "item_name"],
+		[(name, now, now, "Administrator", "Administrator", name) for name in names],
+		ignore_duplicates=True,
+	)
+	return names
+
+
+def insert_warehouses(count: int) -> list[str]:
+	"""
+	Function to insert a group warehouse holding the given number of warehouses
+
+	The nested set is laid out after the existing tree, so the rest of the tree is left untouched.
+
+	:param count: Number of warehouses in the group
+	:return: Names of the warehouses in the group
+	"""
+	root = f"{PREFIX}-WAREHOUSE"
+	if frappe.db.exists("Warehouse", root):
+		return frappe.get_all("Warehouse", filters={"parent_warehouse": root}, pluck="name")
+
+	now = frappe.utils.now_datetime()
+	lft = (frappe.db.sql("select max(rgt) from `tabWarehouse`")[0][0] or 0) + 1
+	names = [f"{PREFIX}-WAREHOUSE-{idx:05d}" for idx in range(count)]
+	rows = [(root, root, 1, None, lft, lft + 2 * count + 1)]
+	rows.extend(
+		(name, name, 0, root, lft + 1 + 2 * idx, lft + 2 + 2 * idx) for idx, name in enumerate(names)
+	)
+	frappe.db.bulk_insert(
+		"Warehouse",
+		[
+			"name",
+			"creation",
+			"modified",
+			"owner",
+			"modified_by",
+			"warehouse_name",
+			"is_group",
+			"parent_warehouse",
+			"lft",
+			"rgt",
+			"address",
+		],
+		[(name, now, now, "Administrator", "Administrator", *row, PREFIX) for name, *row in rows],
+	)
+	return names
+
+
+def generate_ledger(
+	items: int = 1000,
+	warehouses: int = 500,
+	rows: int = 5_000_000,
+	days: int = 365,
+	skew: float = 1.1,
+	chunk_size: int = 10_000,
+	seed: int = 0,
+) -> dict:
+	"""
+	Function to generate a realistic stock ledger with a skewed distribution of movements
+
+	Every row carries a consistent running balance and the bins are rebuilt at the end, so the
+	generated ledger can be posted against like a real one. The running balances start from zero,
+	so the ledger of a previous run is removed first.
+
+	:param items: Number of items
+	:param warehouses: Number of warehouses
+	:param rows: Number of ledger rows
+	:param days: Number of days, up to now, the rows are spread over
+	:param skew: Skew of the distribution of rows over items and warehouses
+	:param chunk_size: Number of rows inserted and committed at once
+	:param seed: Seed of the random generator, so runs can be compared
+	:return: Names of the generated items and warehouses
+	"""
+	generator = random.Random(seed)
+	frappe.db.delete("Stock Ledger Entry", {"source": SOURCE})
+	item_names = insert_items(items)
+	warehouse_names = insert_warehouses(warehouses)
+	frappe.db.commit()
+
+	item_weights = list(itertools.accumulate(get_weights(items, skew)))
+	warehouse_weights = list(itertools.accumulate(get_weights(warehouses, skew)))
+
+	balances: dict[tuple[str, str], list[float]] = {}
+	start = frappe.utils.now_datetime() - timedelta(days=days)
+	step = timedelta(days=days) / rows
+
+	for chunk_start in range(0, rows, chunk_size):
+		chunk_items = generator.choices(item_names, cum_weights=item_weights, k=chunk_size)
+		chunk_warehouses = generator.choices(
+			warehouse_names, cum_weights=warehouse_weights, k=chunk_size
+		)
+		values = []
+		for idx, (item, warehouse) in enumerate(zip(chunk_items, chunk_warehouses)):
+			if chunk_start + idx >= rows:
+				break
+
+			actual_qty, stock_value = balances.get((item, warehouse), (0.0, 0.0))
+			rate = generator.randint(100, 1000)
+			# Consume part of the stock about a third of the time, receive stock otherwise
+			if actual_qty > 1 and generator.random() < 0.35:
+				quantity = -float(generator.randint(1, int(actual_qty // 2) or 1))
+			else:
+				quantity = float(generator.randint(1, 100))
+
+			stock_value_difference = get_stock_value_difference(
+				actual_qty, stock_value, quantity, rate
+			)
+			actual_qty += quantity
+			stock_value += stock_value_difference
+			balances[(item, warehouse)] = (actual_qty, stock_value)
+
+			entry_time = start + step * (chunk_start + idx)
+			values.append(
+				(
+					frappe.generate_hash(length=10),
+					entry_time,
+					entry_time,
+					"Administrator",
+					"Administrator",
+					item,
+					warehouse,
+					entry_time,
+					quantity,
+					rate,
+					actual_qty,
+					get_valuation_rate(actual_qty, stock_value),
+					stock_value,
+					stock_value_difference,
+					"Stock Entry",
+					SOURCE,
+					0,
+					0,
+				)
+			)
+
+		frappe.db.bulk_insert("Stock Ledger Entry", LEDGER_FIELDS, values, chunk_size=chunk_size)
+		frappe.db.commit()
+
+	rebuild_bins()
+	frappe.db.commit()
+	return {"items": item_names, "warehouses": warehouse_names}
+
+
+def clear():
+	"""
+	Function to remove everything generated for the benchmarks
+	"""
+	frappe.db.delete("Stock Ledger Entry", {"source": SOURCE})
+	frappe.db.delete("Warehouse", {"name": ["like", f"{PREFIX}-%"]})
+	frappe.db.delete("Item", {"name": ["like", f"{PREFIX}-%"]})
+	rebuild_bins()
+	frappe.db.commit()
@@ -0,0 +1,96 @@
+"""
+Benchmark for Stock Entry submission latency
+
+Run with: bench --site <site> execute accounting.benchmarks.stock_entry.run
+Everything created by the benchmark is rolled back once it finishes.
+"""
+import statistics
+import time
+
+import frappe
+from accounting.utils import generate_random_string
+
+
+def create_items(count: int) -> list[str]:
+	return [
+		frappe.new_doc("Item", item_name=generate_random_string()).insert().name
+		for _ in range(count)
+	]
+
+
+def create_warehouses(count: int) -> list[str]:
+	return [
+		frappe.new_doc(
+			"Warehouse",
+			warehouse_name=generate_random_string(),
+			address=generate_random_string(),
+		)
+		.insert()
+		.name
+		for _ in range(count)
+	]
+
+
+def time_submit(doc) -> float:
+	"""
+	Function to measure how long submitting a stock entry takes
+
+	:param doc: Unsaved stock entry
+	:return: Time taken by insert and submit, in seconds
+	"""
+	start = time.perf_counter()
+	doc.insert().submit()
+	return time.perf_counter() - start
+
+
+def run(line_counts: tuple[int, ...] = (10, 100, 1000), repeat: int = 3) -> dict:
+	"""
+	Function to benchmark Receipt and Transfer submission for stock entries of different sizes
+
+	:param line_counts: Number of lines in the benchmarked stock entries
+	:param repeat: Number of times every measurement is repeated
+	:return: Median submission latency in seconds, keyed by entry type and line count
+	"""
+	frappe.set_user("Administrator")
+	results: dict[str, dict[int, float]] = {"Receipt": {}, "Transfer": {}}
+	try:
+		# Measured in the foreground whatever the site is configured with
+		frappe.db.set_single_value("Stock Settings", "background_submit_threshold", 0)
+		items = create_items(max(line_counts))
+		source_warehouse, target_warehouse = create_warehouses(2)
+
+		for line_count in line_counts:
+			lines = [{"item": item, "quantity": 10, "rate": 100} for item in items[:line_count]]
+			receipts, transfers = [], []
+			for _ in range(repeat):
+				receipts.append(
+					time_submit(
+						frappe.new_doc(
+							"Stock Entry",
+							entry_type="Receipt",
+							target_warehouse=source_warehouse,
+							items=lines,
+						)
+					)
+				)
+				transfers.append(
+					time_submit(
+						frappe.new_doc(
+							"Stock Entry",
+							entry_type="Transfer",
+							source_warehouse=source_warehouse,
+							target_warehouse=target_warehouse,
+							items=lines,
+						)
+					)
+				)
+			results["Receipt"][line_count] = statistics.median(receipts)
+			results["Transfer"][line_count] = statistics.median(transfers)
+			print(
+				f"{line_count:>6} lines: receipt {results['Receipt'][line_count]:.3f}s, "
+				f"transfer {results['Transfer'][line_count]:.3f}s"
+			)
+	finally:
+		frappe.db.rollback()
+
+	return results
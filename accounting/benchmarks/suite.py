@@ -0,0 +1,155 @@
+"""
+Synthetic-load benchmark suite for stock posting and reports
+
+Run with: bench --site <site> execute accounting.benchmarks.suite.run --kwargs "{'rows': 100000}"
+The ledger is generated once per site (see accounting.benchmarks.data) and reused by later runs,
+the stock entries posted while measuring are rolled back. Results are printed and written to the
+site as JSON.
+"""
+import json
+import os
+import platform
+from datetime import timedelta
+
+import frappe
+from accounting.accounting.report.stock_ageing import stock_ageing
+from accounting.accounting.report.stock_balance import stock_balance
+from accounting.accounting.report.stock_ledger import stock_ledger
+from accounting.benchmarks import data
+from accounting.benchmarks.utils import Measurement, measure
+
+
+def measure_stock_entries(
+	items: list[str], warehouses: list[str], line_counts: tuple[int, ...]
+) -> list[Measurement]:
+	measurements = []
+	source_warehouse, target_warehouse = warehouses[:2]
+	for line_count in line_counts:
+		lines = [{"item": item, "quantity": 1, "rate": 100} for item in items[:line_count]]
+		for entry_type, kwargs in (
+			("Receipt", {"target_warehouse": source_warehouse}),
+			(
+				"Transfer",
+				{"source_warehouse": source_warehouse, "target_warehouse": target_warehouse},
+			),
+			("Consume", {"source_warehouse": target_warehouse}),
+		):
+			doc = frappe.new_doc("Stock Entry", entry_type=entry_type, items=lines, **kwargs)
+			with measure(f"stock_entry.submit.{entry_type.lower()}.{line_count}") as measurement:
+				doc.insert().submit()
+			measurements.append(measurement)
+
+			with measure(f"stock_entry.cancel.{entry_type.lower()}.{line_count}") as measurement:
+				doc.cancel()
+			measurements.append(measurement)
+
+			# Post the entry again, so that the next entry type has stock to move
+			frappe.new_doc(
+				"Stock Entry", entry_type=entry_type, items=lines, **kwargs
+			).insert().submit()
+
+	return measurements
+
+
+def measure_reports(items: list[str], warehouses: list[str]) -> list[Measurement]:
+	measurements = []
+	now = frappe.utils.now_datetime()
+	windows = {"month": now - timedelta(days=30), "year": now - timedelta(days=365)}
+
+	for window, from_date in windows.items():
+		for scope, filters in (
+			("all", {}),
+			("item", {"item": items[0]}),
+			("warehouse", {"warehouse": warehouses[0]}),
+		):
+			with measure(f"stock_balance.{window}.{scope}", trace_memory=True) as measurement:
+				stock_balance.execute({"from_date": from_date, "to_date": now, **filters})
+			measurements.append(measurement)
+
+			# Same filters again, served from the result cache
+			with measure(f"stock_balance.{window}.{scope}.cached") as measurement:
+				stock_balance.execute({"from_date": from_date, "to_date": now, **filters})
+			measurements.append(measurement)
+
+		with measure(f"stock_ledger.{window}.first_page", trace_memory=True) as measurement:
+			stock_ledger.execute({"from_date": from_date, "to_date": now})
+		measurements.append(measurement)
+
+		with measure(f"stock_ledger.{window}.all_pages", trace_memory=True) as measurement:
+			for _ in stock_ledger.iter_pages(
+				stock_ledger.Filters(from_date=from_date, to_date=now, page_size=5000)
+			):
+				pass
+		measurements.append(measurement)
+
+	# Ages the whole ledger at once, whatever the window
+	with measure("stock_ageing.all", trace_memory=True) as measurement:
+		stock_ageing.execute({"to_date": now})
+	measurements.append(measurement)
+
+	return measurements
+
+
+def run(
+	items: int = 1000,
+	warehouses: int = 500,
+	rows: int = 5_000_000,
+	line_counts: tuple[int, ...] = (1, 10, 100),
+	generate: bool | None = None,
+	output: str | None = None,
+) -> dict:
+	"""
+	Function to run the whole benchmark suite
+
+	:param items: Number of items in the generated ledger
+	:param warehouses: Number of warehouses in the generated ledger
+	:param rows: Number of rows in the generated ledger
+	:param line_counts: Number of lines in the benchmarked stock entries
+	:param generate: Whether to generate the ledger again, by default it is only generated when no
+		previous run left one to reuse
+	:param output: Path of the JSON results, defaults to benchmarks/<timestamp>.json in the site
+	:return: Benchmark results
+	"""
+	frappe.set_user("Administrator")
+	if generate is None:
+		generate = not frappe.db.exists("Stock Ledger Entry", {"source": data.SOURCE})
+	if generate:
+		generated = data.generate_ledger(items=items, warehouses=warehouses, rows=rows)
+	else:
+		generated = {
+			"items": frappe.get_all(
+				"Item",
+				filters={"name": ["like", f"{data.PREFIX}-%"]},
+				pluck="name",
+				order_by="name",
+			),
+			"warehouses": data.insert_warehouses(warehouses),
+		}
+
+	try:
+		# Reports go first, their results are not cached while the transaction has writes
+		measurements = measure_reports(generated["items"], generated["warehouses"])
+		# Stock entries are measured in the foreground whatever the site is configured with
+		frappe.db.set_single_value("Stock Settings", "background_submit_threshold", 0)
+		measurements += measure_stock_entries(
+			generated["items"], generated["warehouses"], line_counts
+		)
+	finally:
+		frappe.db.rollback()
+
+	results = {
+		"timestamp": frappe.utils.now(),
+		"python": platform.python_version(),
+		"ledger_rows": frappe.db.count("Stock Ledger Entry"),
+		"measurements": [measurement.as_dict() for measurement in measurements],
+	}
+
+	output = output or frappe.get_site_path(
+		"benchmarks", f"{frappe.utils.now_datetime():%Y%m%d%H%M%S}.json"
+	)
+	os.makedirs(os.path.dirname(output), exist_ok=True)
+	with open(output, "w") as f:
+		json.dump(results, f, indent=1)
+
+	print(json.dumps(results, indent=1))
+	return results
@@ -0,0 +1,74 @@
+import time
+import tracemalloc
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from typing import Callable, Iterable, Iterator
+
+from accounting.instrumentation import track_queries
+
+# Sizes the query budget of hot paths is checked at
+QUERY_BUDGET_SIZES = (1, 10, 100)
+
+
+@dataclass
+class Measurement:
+	name: str
+	seconds: float = 0
+	queries: int = 0
+	# Peak memory allocated in Python while measuring, in bytes, only set when traced
+	peak_memory: int | None = None
+
+	def as_dict(self) -> dict:
+		return asdict(self)
+
+
+@contextmanager
+def measure(name: str, trace_memory: bool = False) -> Iterator[Measurement]:
+	"""
+	Context manager to measure the wall time and number of queries of the code it wraps
+
+	:param name: Name of the measurement
+	:param trace_memory: Whether to also trace the peak memory, which slows the code down
+	:return: Measurement that is filled in once the block exits
+	"""
+	measurement = Measurement(name)
+	if trace_memory:
+		tracemalloc.start()
+	start = time.perf_counter()
+	with track_queries() as stats:
+		try:
+			yield measurement
+		finally:
+			measurement.seconds = time.perf_counter() - start
+			measurement.queries = stats.count
+			if trace_memory:
+				measurement.peak_memory = tracemalloc.get_traced_memory()[1]
+				tracemalloc.stop()
+
+
+def get_query_counts(
+	prepare: Callable[[int], Callable[[], object]],
+	sizes: Iterable[int] = QUERY_BUDGET_SIZES,
+	exclude: Iterable[str] = (),
+) -> dict[int, int]:
+	"""
+	Function to count the queries of an operation at different sizes, to check they stay constant
+
+	The operation is run once beforehand, so that caches filled on first use are not counted.
+
+	:param prepare: Function setting up the operation for a size and returning it, only the queries
+		of the returned operation are counted
+	:param sizes: Sizes to run the operation at
+	:param exclude: Tables whose statements are not counted
+	:return: Mapping of size to the number of queries
+	"""
+	sizes = list(sizes)
+	prepare(sizes[0])()
+
+	counts = {}
+	for size in sizes:
+		operation = prepare(size)
+		with track_queries(exclude) as stats:
+			operation()
+		counts[size] = stats.count
+	return counts
@@ -0,0 +1,21 @@
+import click
+from frappe.commands import get_site, pass_context
+
+
+@click.command("rebuild-bins")
+@pass_context
+def rebuild_bins(context):
+	"""Recreate the Bin table from the Stock Ledger Entry table"""
+	import frappe
+	from accounting.accounting.doctype.bin.bin import rebuild_bins
+
+	frappe.init(site=get_site(context))
+	frappe.connect()
+	try:
+		rebuild_bins()
+		frappe.db.commit()
+	finally:
+		frappe.destroy()
+
+
+commands = [rebuild_bins]
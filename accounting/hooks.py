@@ -133,23 +133,13 @@ app_license = "mit"
 # Scheduled Tasks
 # ---------------
 
-# scheduler_events = {
-#	"all": [
-#		"accounting.tasks.all"
-#	],
-#	"daily": [
-#		"accounting.tasks.daily"
-#	],
-#	"hourly": [
-#		"accounting.tasks.hourly"
-#	],
-#	"weekly": [
-#		"accounting.tasks.weekly"
-#	],
-#	"monthly": [
-#		"accounting.tasks.monthly"
-#	],
-# }
+scheduler_events = {
+	"all": ["accounting.accounting.doctype.stock_repost_entry.stock_repost_entry.enqueue_repost"],
+	"monthly": [
+		"accounting.accounting.doctype.stock_period_closing.stock_period_closing.close_previous_month",
+		"accounting.accounting.doctype.stock_ledger_archive.stock_ledger_archive.archive_ledger",
+	],
+}
 
 # Testing
 # -------
@@ -181,13 +171,13 @@ app_license = "mit"
 
 # Request Events
 # ----------------
-# before_request = ["accounting.utils.before_request"]
-# after_request = ["accounting.utils.after_request"]
+before_request = ["accounting.instrumentation.start"]
+after_request = ["accounting.instrumentation.stop"]
 
 # Job Events
 # ----------
-# before_job = ["accounting.utils.before_job"]
-# after_job = ["accounting.utils.after_job"]
+before_job = ["accounting.instrumentation.start"]
+after_job = ["accounting.instrumentation.stop"]
 
 # User Data Protection
 # --------------------
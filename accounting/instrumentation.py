@@ -0,0 +1,214 @@
+# Copyright (c) 2023, Akhil and contributors
+# For license information, please see license.txt
+import functools
+import json
+import math
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Callable, Iterable, Iterator
+
+import frappe
+
+# Latest samples kept for every instrumented function
+SAMPLE_SIZE = 1000
+SAMPLES_KEY = "instrumentation_samples"
+NAMES_KEY = "instrumentation_names"
+PERCENTILES = (50, 95, 99)
+
+
+@dataclass
+class QueryStats:
+	"""
+	Queries run on the current connection while they are tracked by track_queries
+	"""
+
+	# Tables whose statements are left out, e.g. child tables that Frappe writes a row at a time
+	exclude: Iterable[str] = ()
+	# Whether to keep the statements themselves, which costs turning every query into a string
+	record: bool = False
+	count: int = 0
+	time: float = 0.0
+	queries: list[str] = field(default_factory=list)
+
+	def __post_init__(self):
+		self.exclude = [f"`tab{table}`" for table in self.exclude]
+
+	def add(self, query, seconds: float):
+		if self.exclude or self.record:
+			query = str(query)
+			if any(table in query for table in self.exclude):
+				return
+			if self.record:
+				self.queries.append(query)
+		self.count += 1
+		self.time += seconds
+
+
+def get_query_trackers() -> list[QueryStats] | None:
+	"""
+	Function to wrap frappe.db.sql of the current connection once, so that its queries can be tracked
+
+	Queries cost two clock reads each while anything is tracking them, nothing otherwise.
+
+	:return: QueryStats every query is added to, None without a connection
+	"""
+	db = getattr(frappe.local, "db", None)
+	if not db:
+		return None
+	if (trackers := getattr(db.sql, "query_trackers", None)) is not None:
+		return trackers
+
+	sql = db.sql
+	trackers = []
+
+	@functools.wraps(sql)
+	def tracked_sql(*args, **kwargs):
+		if not trackers:
+			return sql(*args, **kwargs)
+
+		start = time.perf_counter()
+		try:
+			return sql(*args, **kwargs)
+		finally:
+			seconds = time.perf_counter() - start
+			query = args[0] if args else kwargs.get("query")
+			for tracker in trackers:
+				tracker.add(query, seconds)
+
+	tracked_sql.query_trackers = trackers
+	db.sql = tracked_sql
+	return trackers
+
+
+@contextmanager
+def track_queries(exclude: Iterable[str] = (), record: bool = False) -> Iterator[QueryStats]:
+	"""
+	Context manager counting and timing the queries run on the current connection in the block
+
+	Blocks can be nested, every one of them tracks the queries run within it.
+
+	:param exclude: Tables whose statements are not tracked
+	:param record: Whether to keep the statements as well
+	:return: QueryStats that is filled in while the block runs
+	"""
+	stats = QueryStats(exclude, record)
+	trackers = get_query_trackers()
+	if trackers is None:
+		yield stats
+		return
+
+	trackers.append(stats)
+	try:
+		yield stats
+	finally:
+		trackers.remove(stats)
+
+
+def start():
+	"""
+	Hook run before every request and background job, samples are buffered until it ends
+	"""
+	frappe.local.instrumentation_samples = []
+
+
+def stop():
+	"""
+	Hook run after every request and background job, writing its samples in one round trip
+	"""
+	samples = getattr(frappe.local, "instrumentation_samples", None)
+	frappe.local.instrumentation_samples = None
+	if samples:
+		write_samples(samples)
+
+
+def get_samples_key(name: str) -> str:
+	return f"{SAMPLES_KEY}::{name}"
+
+
+def write_samples(samples: list[tuple[str, tuple[float, int, float]]]):
+	# Commands on the pipeline go to redis as they are, unlike those of frappe.cache the keys are
+	# not prefixed with the site
+	names = {name for name, _ in samples}
+	pipeline = frappe.cache.pipeline()
+	for name, sample in samples:
+		pipeline.lpush(frappe.cache.make_key(get_samples_key(name)), json.dumps(sample))
+	for name in names:
+		pipeline.ltrim(frappe.cache.make_key(get_samples_key(name)), 0, SAMPLE_SIZE - 1)
+	pipeline.sadd(frappe.cache.make_key(NAMES_KEY), *names)
+	pipeline.execute()
+
+
+def record_sample(name: str, sample: tuple[float, int, float]):
+	samples = getattr(frappe.local, "instrumentation_samples", None)
+	if samples is None:
+		# Outside of requests and jobs, e.g. in the console or in tests
+		write_samples([(name, sample)])
+	else:
+		samples.append((name, sample))
+
+
+def instrument(func: Callable) -> Callable:
+	"""
+	Decorator recording the wall time, the query count and the query time of every call to func
+
+	:param func: Function to instrument, named after its module and qualified name
+	:return: Instrumented function
+	"""
+	name = f"{func.__module__.rsplit('.', 1)[-1]}.{func.__qualname__}"
+
+	@functools.wraps(func)
+	def wrapper(*args, **kwargs):
+		start_time = time.perf_counter()
+		with track_queries() as stats:
+			try:
+				return func(*args, **kwargs)
+			finally:
+				record_sample(name, (time.perf_counter() - start_time, stats.count, stats.time))
+
+	return wrapper
+
+
+def get_percentile(values: list[float], percentile: int) -> float:
+	# Nearest rank of the sorted values
+	return values[max(math.ceil(len(values) * percentile / 100), 1) - 1]
+
+
+def get_stats() -> list[dict]:
+	"""
+	Function to aggregate the latest samples of every instrumented function into percentiles
+
+	:return: Call count and percentiles of the wall time, query count and query time per function
+	"""
+	names = sorted(name.decode() for name in frappe.cache.smembers(NAMES_KEY))
+	pipeline = frappe.cache.pipeline()
+	for name in names:
+		pipeline.lrange(frappe.cache.make_key(get_samples_key(name)), 0, -1)
+
+	stats = []
+	for name, samples in zip(names, pipeline.execute()):
+		if not samples:
+			continue
+		wall_times, query_counts, query_times = (
+			sorted(column) for column in zip(*(json.loads(sample) for sample in samples))
+		)
+		row = {"name": name, "calls": len(samples)}
+		for percentile in PERCENTILES:
+			row[f"p{percentile}_time"] = get_percentile(wall_times, percentile) * 1000
+			row[f"p{percentile}_queries"] = get_percentile(query_counts, percentile)
+			row[f"p{percentile}_query_time"] = get_percentile(query_times, percentile) * 1000
+		stats.append(row)
+	return stats
+
+
+@frappe.whitelist()
+def get_instrumentation_stats() -> list[dict]:
+	"""
+	Endpoint to fetch the percentiles of the instrumented stock posting and report functions
+
+	Times are in milliseconds, over the latest SAMPLE_SIZE calls of every function.
+
+	:return: Call count and percentiles of the wall time, query count and query time per function
+	"""
+	frappe.only_for("System Manager")
+	return get_stats()
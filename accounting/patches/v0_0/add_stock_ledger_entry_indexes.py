@@ -0,0 +1,21 @@
+import frappe
+
+# Index name -> columns, matching the indexes declared by the Stock Ledger Entry doctype
+INDEXES = {
+	"item_warehouse_entry_time_index": ["item", "warehouse", "entry_time"],
+	"entry_time": ["entry_time"],
+}
+
+
+def execute():
+	# Build the indexes online before the doctype is synced, so that a large ledger keeps accepting
+	# writes while they are created. The sync then finds them in place and leaves them untouched.
+	for index_name, columns in INDEXES.items():
+		if frappe.db.has_index("tabStock Ledger Entry", index_name):
+			continue
+
+		frappe.db.sql_ddl(
+			f"""ALTER TABLE `tabStock Ledger Entry`
+			ADD INDEX `{index_name}` ({", ".join(f"`{column}`" for column in columns)}),
+			ALGORITHM=INPLACE, LOCK=NONE"""
+		)
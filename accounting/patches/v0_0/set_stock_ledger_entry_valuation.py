@@ -0,0 +1,49 @@
+import frappe
+from accounting.accounting.doctype.bin.bin import (
+	get_stock_value_difference,
+	get_valuation_rate,
+	rebuild_bins,
+)
+from frappe.query_builder import DocType
+
+
+def execute():
+	# Replay the ledger of every (item, warehouse) pair to fill in the running balance on rows that
+	# were posted before it was stored, then recreate the bins from the filled in rows
+	stock_ledger_entry = DocType("Stock Ledger Entry")
+	pairs = (
+		frappe.qb.from_(stock_ledger_entry)
+		.distinct()
+		.select(stock_ledger_entry.item, stock_ledger_entry.warehouse)
+		.run()
+	)
+
+	for item, warehouse in pairs:
+		rows = (
+			frappe.qb.from_(stock_ledger_entry)
+			.select(stock_ledger_entry.name, stock_ledger_entry.quantity, stock_ledger_entry.rate)
+			.where(stock_ledger_entry.item == item)
+			.where(stock_ledger_entry.warehouse == warehouse)
+			.orderby(stock_ledger_entry.entry_time)
+			.orderby(stock_ledger_entry.creation)
+			.run(as_dict=True)
+		)
+
+		actual_qty = stock_value = 0.0
+		updates = {}
+		for row in rows:
+			stock_value_difference = get_stock_value_difference(
+				actual_qty, stock_value, row.quantity, row.rate
+			)
+			actual_qty += row.quantity
+			stock_value += stock_value_difference
+			updates[row.name] = {
+				"qty_after_transaction": actual_qty,
+				"valuation_rate": get_valuation_rate(actual_qty, stock_value),
+				"stock_value": stock_value,
+				"stock_value_difference": stock_value_difference,
+			}
+
+		frappe.db.bulk_update("Stock Ledger Entry", updates, update_modified=False)
+
+	rebuild_bins()